@@ -1,16 +1,18 @@
 # admin_server.py
 # A separate server for the admin panel, now refactored to use request handlers.
 
-import http.server
 import socketserver
-import json
 import os
-from urllib.parse import urlparse
-import datetime
 
 # Import the new database and handler modules
+from db.connection import start_replica_health_checks, warm_pools
 from db.user_queries import get_entity_by_token
-from handlers.admin_handler import handle_admin_get_request, handle_admin_post_request
+from db.session_tokens import is_signed_token, verify_signed_token
+from handlers.base_handler import BaseRequestHandler, DateTimeEncoder
+from handlers.admin_handler import (handle_admin_get_request, handle_admin_post_request, request_budget,
+                                    request_priority, RATE_LIMITS)
+from services.invalidation import start_bus
+from services.warmup import start_warm_up
 
 # Define server constants
 ADMIN_PORT = 8001
@@ -18,57 +20,63 @@ STATIC_DIR = "static"
 UPLOADS_DIR = os.path.join(STATIC_DIR, "uploads")
 
 
-class DateTimeEncoder(json.JSONEncoder):
-    """Custom JSON encoder to handle datetime objects."""
-    def default(self, obj):
-        if isinstance(obj, (datetime.datetime, datetime.date)):
-            return obj.isoformat()
-        return super(DateTimeEncoder, self).default(obj)
-
-class AdminHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+class AdminHTTPRequestHandler(BaseRequestHandler):
     """
     Handles HTTP requests by dispatching them to the appropriate
     functions in the admin_handler module.
     """
 
-    def _send_response(self, status_code, data, content_type='application/json'):
-        """Helper to send a standardized HTTP response."""
-        self.send_response(status_code)
-        self.send_header('Content-type', content_type)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        if data is not None:
-            response_data = json.dumps(data, cls=DateTimeEncoder).encode('utf-8')
-            self.wfile.write(response_data)
+    rate_limits = RATE_LIMITS
+    request_priority = staticmethod(request_priority)
+    request_budget = staticmethod(request_budget)
+
+    def _send_export_stream(self, stream, export_format, filename, extra_headers=None):
+        """
+        Sends a RowStream as a downloadable NDJSON or CSV file, batch by batch, so
+        memory use stays the same however many rows there are.
+        """
+        if export_format == 'csv':
+            content_type, pieces = 'text/csv; charset=utf-8', stream.iter_csv()
+        else:
+            content_type, pieces = 'application/x-ndjson', stream.iter_ndjson(DateTimeEncoder())
+        headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+        headers.update(extra_headers or {})
+        try:
+            self._send_chunks(200, content_type, pieces, headers)
+        finally:
+            stream.close()
 
     def _get_auth_admin(self):
         """Validates the token and returns the authenticated admin."""
-        auth_header = self.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            # Use the refactored database query function
-            return get_entity_by_token(token, 'admin')
-        return None
-
-    def do_OPTIONS(self):
-        """Handle pre-flight CORS requests."""
-        self.send_response(204)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-        self.end_headers()
+        token = self._get_auth_token()
+        if not token:
+            return None
+        if is_signed_token(token):
+            # Signed tokens are checked in memory, without a database lookup
+            return verify_signed_token(token, 'admin')
+        # Use the refactored database query function
+        return get_entity_by_token(token, 'admin')
 
     def do_GET(self):
         """Dispatches GET requests to the admin handler."""
-        handle_admin_get_request(self)
+        self._dispatch(handle_admin_get_request)
 
     def do_POST(self):
         """Dispatches POST requests to the admin handler."""
-        handle_admin_post_request(self)
+        self._dispatch(handle_admin_post_request)
+
+class AdminServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """TCPServer that handles each connection on its own thread (see services/admission.py)."""
+
+    daemon_threads = True
 
 # --- Main Execution Block ---
 if __name__ == "__main__":
-    with socketserver.TCPServer(("", ADMIN_PORT), AdminHTTPRequestHandler) as httpd:
+    # Tell the main servers about the changes made here
+    start_bus()
+    start_replica_health_checks()
+    start_warm_up([('database', warm_pools)])
+    with AdminServer(("", ADMIN_PORT), AdminHTTPRequestHandler) as httpd:
         print(f"Admin server running at http://localhost:{ADMIN_PORT}")
         try:
             httpd.serve_forever()
@@ -0,0 +1,69 @@
+# benchmarks/bench_fuzzy.py
+# Latency benchmark for the typo-tolerant search index in services/search.py.
+#
+# Builds an index over generated titles (English words mixed with transliterated
+# Bengali ones, as in the real catalog), then times misspelled and partly typed
+# queries. The target is under 5 ms per query at 100k titles.
+#
+# Usage: python -m benchmarks.bench_fuzzy [number_of_titles]
+
+import random
+import sys
+import time
+from services.search import FuzzyIndex
+
+WORDS = """bangladesh bank job exam preparation guide mastering introduction essential skills
+bcs preliminary written viva recruitment government non cadre ntrca teacher registration primary
+school general knowledge language literature mathematics english bangla grammar science history
+geography computer information technology model test question solution analysis current affairs
+international economics accounting finance management marketing physics chemistry biology
+shongbidhan muktijuddho shadhinota sahitya byakaron ganit bigyan itihas bhugol prosno uttor
+sohayika digest sheet suggestion complete book series edition volume practice""".split()
+
+FIRST_NAMES = "rahim karim abdul mohammad nazrul rabindranath humayun jafar selina tahmima anisul".split()
+LAST_NAMES = "ahmed hossain islam rahman chowdhury uddin khan sarkar tagore haque alam".split()
+PUBLISHERS = "prothoma anupam ananya oriental professors panjeree lecture ajkal bhumika somoy".split()
+
+QUERIES = [
+    "Bangladsh bank", "bangladesh bnak job", "Mastring bank exam", "preliminery", "goverment job",
+    "shongbidan", "muktijudho itihash", "rabindranth tagor", "humayn ahmed", "panjere",
+    "profesors", "bcs prelim", "bangl", "introdction to esential", "ntrca techer",
+]
+
+def build(count):
+    """Builds an index over `count` generated books."""
+    random.seed(7)
+    index = FuzzyIndex()
+    for book_id in range(count):
+        title = ' '.join(random.choice(WORDS) for _ in range(random.randint(2, 6)))
+        # Some made-up words so the vocabulary grows with the catalog, like real titles
+        title += f" vol{book_id % 997}" if book_id % 3 == 0 else ''
+        author = f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}"
+        publisher_id = random.randrange(len(PUBLISHERS))
+        index.put(book_id, title.title(), author.title(), publisher_id,
+                  PUBLISHERS[publisher_id].title() + " Publications")
+    return index
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    began = time.perf_counter()
+    index = build(count)
+    print(f"built index over {count} titles ({len(index.postings)} distinct words) "
+          f"in {time.perf_counter() - began:.1f}s")
+
+    timings = []
+    for _ in range(5):
+        for query in QUERIES:
+            began = time.perf_counter()
+            result = index.search(query, limit=10)
+            timings.append((time.perf_counter() - began) * 1000)
+    timings.sort()
+    print(f"queries: {len(timings)}  p50 {timings[len(timings) // 2]:.2f} ms  "
+          f"p95 {timings[int(len(timings) * 0.95)]:.2f} ms  max {timings[-1]:.2f} ms")
+
+    for query in QUERIES[:5]:
+        result = index.search(query, limit=3)
+        print(f"  {query!r:28} -> {[b['name'] for b in result['books']]}")
+
+if __name__ == "__main__":
+    main()
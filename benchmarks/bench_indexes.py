@@ -0,0 +1,133 @@
+# benchmarks/bench_indexes.py
+# Before/after benchmark for the index migrations in db/migrations.
+#
+# It builds a local SQLite stand-in of the schema in database.sql, fills it with
+# generated rows, times the hot lookups from the db package, then applies the
+# migration files and times them again.
+#
+# Usage: python -m benchmarks.bench_indexes [scale]
+
+import datetime
+import random
+import sqlite3
+import sys
+import time
+from db.migrate import list_migrations, read_statements
+
+# SQLite version of database.sql. The UNIQUE constraints are kept because they
+# create indexes of their own, which is the "before" state we compare against.
+SCHEMA = """
+CREATE TABLE users (user_id INTEGER PRIMARY KEY, name TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
+                    phone TEXT, password TEXT NOT NULL, session_token TEXT, token_expiry TIMESTAMP);
+CREATE TABLE publishers (publisher_id INTEGER PRIMARY KEY, name TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
+                         phone TEXT, address TEXT, description TEXT, image_path TEXT,
+                         password TEXT NOT NULL, session_token TEXT, token_expiry TIMESTAMP);
+CREATE TABLE admins (admin_id INTEGER PRIMARY KEY, name TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
+                     password TEXT NOT NULL, session_token TEXT, token_expiry TIMESTAMP);
+CREATE TABLE categories (category_id INTEGER PRIMARY KEY, category_name TEXT UNIQUE NOT NULL);
+CREATE TABLE books (book_id INTEGER PRIMARY KEY, name TEXT NOT NULL, author_name TEXT, description TEXT,
+                    cover_path TEXT, pdf_path TEXT, publisher_id INTEGER, category_id INTEGER);
+CREATE TABLE reading_history (history_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+                              book_id INTEGER NOT NULL, last_read_timestamp TIMESTAMP,
+                              UNIQUE (user_id, book_id));
+"""
+
+# The hot lookups, written in SQLite syntax. Each entry is (label, sql, make_params).
+QUERIES = [
+    ("token lookup (users)",
+     "SELECT * FROM users WHERE session_token = ? AND token_expiry > ?",
+     lambda n: (f"token{random.randrange(n['users'])}", "2000-01-01")),
+    ("books by category",
+     """SELECT b.book_id, b.name, p.name FROM books b
+        JOIN publishers p ON b.publisher_id = p.publisher_id
+        LEFT JOIN categories c ON b.category_id = c.category_id
+        WHERE b.category_id = ?""",
+     lambda n: (random.randrange(n['categories']),)),
+    ("books by publisher",
+     """SELECT b.*, p.name FROM books b
+        JOIN publishers p ON b.publisher_id = p.publisher_id
+        WHERE b.publisher_id = ? ORDER BY b.name""",
+     lambda n: (random.randrange(n['publishers']),)),
+    ("reading history (latest 10)",
+     """SELECT b.book_id, b.name, rh.last_read_timestamp FROM books b
+        JOIN reading_history rh ON b.book_id = rh.book_id
+        WHERE rh.user_id = ? ORDER BY rh.last_read_timestamp DESC LIMIT 10""",
+     lambda n: (random.randrange(n['users']),)),
+    ("login (email + password)",
+     "SELECT user_id, name, email FROM users WHERE email = ? AND password = ?",
+     lambda n: (f"user{random.randrange(n['users'])}@example.com", "secret")),
+]
+
+def build_database(scale):
+    """Creates the in-memory stand-in database and fills it with generated rows."""
+    sizes = {
+        'users': 20000 * scale,
+        'publishers': 500 * scale,
+        'categories': 20,
+        'books': 20000 * scale,
+        'history': 100000 * scale,
+    }
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(SCHEMA)
+    start = datetime.datetime(2025, 1, 1)
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ((i, f"User {i}", f"user{i}@example.com", None, "secret", f"token{i}", "2030-01-01")
+                      for i in range(sizes['users'])))
+    conn.executemany("INSERT INTO publishers (publisher_id, name, email, password) VALUES (?, ?, ?, ?)",
+                     ((i, f"Publisher {i}", f"pub{i}@example.com", "secret") for i in range(sizes['publishers'])))
+    conn.executemany("INSERT INTO categories VALUES (?, ?)",
+                     ((i, f"Category {i}") for i in range(sizes['categories'])))
+    conn.executemany("INSERT INTO books (book_id, name, author_name, publisher_id, category_id) VALUES (?, ?, ?, ?, ?)",
+                     ((i, f"Book {i}", f"Author {i % 997}", random.randrange(sizes['publishers']),
+                       random.randrange(sizes['categories'])) for i in range(sizes['books'])))
+    conn.executemany("INSERT OR IGNORE INTO reading_history (user_id, book_id, last_read_timestamp) VALUES (?, ?, ?)",
+                     ((random.randrange(sizes['users']), random.randrange(sizes['books']),
+                       (start + datetime.timedelta(minutes=i)).isoformat()) for i in range(sizes['history'])))
+    conn.commit()
+    return conn, sizes
+
+def time_queries(conn, sizes, repeat=200):
+    """Runs every hot query `repeat` times and returns the average milliseconds per call."""
+    results = {}
+    for label, sql, make_params in QUERIES:
+        random.seed(label)
+        params = [make_params(sizes) for _ in range(repeat)]
+        began = time.perf_counter()
+        for p in params:
+            conn.execute(sql, p).fetchall()
+        results[label] = (time.perf_counter() - began) * 1000 / repeat
+    return results
+
+def apply_migrations(conn):
+    """
+    Applies the index statements of every migration file to the stand-in
+    database. Other statements (new tables, ALTER TABLE) use Oracle-only syntax
+    and do not change the timed lookups, so they are skipped, as are indexes on
+    tables or columns the stand-in does not have.
+    """
+    for version, name, path in list_migrations():
+        for statement in read_statements(path):
+            words = statement.split()
+            if [word.upper() for word in words[:2]] not in (['CREATE', 'INDEX'], ['CREATE', 'UNIQUE']):
+                continue
+            try:
+                conn.execute(statement)
+            except sqlite3.OperationalError as e:
+                print(f"Skipping {words[2] if words[1].upper() == 'INDEX' else words[3]} from {name}: {e}")
+    conn.commit()
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    random.seed(42)
+    conn, sizes = build_database(scale)
+    before = time_queries(conn, sizes)
+    apply_migrations(conn)
+    after = time_queries(conn, sizes)
+
+    print(f"{'query':32} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for label in before:
+        speedup = before[label] / after[label] if after[label] else float('inf')
+        print(f"{label:32} {before[label]:10.3f} {after[label]:10.3f} {speedup:7.1f}x")
+
+if __name__ == "__main__":
+    main()
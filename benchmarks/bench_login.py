@@ -0,0 +1,84 @@
+# benchmarks/bench_login.py
+# Measures /api/login latency against a running server.py at a given concurrency.
+#
+# Each worker thread logs in over and over with the same account, like a burst of
+# users signing in after a deploy. Every worker comes from this machine's address,
+# and /api/login allows one try every five seconds per address, so start the
+# server with that limit raised for the run (see RATE_LIMITS in
+# services/admission.py), then run e.g.:
+#   RATE_LIMITS="/api/login=1000:1000" python server.py
+#   python -m benchmarks.bench_login --email reader@example.com --password secret
+#   python -m benchmarks.bench_login --email pub@example.com --password secret --concurrency 32
+
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+
+def login_worker(host, port, body, count, latencies, failures, limited):
+    """
+    Sends `count` login requests one after another and records each latency.
+    Logins refused with 429 Too Many Requests are counted in `limited`.
+    """
+    for _ in range(count):
+        began = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            conn.request('POST', '/api/login', body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            ok = response.status == 200
+            if response.status == 429:
+                limited.append(1)
+        except OSError:
+            ok = False
+        elapsed = (time.perf_counter() - began) * 1000
+        if ok:
+            latencies.append(elapsed)
+        else:
+            failures.append(elapsed)
+
+def percentile(sorted_values, fraction):
+    """Returns the value at the given fraction (0..1) of a sorted list."""
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /api/login latency.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--concurrency', type=int, default=16, help="number of parallel clients")
+    parser.add_argument('--requests', type=int, default=50, help="logins per client")
+    args = parser.parse_args()
+
+    body = json.dumps({'email': args.email, 'password': args.password})
+    latencies, failures, limited = [], [], []
+    threads = [threading.Thread(target=login_worker,
+                                args=(args.host, args.port, body, args.requests, latencies, failures, limited))
+               for _ in range(args.concurrency)]
+    began = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - began
+
+    if limited:
+        print(f"{len(limited)} logins were rate limited (429). Start the server with "
+              f"RATE_LIMITS=\"/api/login=1000:1000\" so the limit does not skew the results.")
+    if not latencies:
+        print(f"All {len(failures)} logins failed. Is the server running and are the credentials right?")
+        return
+    latencies.sort()
+    print(f"clients: {args.concurrency}  logins: {len(latencies)}  failed: {len(failures)}")
+    print(f"throughput: {len(latencies) / wall:.1f} logins/s")
+    print(f"latency ms  mean {statistics.mean(latencies):.1f}  p50 {percentile(latencies, 0.50):.1f}  "
+          f"p95 {percentile(latencies, 0.95):.1f}  p99 {percentile(latencies, 0.99):.1f}  max {latencies[-1]:.1f}")
+
+if __name__ == "__main__":
+    main()
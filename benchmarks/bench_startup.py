@@ -0,0 +1,114 @@
+# benchmarks/bench_startup.py
+# Measures how fast server.py starts: import time, time until it answers
+# /healthz, time until /readyz says it is warm, and the first requests after that.
+#
+# Starts its own server.py on a free port (the database must be reachable), so
+# no server should be needed beforehand. Run from the project root, e.g.:
+#   python -m benchmarks.bench_startup
+#   python -m benchmarks.bench_startup --imports 20 --top 15
+
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+def measure_import(runs):
+    """Returns the wall time in ms of `import server` in a fresh interpreter, once per run."""
+    times = []
+    for _ in range(runs):
+        began = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import server'], check=True)
+        times.append((time.perf_counter() - began) * 1000)
+    return times
+
+def slowest_imports(count):
+    """Returns the `count` modules with the highest cumulative import time, as (ms, name)."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import server'],
+                            capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        modules.append((int(parts[1]) / 1000, parts[2].rstrip()))
+    modules.sort(reverse=True)
+    return modules[:count]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def get(port, path):
+    """Returns (status, ms) for one GET, or (None, ms) if the server did not answer."""
+    began = time.perf_counter()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        status = response.status
+    except OSError:
+        status = None
+    return status, (time.perf_counter() - began) * 1000
+
+def measure_boot(timeout):
+    """Starts server.py and returns the timings of its start, in ms."""
+    port = free_port()
+    env = dict(os.environ, PORT=str(port))
+    began = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'server.py'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    timings = {}
+    try:
+        deadline = began + timeout
+        while time.perf_counter() < deadline:
+            if 'healthz' not in timings:
+                if get(port, '/healthz')[0] == 200:
+                    timings['healthz'] = (time.perf_counter() - began) * 1000
+            elif get(port, '/readyz')[0] == 200:
+                timings['readyz'] = (time.perf_counter() - began) * 1000
+                break
+            time.sleep(0.01)
+        if 'readyz' in timings:
+            # What the first users after a deploy see
+            for path in ('/api/categories', '/api/books', '/static/js/main.js'):
+                timings[path] = get(port, path)[1]
+    finally:
+        process.terminate()
+        process.wait()
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server.py start-up.")
+    parser.add_argument('--imports', type=int, default=10, help="fresh interpreters to time `import server` in")
+    parser.add_argument('--top', type=int, default=10, help="slowest imports to list")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait for /readyz")
+    args = parser.parse_args()
+
+    times = sorted(measure_import(args.imports))
+    print(f"import server (incl. interpreter start)  median {statistics.median(times):.1f} ms  "
+          f"min {times[0]:.1f} ms  max {times[-1]:.1f} ms")
+    print("slowest imports (cumulative ms):")
+    for ms, name in slowest_imports(args.top):
+        print(f"  {ms:8.1f}  {name}")
+
+    timings = measure_boot(args.timeout)
+    if 'healthz' not in timings:
+        print("The server never answered /healthz. Does server.py start on its own?")
+        return
+    print(f"first /healthz answer  {timings['healthz']:.0f} ms")
+    if 'readyz' not in timings:
+        print(f"/readyz was not ready within {args.timeout:.0f} s. Is the database reachable?")
+        return
+    print(f"/readyz ready          {timings['readyz']:.0f} ms")
+    for path in ('/api/categories', '/api/books', '/static/js/main.js'):
+        print(f"first {path:<20} {timings[path]:.1f} ms")
+
+if __name__ == "__main__":
+    main()
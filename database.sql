@@ -100,3 +100,7 @@ CREATE TABLE reading_history (
 
 INSERT INTO admins (name, email, password)
 VALUES ('admin', 'admin@emailcom', 'admin');
+
+
+-- Secondary indexes are managed as numbered migrations in db/migrations.
+-- Apply them (and record the applied versions) with: python -m db.migrate
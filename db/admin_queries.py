@@ -3,12 +3,14 @@
 
 import cx_Oracle
 import datetime
-from db.connection import get_db_connection, _fetch_as_dict
+from db.connection import get_db_connection, _fetch_as_dict, _fetch_compact, _tune_cursor, _open_row_stream, READ, WRITE, PRIMARY
+from db.versions import CATALOG, bump
+from db.change_events import emit
 from db.user_queries import set_session_token
 
 def verify_admin_login(email, password):
     """Verifies admin credentials and returns admin data with a new session token."""
-    conn = get_db_connection()
+    conn = get_db_connection(PRIMARY)
     if not conn:
         return None
     try:
@@ -34,33 +36,35 @@ def verify_admin_login(email, password):
         if conn:
             conn.close()
 
+# SQL query to get all users and their active subscriptions
+_ALL_USERS_SQL = """
+    SELECT
+        u.user_id,
+        u.name,
+        u.email,
+        u.phone,
+        (
+            SELECT LISTAGG(c.category_name, ', ') WITHIN GROUP (ORDER BY c.category_name)
+            FROM user_subscriptions us
+            JOIN categories c ON us.category_id = c.category_id
+            WHERE us.user_id = u.user_id AND us.expiry_date >= :today
+        ) as active_subscriptions
+    FROM users u
+    ORDER BY u.user_id
+"""
+
 def get_all_users_for_admin():
     """
     Gets all users and a list of their active subscriptions for the admin panel.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return []
     try:
         with conn.cursor() as cursor:
-            # SQL query to get all users and their active subscriptions
-            sql = """
-                SELECT
-                    u.user_id,
-                    u.name,
-                    u.email,
-                    u.phone,
-                    (
-                        SELECT LISTAGG(c.category_name, ', ') WITHIN GROUP (ORDER BY c.category_name)
-                        FROM user_subscriptions us
-                        JOIN categories c ON us.category_id = c.category_id
-                        WHERE us.user_id = u.user_id AND us.expiry_date >= :today
-                    ) as active_subscriptions
-                FROM users u
-                ORDER BY u.user_id
-            """
-            cursor.execute(sql, today=datetime.date.today())
-            return _fetch_as_dict(cursor)
+            _tune_cursor(cursor)
+            cursor.execute(_ALL_USERS_SQL, today=datetime.date.today())
+            return _fetch_compact(cursor)
     except cx_Oracle.Error as e:
         print(f"Database error in get_all_users_for_admin: {e}")
         return []
@@ -68,12 +72,16 @@ def get_all_users_for_admin():
         if conn:
             conn.close()
 
+def stream_all_users_for_admin():
+    """Returns a RowStream over all users for a streaming admin listing, or None on failure."""
+    return _open_row_stream(_ALL_USERS_SQL, {'today': datetime.date.today()})
+
 def delete_user_by_admin(user_id):
     """
     Deletes a user and their associated data (subscriptions, bookmarks, history)
     from the admin panel.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -93,17 +101,19 @@ def delete_user_by_admin(user_id):
         if conn:
             conn.close()
 
+# SQL query to get all publishers
+_ALL_PUBLISHERS_SQL = "SELECT publisher_id, name, email, phone, address, image_path FROM publishers ORDER BY publisher_id"
+
 def get_all_publishers_for_admin():
     """Gets all publishers for the admin panel."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return []
     try:
         with conn.cursor() as cursor:
-            # SQL query to get all publishers
-            sql = "SELECT publisher_id, name, email, phone, address, image_path FROM publishers ORDER BY publisher_id"
-            cursor.execute(sql)
-            return _fetch_as_dict(cursor)
+            _tune_cursor(cursor)
+            cursor.execute(_ALL_PUBLISHERS_SQL)
+            return _fetch_compact(cursor)
     except cx_Oracle.Error as e:
         print(f"Database error in get_all_publishers_for_admin: {e}")
         return []
@@ -111,12 +121,16 @@ def get_all_publishers_for_admin():
         if conn:
             conn.close()
 
+def stream_all_publishers_for_admin():
+    """Returns a RowStream over all publishers for a streaming admin listing, or None on failure."""
+    return _open_row_stream(_ALL_PUBLISHERS_SQL, {})
+
 def delete_publisher_by_admin(publisher_id):
     """
     Deletes a publisher and all of their associated books and files.
     Returns a dictionary of file paths to be deleted from the server.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return None
 
@@ -131,16 +145,21 @@ def delete_publisher_by_admin(publisher_id):
                 files_to_delete['publisher_images'].append(pub_image[0])
 
             # Get the paths of all book covers and PDFs associated with the publisher
-            cursor.execute("SELECT cover_path, pdf_path FROM books WHERE publisher_id = :id", id=publisher_id)
+            cursor.execute("SELECT cover_path, pdf_path, book_id FROM books WHERE publisher_id = :id", id=publisher_id)
+            book_ids = []
             for row in cursor.fetchall():
                 if row[0]: files_to_delete['covers'].append(row[0])
                 if row[1]: files_to_delete['pdfs'].append(row[1])
+                book_ids.append(int(row[2]))
 
             # Delete all books by the publisher, then delete the publisher
             cursor.execute("DELETE FROM books WHERE publisher_id = :id", id=publisher_id)
             cursor.execute("DELETE FROM publishers WHERE publisher_id = :id", id=publisher_id)
 
             conn.commit()
+            bump(CATALOG)
+            for book_id in book_ids:
+                emit('book-deleted', {'book_id': book_id})
             return files_to_delete
     except cx_Oracle.Error as e:
         print(f"Database error in delete_publisher_by_admin: {e}")
@@ -152,7 +171,7 @@ def delete_publisher_by_admin(publisher_id):
 
 def get_user_by_id_for_admin(user_id):
     """Fetches a single user's details for editing in the admin panel."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return None
     try:
@@ -171,13 +190,13 @@ def get_user_by_id_for_admin(user_id):
 
 def update_user_by_admin(user_id, name, phone):
     """Updates a user's details from the admin panel."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
         with conn.cursor() as cursor:
             # SQL statement to update user's name and phone
-            sql = "UPDATE users SET name = :name, phone = :phone WHERE user_id = :id"
+            sql = "UPDATE users SET name = :name, phone = :phone, updated_at = SYSTIMESTAMP WHERE user_id = :id"
             cursor.execute(sql, name=name, phone=phone, id=user_id)
             conn.commit()
             return cursor.rowcount > 0
@@ -190,7 +209,7 @@ def update_user_by_admin(user_id, name, phone):
 
 def get_publisher_by_id_for_admin(publisher_id):
     """Fetches a single publisher's details for editing in the admin panel."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return None
     try:
@@ -209,17 +228,22 @@ def get_publisher_by_id_for_admin(publisher_id):
 
 def update_publisher_by_admin(pub_id, name, phone, address, description):
     """Updates a publisher's details from the admin panel."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
         with conn.cursor() as cursor:
             # SQL statement to update publisher details
-            sql = """UPDATE publishers SET name = :name, phone = :phone, address = :address, description = :desc
+            sql = """UPDATE publishers SET name = :name, phone = :phone, address = :address, description = :desc,
+                     updated_at = SYSTIMESTAMP
                      WHERE publisher_id = :id"""
             cursor.execute(sql, name=name, phone=phone, address=address, desc=description, id=pub_id)
             conn.commit()
-            return cursor.rowcount > 0
+            bump(CATALOG)
+            updated = cursor.rowcount > 0
+            if updated:
+                emit('publisher-updated', {'publisher_id': int(pub_id)})
+            return updated
     except cx_Oracle.Error as e:
         print(f"Database error in update_publisher_by_admin: {e}")
         return False
@@ -1,25 +1,39 @@
 # db/book_queries.py
 # Contains all database operations related to books.
 
+import datetime
 import cx_Oracle
-from db.connection import get_db_connection, _fetch_as_dict
+from db.connection import get_db_connection, _fetch_as_dict, _fetch_compact, _tune_cursor, _open_row_stream, READ, WRITE, PRIMARY
+from db.versions import CATALOG, bump
+from db.change_events import emit
+
+MAX_PATHS_PER_QUERY = 500
 
 def add_book(name, author, desc, category_id, cover_path, pdf_path, pub_id):
-    """Adds a new book to the database, linking it to a category and publisher."""
-    conn = get_db_connection()
+    """
+    Adds a new book to the database, linking it to a category and publisher.
+    Returns the new book's ID.
+    """
+    conn = get_db_connection(WRITE)
     if not conn:
         return None
     try:
         with conn.cursor() as cursor:
-            # SQL statement to insert a new book
+            # SQL statement to insert a new book and hand back its generated ID
             sql = """
                 INSERT INTO books (name, author_name, description, category_id, cover_path, pdf_path, publisher_id)
                 VALUES (:name, :author, :desc_val, :cat_id, :cover, :pdf, :pub_id)
+                RETURNING book_id INTO :new_id
             """
+            new_id = cursor.var(cx_Oracle.NUMBER)
             cursor.execute(sql, name=name, author=author, desc_val=desc, cat_id=category_id,
-                           cover=cover_path, pdf=pdf_path, pub_id=pub_id)
+                           cover=cover_path, pdf=pdf_path, pub_id=pub_id, new_id=new_id)
             conn.commit()
-            return True
+            bump(CATALOG)
+            book_id = int(new_id.getvalue()[0])
+            emit('book-added', {'book_id': book_id, 'name': name, 'author_name': author,
+                                'category_id': category_id, 'publisher_id': pub_id})
+            return book_id
     except cx_Oracle.Error as e:
         print(f"Database error in add_book: {e}")
         return False
@@ -27,9 +41,59 @@ def add_book(name, author, desc, category_id, cover_path, pdf_path, pub_id):
         if conn:
             conn.close()
 
+def add_books_bulk(books, pub_id):
+    """
+    Inserts many books for one publisher with a single executemany call.
+    `books` is a list of dictionaries with name, author_name, description,
+    category_id, cover_path and pdf_path. A row that fails (for example an unknown
+    category) is skipped without undoing the others.
+    Returns a (new book_id or None, error message or None) pair per row, in
+    order, or None if the whole batch failed.
+    """
+    if not books:
+        return []
+    conn = get_db_connection(WRITE)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            # SQL statement to insert one book per bound row and hand back each new ID
+            sql = """
+                INSERT INTO books (name, author_name, description, category_id, cover_path, pdf_path, publisher_id)
+                VALUES (:name, :author, :desc_val, :cat_id, :cover, :pdf, :pub_id)
+                RETURNING book_id INTO :new_id
+            """
+            new_id = cursor.var(cx_Oracle.NUMBER, arraysize=len(books))
+            cursor.setinputsizes(new_id=new_id)
+            rows = [{'name': book['name'], 'author': book['author_name'], 'desc_val': book['description'],
+                     'cat_id': book['category_id'], 'cover': book['cover_path'], 'pdf': book['pdf_path'],
+                     'pub_id': pub_id}
+                    for book in books]
+            cursor.executemany(sql, rows, batcherrors=True)
+            errors = {error.offset: error.message for error in cursor.getbatcherrors()}
+            conn.commit()
+            bump(CATALOG)
+            results = []
+            for i in range(len(books)):
+                if i in errors:
+                    results.append((None, errors[i]))
+                else:
+                    results.append((int(new_id.getvalue(i)[0]), None))
+                    emit('book-added', {'book_id': results[-1][0], 'name': books[i]['name'],
+                                        'author_name': books[i]['author_name'],
+                                        'category_id': books[i]['category_id'], 'publisher_id': pub_id})
+            return results
+    except cx_Oracle.Error as e:
+        print(f"Database error in add_books_bulk: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
 def update_book(book_id, name, author, desc, category_id, cover_path):
     """Updates an existing book's details in the database."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -41,13 +105,19 @@ def update_book(book_id, name, author, desc, category_id, cover_path):
                     author_name = :author,
                     description = :desc_val,
                     category_id = :cat_id,
-                    cover_path = :cover
+                    cover_path = :cover,
+                    updated_at = SYSTIMESTAMP
                 WHERE book_id = :book_id
             """
             cursor.execute(sql, name=name, author=author, desc_val=desc, cat_id=category_id,
                            cover=cover_path, book_id=book_id)
             conn.commit()
-            return cursor.rowcount > 0
+            bump(CATALOG)
+            updated = cursor.rowcount > 0
+            if updated:
+                emit('book-updated', {'book_id': int(book_id), 'name': name, 'author_name': author,
+                                      'category_id': category_id})
+            return updated
     except cx_Oracle.Error as e:
         print(f"Database error in update_book: {e}")
         return False
@@ -55,49 +125,52 @@ def update_book(book_id, name, author, desc, category_id, cover_path):
         if conn:
             conn.close()
 
+def _build_books_query(search_term="", category_id=None):
+    """Builds the catalog query and its bind parameters for the given filters."""
+    # Base SQL query to select books and join with publishers and categories
+    base_sql = """
+        SELECT b.book_id, b.name, b.author_name, b.description, b.cover_path,
+               b.publisher_id, b.category_id, p.name as publisher_name, c.category_name
+        FROM books b
+        JOIN publishers p ON b.publisher_id = p.publisher_id
+        LEFT JOIN categories c ON b.category_id = c.category_id
+    """
+
+    where_clauses = []
+    params = {}
+
+    # Add a search filter if a search term is provided
+    if search_term:
+        where_clauses.append("(UPPER(b.name) LIKE :term OR UPPER(b.author_name) LIKE :term OR UPPER(c.category_name) LIKE :term)")
+        params['term'] = f"%{search_term.upper()}%"
+
+    # Add a category filter if a category ID is provided
+    try:
+        if category_id and int(category_id) > 0:
+            where_clauses.append("b.category_id = :cat_id")
+            params['cat_id'] = int(category_id)
+    except (ValueError, TypeError):
+        pass  # Ignore invalid category IDs
+
+    # Combine the base query with any filters
+    if where_clauses:
+        return base_sql + " WHERE " + " AND ".join(where_clauses), params
+    return base_sql, params
+
 def get_all_books(search_term="", category_id=None):
     """
     Gets all books, with optional search and category filters.
     The pdf_path is excluded for security reasons.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return []
     try:
         with conn.cursor() as cursor:
-            # Base SQL query to select books and join with publishers and categories
-            base_sql = """
-                SELECT b.book_id, b.name, b.author_name, b.description, b.cover_path,
-                       b.publisher_id, b.category_id, p.name as publisher_name, c.category_name
-                FROM books b
-                JOIN publishers p ON b.publisher_id = p.publisher_id
-                LEFT JOIN categories c ON b.category_id = c.category_id
-            """
-
-            where_clauses = []
-            params = {}
-
-            # Add a search filter if a search term is provided
-            if search_term:
-                where_clauses.append("(UPPER(b.name) LIKE :term OR UPPER(b.author_name) LIKE :term OR UPPER(c.category_name) LIKE :term)")
-                params['term'] = f"%{search_term.upper()}%"
-
-            # Add a category filter if a category ID is provided
-            try:
-                if category_id and int(category_id) > 0:
-                    where_clauses.append("b.category_id = :cat_id")
-                    params['cat_id'] = int(category_id)
-            except (ValueError, TypeError):
-                pass  # Ignore invalid category IDs
-
-            # Combine the base query with any filters
-            if where_clauses:
-                sql = base_sql + " WHERE " + " AND ".join(where_clauses)
-            else:
-                sql = base_sql
-
+            _tune_cursor(cursor)
+            sql, params = _build_books_query(search_term, category_id)
             cursor.execute(sql, params)
-            return _fetch_as_dict(cursor)
+            return _fetch_compact(cursor)
     except cx_Oracle.Error as e:
         print(f"Database error in get_all_books: {e}")
         return []
@@ -105,9 +178,17 @@ def get_all_books(search_term="", category_id=None):
         if conn:
             conn.close()
 
+def stream_all_books(search_term="", category_id=None):
+    """
+    Same as get_all_books, but returns a RowStream that pulls the rows in batches
+    for a streaming response. Returns None if the query could not be started.
+    """
+    sql, params = _build_books_query(search_term, category_id)
+    return _open_row_stream(sql, params)
+
 def delete_book(book_id):
     """Deletes a book from the database and returns the paths of its associated files."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -118,6 +199,9 @@ def delete_book(book_id):
             # Then, delete the book record
             cursor.execute("DELETE FROM books WHERE book_id = :id", id=book_id)
             conn.commit()
+            bump(CATALOG)
+            if paths:
+                emit('book-deleted', {'book_id': int(book_id)})
             return paths[0] if paths else None
     except cx_Oracle.Error as e:
         print(f"Database error in delete_book: {e}")
@@ -128,11 +212,12 @@ def delete_book(book_id):
 
 def get_books_by_publisher(publisher_id):
     """Gets all books published by a specific publisher."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return []
     try:
         with conn.cursor() as cursor:
+            _tune_cursor(cursor)
             # SQL query to get all books for a given publisher
             sql = """
                 SELECT b.*, p.name as publisher_name, c.category_name
@@ -142,7 +227,7 @@ def get_books_by_publisher(publisher_id):
                 WHERE b.publisher_id = :id ORDER BY b.name
             """
             cursor.execute(sql, id=publisher_id)
-            return _fetch_as_dict(cursor)
+            return _fetch_compact(cursor)
     except cx_Oracle.Error as e:
         print(f"Database error in get_books_by_publisher: {e}")
         return []
@@ -155,7 +240,7 @@ def get_book_pdf_path(book_id):
     Securely retrieves just the PDF path for a given book.
     This is intended for use by the protected download endpoint.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return None
     try:
@@ -170,3 +255,203 @@ def get_book_pdf_path(book_id):
     finally:
         if conn:
             conn.close()
+
+def get_pdf_access(user_id, book_id):
+    """
+    Checks in one query whether a user may read a book and where its PDF is.
+    Returns (pdf_path, is_subscribed), or None if the book does not exist.
+    """
+    conn = get_db_connection(READ)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            # SQL query to get the PDF path and whether the user has an active
+            # subscription for the book's category
+            sql = """
+                SELECT b.pdf_path,
+                       (SELECT COUNT(*) FROM user_subscriptions us
+                        WHERE us.user_id = :user_id
+                          AND us.category_id = b.category_id
+                          AND us.expiry_date >= :today) AS subscribed
+                FROM books b
+                WHERE b.book_id = :book_id
+            """
+            cursor.execute(sql, user_id=user_id, book_id=book_id, today=datetime.date.today())
+            result = cursor.fetchone()
+            return (result[0], result[1] > 0) if result else None
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_pdf_access: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_books_by_ids(book_ids):
+    """
+    Gets the public details of the given books, in the same order as book_ids.
+    Books that no longer exist are left out.
+    """
+    if not book_ids:
+        return []
+    conn = get_db_connection(READ)
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cursor:
+            # Build one bind variable per id (:id0, :id1, ...)
+            params = {f"id{i}": int(book_id) for i, book_id in enumerate(book_ids)}
+            sql = f"""
+                SELECT b.book_id, b.name, b.author_name, b.description, b.cover_path,
+                       b.publisher_id, b.category_id, p.name as publisher_name, c.category_name
+                FROM books b
+                JOIN publishers p ON b.publisher_id = p.publisher_id
+                LEFT JOIN categories c ON b.category_id = c.category_id
+                WHERE b.book_id IN ({', '.join(':' + name for name in params)})
+            """
+            cursor.execute(sql, params)
+            books = {book['book_id']: book for book in _fetch_as_dict(cursor)}
+            return [books[int(book_id)] for book_id in book_ids if int(book_id) in books]
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_books_by_ids: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def get_book_ids_changed_since(since, max_book_id):
+    """
+    Returns the ids of the books added after max_book_id or changed at or after
+    `since` (a datetime), or None if the query failed. Used to bring a catalog
+    snapshot up to date without reading every book.
+    """
+    conn = get_db_connection(READ)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            _tune_cursor(cursor)
+            # SQL query using the book_id key and the updated_at index (migration 006)
+            sql = "SELECT book_id FROM books WHERE book_id > :max_id OR updated_at >= :since"
+            cursor.execute(sql, max_id=int(max_book_id), since=since)
+            return [row[0] for row in cursor.fetchall()]
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_book_ids_changed_since: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_catalog_book_ids():
+    """
+    Returns the set of ids of the books the catalog lists (like get_all_books,
+    only books with a publisher), or None if the query failed. Comparing it with
+    a snapshot finds the books deleted since.
+    """
+    conn = get_db_connection(READ)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            _tune_cursor(cursor, arraysize=5000, prefetchrows=5001)
+            # SQL query reading only the ids, not the book rows
+            sql = "SELECT b.book_id FROM books b JOIN publishers p ON b.publisher_id = p.publisher_id"
+            cursor.execute(sql)
+            return {row[0] for row in cursor.fetchall()}
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_catalog_book_ids: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_book_pdf_paths():
+    """Returns (book_id, pdf_path) for every book that has a PDF."""
+    conn = get_db_connection(READ)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            _tune_cursor(cursor)
+            # SQL query to list the PDF of every book
+            cursor.execute("SELECT book_id, pdf_path FROM books WHERE pdf_path IS NOT NULL")
+            return [(int(book_id), pdf_path) for book_id, pdf_path in cursor.fetchall()]
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_book_pdf_paths: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_upload_paths_referenced(paths):
+    """
+    Returns the subset of the given upload paths that a book or publisher still
+    refers to. Returns None if the database could not be reached, or False if
+    the query failed. Read from the primary, so a path that was just used again
+    is never reported free by a lagging replica.
+    """
+    if not paths:
+        return set()
+    conn = get_db_connection(PRIMARY)
+    if not conn:
+        return None
+    try:
+        referenced = set()
+        with conn.cursor() as cursor:
+            # Oracle allows 1000 values in an IN list, so long lists are checked in parts
+            for start in range(0, len(paths), MAX_PATHS_PER_QUERY):
+                # Build one bind variable per path (:p0, :p1, ...)
+                params = {f"p{i}": path for i, path in enumerate(paths[start:start + MAX_PATHS_PER_QUERY])}
+                in_list = ', '.join(':' + name for name in params)
+                # SQL query to find which of the paths any row still stores
+                sql = f"""
+                    SELECT cover_path FROM books WHERE cover_path IN ({in_list})
+                    UNION
+                    SELECT pdf_path FROM books WHERE pdf_path IN ({in_list})
+                    UNION
+                    SELECT image_path FROM publishers WHERE image_path IN ({in_list})
+                """
+                cursor.execute(sql, params)
+                referenced.update(row[0] for row in cursor.fetchall())
+        return referenced
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_upload_paths_referenced: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def get_upload_paths_in_use():
+    """
+    Returns the set of every upload path the database still refers to: book
+    covers, book PDFs and publisher images. Returns None if the query fails part
+    way, so a caller never mistakes a partial list for the full one.
+    """
+    conn = get_db_connection(READ)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            _tune_cursor(cursor, arraysize=5000)
+            # SQL query to list every stored file path, whichever table it is in
+            sql = """
+                SELECT cover_path FROM books WHERE cover_path IS NOT NULL
+                UNION ALL
+                SELECT pdf_path FROM books WHERE pdf_path IS NOT NULL
+                UNION ALL
+                SELECT image_path FROM publishers WHERE image_path IS NOT NULL
+            """
+            cursor.execute(sql)
+            paths = set()
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                paths.update(row[0] for row in rows)
+            return paths
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_upload_paths_in_use: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
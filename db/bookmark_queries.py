@@ -3,15 +3,17 @@
 
 import cx_Oracle
 import datetime
-from db.connection import get_db_connection, _fetch_as_dict
+from db.connection import get_db_connection, _fetch_compact, _tune_cursor, _open_row_stream, READ, WRITE
+from db.versions import bump, bookmarks_stamp_name, history_stamp_name
 
 def get_user_bookmarks(user_id):
     """Retrieves all bookmarked books for a specific user."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return []
     try:
         with conn.cursor() as cursor:
+            _tune_cursor(cursor)
             # SQL query to get all books bookmarked by the user
             sql = """
                 SELECT b.book_id, b.name, b.author_name, b.description, b.cover_path,
@@ -23,7 +25,7 @@ def get_user_bookmarks(user_id):
                 WHERE bm.user_id = :user_id
             """
             cursor.execute(sql, user_id=user_id)
-            return _fetch_as_dict(cursor)
+            return _fetch_compact(cursor)
     except cx_Oracle.Error as e:
         print(f"Database error in get_user_bookmarks: {e}")
         return []
@@ -33,7 +35,7 @@ def get_user_bookmarks(user_id):
 
 def add_bookmark(user_id, book_id):
     """Adds a book to a user's bookmarks, avoiding duplicates."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -47,6 +49,7 @@ def add_bookmark(user_id, book_id):
             """
             cursor.execute(sql, user_id=user_id, book_id=book_id)
             conn.commit()
+            bump(bookmarks_stamp_name(user_id))
             return True
     except cx_Oracle.Error as e:
         print(f"Database error in add_bookmark: {e}")
@@ -57,7 +60,7 @@ def add_bookmark(user_id, book_id):
 
 def remove_bookmark(user_id, book_id):
     """Removes a book from a user's bookmarks."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -66,6 +69,7 @@ def remove_bookmark(user_id, book_id):
             sql = "DELETE FROM bookmarks WHERE user_id = :user_id AND book_id = :book_id"
             cursor.execute(sql, user_id=user_id, book_id=book_id)
             conn.commit()
+            bump(bookmarks_stamp_name(user_id))
             return cursor.rowcount > 0
     except cx_Oracle.Error as e:
         print(f"Database error in remove_bookmark: {e}")
@@ -76,11 +80,12 @@ def remove_bookmark(user_id, book_id):
 
 def get_reading_history(user_id, limit=10):
     """Gets the most recently read books for a user, up to a specified limit."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return []
     try:
         with conn.cursor() as cursor:
+            _tune_cursor(cursor)
             # SQL query to get the user's reading history, ordered by the last read timestamp
             sql = """
                 SELECT b.book_id, b.name, b.author_name, b.description, b.cover_path,
@@ -95,7 +100,7 @@ def get_reading_history(user_id, limit=10):
                 FETCH FIRST :limit ROWS ONLY
             """
             cursor.execute(sql, user_id=user_id, limit=limit)
-            return _fetch_as_dict(cursor)
+            return _fetch_compact(cursor)
     except cx_Oracle.Error as e:
         print(f"Database error in get_reading_history: {e}")
         return []
@@ -105,7 +110,7 @@ def get_reading_history(user_id, limit=10):
 
 def add_to_reading_history(user_id, book_id):
     """Adds or updates a book in the user's reading history."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -121,6 +126,7 @@ def add_to_reading_history(user_id, book_id):
             """
             cursor.execute(sql, user_id=user_id, book_id=book_id, current_time=datetime.datetime.now())
             conn.commit()
+            bump(history_stamp_name(user_id))
             return True
     except cx_Oracle.Error as e:
         print(f"Database error in add_to_reading_history: {e}")
@@ -128,3 +134,44 @@ def add_to_reading_history(user_id, book_id):
     finally:
         if conn:
             conn.close()
+
+def stream_user_book_interactions():
+    """
+    Returns a RowStream of (user_id, book_id) pairs for every book a user has read
+    or bookmarked, ordered by user. Used to build the recommendation model.
+    """
+    sql = """
+        SELECT user_id, book_id FROM reading_history
+        UNION
+        SELECT user_id, book_id FROM bookmarks
+        ORDER BY 1
+    """
+    return _open_row_stream(sql, {}, batch_size=5000)
+
+def get_user_book_interactions_since(since):
+    """
+    Returns the (user_id, book_id) pairs read or bookmarked at or after `since`
+    (a datetime), ordered by user, or None if the query failed. Used to bring a
+    recommendation model snapshot up to date.
+    """
+    conn = get_db_connection(READ)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            _tune_cursor(cursor)
+            # SQL query using the timestamp indexes (migration 006)
+            sql = """
+                SELECT user_id, book_id FROM reading_history WHERE last_read_timestamp >= :since
+                UNION
+                SELECT user_id, book_id FROM bookmarks WHERE created_at >= :since
+                ORDER BY 1
+            """
+            cursor.execute(sql, since=since)
+            return cursor.fetchall()
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_user_book_interactions_since: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
@@ -2,19 +2,22 @@
 # Contains all database operations related to book categories.
 
 import cx_Oracle
-from db.connection import get_db_connection, _fetch_as_dict
+from db.connection import get_db_connection, _fetch_compact, _tune_cursor, READ, WRITE
+from db.versions import CATALOG, bump
+from db.change_events import emit
 
 def get_all_categories():
     """Gets all book categories from the database, ordered by name."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return []
     try:
         with conn.cursor() as cursor:
+            _tune_cursor(cursor)
             # SQL query to select all categories
             sql = "SELECT category_id, category_name FROM categories ORDER BY category_name"
             cursor.execute(sql)
-            return _fetch_as_dict(cursor)
+            return _fetch_compact(cursor)
     except cx_Oracle.Error as e:
         print(f"Database error in get_all_categories: {e}")
         return []
@@ -24,7 +27,7 @@ def get_all_categories():
 
 def add_category(category_name):
     """Adds a new book category to the database."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -33,6 +36,8 @@ def add_category(category_name):
             sql = "INSERT INTO categories (category_name) VALUES (:name)"
             cursor.execute(sql, name=category_name)
             conn.commit()
+            bump(CATALOG)
+            emit('category-changed', {'action': 'added', 'category_name': category_name})
             return True
     except cx_Oracle.IntegrityError:
         # Handle cases where the category already exists
@@ -50,7 +55,7 @@ def delete_category(category_id):
     Deletes a category if it is not currently in use by any books.
     The ON DELETE CASCADE constraint handles associated user subscriptions.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -65,7 +70,11 @@ def delete_category(category_id):
             # If not in use, proceed with deletion
             cursor.execute("DELETE FROM categories WHERE category_id = :id", id=category_id)
             conn.commit()
-            return cursor.rowcount > 0
+            bump(CATALOG)
+            deleted = cursor.rowcount > 0
+            if deleted:
+                emit('category-changed', {'action': 'deleted', 'category_id': int(category_id)})
+            return deleted
     except cx_Oracle.Error as e:
         print(f"Database error in delete_category: {e}")
         return False
@@ -0,0 +1,77 @@
+# db/change_events.py
+# Small change events announced by the db write functions after they commit.
+#
+# An event is a dictionary: {'type': 'book-added', 'data': {...}, 'user_id': None}.
+# Events with a user_id are only meant for that user (their subscriptions
+# changed); the others go to everyone. The servers register listeners: the event
+# hub pushes events to the browsers connected to /api/events
+# (services/event_stream.py), and the invalidation bus (services/invalidation.py)
+# passes them on to the other server processes.
+#
+# A process without listeners (a script, say) writes its events to SPOOL_DIR,
+# one small file per event, and a main server picks them up from there. Like the
+# janitor's queue, a file is written under a temporary name and renamed, so it is
+# never read half-written.
+
+import json
+import os
+import time
+import uuid
+
+SPOOL_DIR = os.path.join("data", "events")
+
+_listeners = []
+
+def add_listener(listener):
+    """Makes this process hand events to listener(event) instead of the spool."""
+    _listeners.append(listener)
+
+def dispatch(event):
+    """Hands an event to every listener. Returns False if there are none."""
+    for listener in _listeners:
+        try:
+            listener(event)
+        except Exception as e:
+            print(f"Change event listener failed for {event['type']}: {e}")
+    return bool(_listeners)
+
+def emit(event_type, data, user_id=None):
+    """Announces a committed change. Never raises; a lost event only means a late refresh."""
+    event = {'type': event_type, 'data': data, 'user_id': user_id, 'time': time.time()}
+    if dispatch(event):
+        return
+    try:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        name = f"{time.time_ns()}-{uuid.uuid4().hex}"
+        temp_path = os.path.join(SPOOL_DIR, name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(event, f, default=str)
+        os.replace(temp_path, os.path.join(SPOOL_DIR, name + ".json"))
+    except OSError as e:
+        print(f"Could not record change event {event_type}: {e}")
+
+def take_spooled_events(max_age):
+    """
+    Returns the events waiting in the spool, oldest first, and removes them.
+    Events older than max_age seconds are dropped: nobody was listening then.
+    """
+    try:
+        names = sorted(entry.name for entry in os.scandir(SPOOL_DIR) if entry.name.endswith(".json"))
+    except FileNotFoundError:
+        return []
+    events = []
+    cutoff = time.time() - max_age
+    for name in names:
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            with open(path, encoding='utf-8') as f:
+                event = json.load(f)
+            if event.get('time', 0) >= cutoff:
+                events.append(event)
+        except (OSError, ValueError) as e:
+            print(f"Skipping unreadable change event {name}: {e}")
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return events
@@ -1,32 +1,610 @@
+import contextvars
+import csv
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import os
+import threading
+import time
 import cx_Oracle
+from db.deadlines import DeadlineExceeded, call_timeout_ms, expired, in_request
 
 # Database connection parameters
 DB_USER = "EBOOK_SITE"
 DB_PASSWORD = "1124"
-DB_DSN = "localhost:1521/XEPDB1"
+DB_DSN = os.environ.get("DB_DSN", "localhost:1521/XEPDB1")
+# Read replicas, comma separated, e.g. "replica1:1521/XEPDB1,replica2:1521/XEPDB1".
+# Without any, reads go to DB_DSN like everything else.
+DB_READ_DSNS = [dsn.strip() for dsn in os.environ.get("DB_READ_DSNS", "").split(",") if dsn.strip()]
 
-def get_db_connection():
-    """Establishes and returns a connection to the Oracle database."""
+# Fetch tuning for large listings. arraysize is how many rows each fetch
+# round trip brings back; prefetchrows is how many come back with the execute.
+DEFAULT_ARRAYSIZE = 500
+DEFAULT_PREFETCHROWS = 501
+
+# Connections come from a session pool per database shared by all threads, so
+# a request reuses an open session instead of logging in every time.
+POOL_MIN = 1
+POOL_MAX = 8
+# How long to wait for a free pooled connection before giving up, in milliseconds
+ACQUIRE_TIMEOUT_MS = 2000
+# Oracle's error for "no free session in the pool within the wait timeout"
+POOL_TIMEOUT_CODE = 24457
+
+# Every query function asks for a connection of one of these kinds. WRITE
+# connections go to the primary (DB_DSN). READ connections go to a healthy
+# replica, taken in turn, and fall back to the primary when none is healthy.
+# PRIMARY is for reads that must never be stale, like checking a session token
+# that was issued a moment ago; they go to the primary without counting as a write.
+READ = 'read'
+WRITE = 'write'
+PRIMARY = 'primary'
+
+# A replica that failed is left alone for this long, then checked again
+REPLICA_RETRY_INTERVAL = 30
+REPLICA_CHECK_INTERVAL = 10
+# Replicas lag behind the primary. For this many seconds after a client writes,
+# its reads go to the primary so it sees its own changes. The client's next
+# request may be answered by another server process, so when there are replicas
+# the time of its last write is also kept as the mtime of a small file in
+# WRITE_MARKER_DIR, named after a hash of the client, which every process checks.
+READ_YOUR_WRITES_WINDOW = 5
+WRITE_MARKER_DIR = os.path.join("data", "recent_writes")
+# A client's marker file is touched at most this often, in seconds
+WRITE_MARKER_INTERVAL = 0.5
+
+# Circuit breaker for the primary. While Oracle is down, every connection attempt
+# blocks until it times out. After FAILURE_THRESHOLD failures in a row the breaker
+# opens: get_db_connection() then gives up at once instead of trying, and a
+# background thread tries the primary every PROBE_INTERVAL seconds. The first probe
+# that works closes the breaker again and runs the on_recovery() callbacks.
+FAILURE_THRESHOLD = 3
+PROBE_INTERVAL = 5
+PING_TIMEOUT_MS = 5000
+
+_pools = {}
+_pool_lock = threading.Lock()    # guards _pool_locks only
+_pool_locks = {}                 # dsn -> lock held while that database's pool is created
+_replica_down_until = {dsn: 0 for dsn in DB_READ_DSNS}
+_replica_turn = itertools.count()
+
+# Per request: who is asking (see begin_request) and whether it has written yet.
+# Context variables rather than thread locals, so work a request hands to a
+# thread pool can carry them along.
+_request_client = contextvars.ContextVar('db_request_client', default=None)
+_request_wrote = contextvars.ContextVar('db_request_wrote', default=False)
+_request_primary = contextvars.ContextVar('db_request_primary', default=False)
+_recent_writes = {}    # client -> time of its last write
+_recent_writes_lock = threading.Lock()
+
+def _get_pool(dsn):
+    """Creates the session pool for a database on first use. Returns None if it cannot be created."""
+    pool = _pools.get(dsn)
+    if pool is not None:
+        return pool
+    # Logging in can take a while, so only callers of the same database wait on it
+    with _pool_lock:
+        dsn_lock = _pool_locks.setdefault(dsn, threading.Lock())
+    with dsn_lock:
+        if dsn not in _pools:
+            try:
+                _pools[dsn] = cx_Oracle.SessionPool(
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    dsn=dsn,
+                    min=POOL_MIN,
+                    max=POOL_MAX,
+                    increment=1,
+                    threaded=True,
+                    getmode=cx_Oracle.SPOOL_ATTRVAL_TIMEDWAIT,
+                    waitTimeout=ACQUIRE_TIMEOUT_MS,
+                    encoding="UTF-8"
+                )
+            except cx_Oracle.Error as e:
+                print(f"Database pool error for {dsn}: {e}")
+                return None
+        return _pools[dsn]
+
+def _connect(dsn):
+    """Returns a connection to one database, from its pool if it has one."""
+    pool = _get_pool(dsn)
+    if pool is not None:
+        return pool.acquire()
+    # Without a pool, fall back to a connection of our own
+    return cx_Oracle.connect(
+        user=DB_USER,
+        password=DB_PASSWORD,
+        dsn=dsn,
+        encoding="UTF-8"
+    )
+
+def begin_request(client=None):
+    """
+    Starts the read/write bookkeeping for a new request. `client` identifies who
+    is asking (a session token or an address); it lets reads in the client's next
+    requests see what it just wrote.
+    """
+    _request_client.set(client)
+    _request_wrote.set(False)
+    _request_primary.set(False)
+
+def read_primary_for_request():
+    """Sends the rest of this request's reads to the primary, e.g. for data that just changed."""
+    _request_primary.set(True)
+
+def _write_marker_path(client):
+    # Hashed, since the client is often a session token
+    return os.path.join(WRITE_MARKER_DIR, hashlib.sha256(client.encode('utf-8')).hexdigest()[:32])
+
+def _touch_write_marker(client):
+    """Records a client's write where the other server processes can see it."""
+    path = _write_marker_path(client)
+    try:
+        os.makedirs(WRITE_MARKER_DIR, exist_ok=True)
+        with open(path, 'a'):
+            os.utime(path)
+    except OSError as e:
+        print(f"Could not record write marker: {e}")
+
+def _note_write():
+    _request_wrote.set(True)
+    client = _request_client.get()
+    if client is None:
+        return
+    now = time.time()
+    with _recent_writes_lock:
+        previous = _recent_writes.get(client)
+        _recent_writes[client] = now
+        if len(_recent_writes) > 10000:
+            for key, written in list(_recent_writes.items()):
+                if now - written > READ_YOUR_WRITES_WINDOW:
+                    del _recent_writes[key]
+    if DB_READ_DSNS and (previous is None or now - previous >= WRITE_MARKER_INTERVAL):
+        _touch_write_marker(client)
+
+def _must_read_primary():
+    """
+    True if this request, or its client a moment ago (in any server process),
+    wrote something, or it asked for the primary.
+    """
+    if _request_wrote.get() or _request_primary.get():
+        return True
+    client = _request_client.get()
+    if client is None:
+        return False
+    with _recent_writes_lock:
+        written = _recent_writes.get(client)
+    if written is None and DB_READ_DSNS:
+        try:
+            written = os.stat(_write_marker_path(client)).st_mtime
+        except OSError:
+            pass    # no recent write by this client anywhere
+    return written is not None and time.time() - written < READ_YOUR_WRITES_WINDOW
+
+def _prune_write_markers():
+    """Deletes write markers older than READ_YOUR_WRITES_WINDOW."""
+    cutoff = time.time() - READ_YOUR_WRITES_WINDOW
+    try:
+        with os.scandir(WRITE_MARKER_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    continue    # removed by another process meanwhile
+    except FileNotFoundError:
+        pass
+
+class CircuitBreaker:
+    """Counts connection failures to one database and stops trying it once there are too many."""
+
+    def __init__(self, name, probe, threshold=FAILURE_THRESHOLD, probe_interval=PROBE_INTERVAL):
+        self.name = name
+        self.probe = probe                  # raises cx_Oracle.Error while the database is down
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.recovery_callbacks = []
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.threshold or self.opened_at is not None:
+                return
+            self.opened_at = time.time()
+        print(f"Database {self.name} is failing, not connecting to it until it recovers")
+        threading.Thread(target=self._probe_loop, name=f"breaker-{self.name}", daemon=True).start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except cx_Oracle.Error:
+                continue
+            break
+        with self.lock:
+            down_for = time.time() - self.opened_at
+            self.opened_at = None
+            self.failures = 0
+        print(f"Database {self.name} is back after {down_for:.0f} seconds")
+        for callback in self.recovery_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Database recovery callback failed: {e}")
+
+def _ping(dsn):
+    """Runs a trivial query on one database. Raises cx_Oracle.Error if it fails."""
+    conn = _connect(dsn)
     try:
-        # Create a connection using the specified credentials and DSN
-        connection = cx_Oracle.connect(
-            user=DB_USER,
-            password=DB_PASSWORD,
-            dsn=DB_DSN,
-            encoding="UTF-8"
-        )
+        conn.callTimeout = PING_TIMEOUT_MS
+        with conn.cursor() as cursor:
+            # SQL health check
+            cursor.execute("SELECT 1 FROM dual")
+            cursor.fetchone()
+    finally:
+        conn.close()
+
+_primary_breaker = CircuitBreaker('primary', lambda: _ping(DB_DSN))
+_last_contact = {'time': None}    # when a connection last worked, to any database
+
+def database_available():
+    """False while the primary's circuit breaker is open."""
+    return not _primary_breaker.is_open()
+
+def seconds_since_database_contact():
+    """How long ago a connection last worked, or None if none ever has."""
+    if _last_contact['time'] is None:
+        return None
+    return time.time() - _last_contact['time']
+
+def on_recovery(callback):
+    """Calls callback() (on the probe thread) whenever the primary comes back after an outage."""
+    _primary_breaker.recovery_callbacks.append(callback)
+
+def _is_pool_timeout(error):
+    """True if a cx_Oracle error means every pooled connection was busy (load, not an outage)."""
+    details = error.args[0] if error.args else None
+    return getattr(details, 'code', None) == POOL_TIMEOUT_CODE
+
+def _mark_replica_down(dsn, error):
+    print(f"Read replica {dsn} unavailable, using another: {error}")
+    _replica_down_until[dsn] = time.time() + REPLICA_RETRY_INTERVAL
+
+def _connect_replica():
+    """Returns a connection to a healthy replica, trying each in turn, or None."""
+    if not DB_READ_DSNS:
+        return None
+    first = next(_replica_turn)
+    for i in range(len(DB_READ_DSNS)):
+        dsn = DB_READ_DSNS[(first + i) % len(DB_READ_DSNS)]
+        if _replica_down_until.get(dsn, 0) > time.time():
+            continue
+        try:
+            return _connect(dsn)
+        except cx_Oracle.Error as e:
+            if not _is_pool_timeout(e):
+                _mark_replica_down(dsn, e)
+    return None
+
+def get_db_connection(mode=WRITE):
+    """
+    Returns a connection to the Oracle database: the primary for WRITE and
+    PRIMARY, a read replica for READ (see above). Closing the connection hands it
+    back to its pool. Returns None if no connection could be made, straight away
+    while the circuit breaker is open.
+
+    During a request, the connection's calls are limited to what is left of the
+    request's time budget, and DeadlineExceeded is raised instead once it is used
+    up (see db/deadlines.py).
+    """
+    if expired():
+        raise DeadlineExceeded("The request ran out of time before its database work was done")
+    connection = _open_connection(mode)
+    if connection is not None:
+        # Oracle cancels a call still running when this runs out (0 means no limit).
+        # Always set, since a pooled connection keeps the last request's value.
+        connection.callTimeout = call_timeout_ms()
+    return connection
+
+def _open_connection(mode):
+    """Picks the database for get_db_connection() and connects to it."""
+    try:
+        if mode == READ and not _must_read_primary():
+            connection = _connect_replica()
+            if connection is not None:
+                _last_contact['time'] = time.time()
+                return connection
+        if _primary_breaker.is_open():
+            # Fail fast; the breaker's probe finds out when the primary is back
+            return None
+        connection = _connect(DB_DSN)
+        _primary_breaker.record_success()
+        _last_contact['time'] = time.time()
+        if mode == WRITE:
+            _note_write()
         return connection
     except cx_Oracle.Error as e:
         # Print an error message if the connection fails
         print(f"Database connection error: {e}")
+        if not _is_pool_timeout(e):
+            _primary_breaker.record_failure()
+        elif in_request():
+            raise DeadlineExceeded("No database connection came free in time", status=503)
+        return None
+
+def get_database_time():
+    """
+    Returns the primary database's clock as a datetime, in the same form as the
+    TIMESTAMP columns, or None if the query failed. Watermarks compared with
+    those columns are taken from here rather than from this server's clock.
+    """
+    conn = get_db_connection(PRIMARY)
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            # SQL query for the database clock, in the same form as the TIMESTAMP columns
+            cursor.execute("SELECT CAST(SYSTIMESTAMP AS TIMESTAMP) FROM dual")
+            return cursor.fetchone()[0]
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_database_time: {e}")
         return None
+    finally:
+        if conn:
+            conn.close()
+
+def check_replicas():
+    """
+    Runs a trivial query on every replica and takes failing ones out of the
+    rotation (and working ones back in). Returns {dsn: healthy}.
+    """
+    status = {}
+    for dsn in DB_READ_DSNS:
+        try:
+            _ping(dsn)
+            _replica_down_until[dsn] = 0
+            status[dsn] = True
+        except cx_Oracle.Error as e:
+            _mark_replica_down(dsn, e)
+            status[dsn] = False
+    return status
+
+def warm_pools():
+    """
+    Opens the session pools at startup (POOL_MIN sessions each) and checks that
+    each database answers, so the first requests do not wait for a login.
+    Returns True if the primary answered.
+    """
+    primary_ok = True
+    for dsn in [DB_DSN] + DB_READ_DSNS:
+        try:
+            _ping(dsn)
+        except cx_Oracle.Error as e:
+            print(f"Warm-up could not reach database {dsn}: {e}")
+            if dsn == DB_DSN:
+                primary_ok = False
+    return primary_ok
+
+def _replica_check_loop():
+    while True:
+        check_replicas()
+        _prune_write_markers()
+        time.sleep(REPLICA_CHECK_INTERVAL)
+
+def start_replica_health_checks():
+    """Checks the read replicas every REPLICA_CHECK_INTERVAL seconds on a daemon thread, if there are any."""
+    if not DB_READ_DSNS:
+        return None
+    thread = threading.Thread(target=_replica_check_loop, name="replica-health", daemon=True)
+    thread.start()
+    return thread
+
+class CompactRows:
+    """
+    A query result stored as one shared tuple of column names plus the plain row
+    tuples returned by the driver. No per-row dictionaries are built, so large
+    listings use far less memory than a list of dicts.
+    """
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def __iter__(self):
+        # Build each dictionary only when the caller actually asks for it
+        columns = self.columns
+        for row in self.rows:
+            yield dict(zip(columns, row))
+
+    def to_dicts(self):
+        """Returns the rows as a list of dictionaries (the old _fetch_as_dict format)."""
+        return list(self)
+
+    def iter_json(self, encoder):
+        """
+        Yields the result as pieces of a JSON array of objects.
+        Values are encoded straight from the row tuples with the given JSONEncoder.
+        """
+        return _iter_json_array(self.columns, [self.rows], encoder)
+
+class StreamInterrupted(Exception):
+    """A RowStream failed part way, so the rows already sent are not all of them."""
+
+class RowStream:
+    """
+    An open query whose rows are pulled from the cursor in batches.
+    Iterating yields lists of row tuples; the connection is closed once the
+    rows run out, a database error occurs, or close() is called. A database
+    error part way raises StreamInterrupted, so a response being streamed can
+    be broken off instead of ending as if it were complete.
+    """
+    __slots__ = ('connection', 'cursor', 'columns')
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self.cursor = cursor
+        self.columns = _column_names(cursor)
+
+    def __iter__(self):
+        try:
+            yield from _fetch_batches(self.cursor)
+        except cx_Oracle.Error as e:
+            print(f"Database error while streaming rows: {e}")
+            raise StreamInterrupted(str(e)) from e
+        finally:
+            self.close()
+
+    def iter_json(self, encoder):
+        """Yields the rows as pieces of a JSON array of objects, one batch at a time."""
+        return _iter_json_array(self.columns, self, encoder)
+
+    def iter_ndjson(self, encoder):
+        """Yields the rows as newline-delimited JSON objects, one batch at a time."""
+        return _iter_ndjson(self.columns, self, encoder)
+
+    def iter_csv(self):
+        """Yields the rows as CSV text with a header line, one batch at a time."""
+        return _iter_csv(self.columns, self)
+
+    def close(self):
+        """Closes the cursor and connection. Safe to call more than once."""
+        if self.connection:
+            try:
+                self.cursor.close()
+                self.connection.close()
+            except cx_Oracle.Error:
+                pass
+            self.connection = None
+
+def _open_row_stream(sql, params, batch_size=DEFAULT_ARRAYSIZE, mode=READ):
+    """
+    Runs a query on its own connection (a read replica unless mode says
+    otherwise) and returns a RowStream over its results, or None if the
+    connection or query fails.
+    """
+    conn = get_db_connection(mode)
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        _tune_cursor(cursor, arraysize=batch_size)
+        cursor.execute(sql, params)
+        return RowStream(conn, cursor)
+    except cx_Oracle.Error as e:
+        print(f"Database error in _open_row_stream: {e}")
+        conn.close()
+        return None
+
+def _column_names(cursor):
+    """Returns the lowercased column names of the current query as a tuple."""
+    return tuple(col[0].lower() for col in cursor.description)
+
+def _tune_cursor(cursor, arraysize=DEFAULT_ARRAYSIZE, prefetchrows=DEFAULT_PREFETCHROWS):
+    """
+    Sets the fetch sizes on a cursor. This must be called before cursor.execute()
+    for prefetchrows to take effect.
+    """
+    cursor.arraysize = arraysize
+    if prefetchrows is not None:
+        cursor.prefetchrows = prefetchrows
 
 def _fetch_as_dict(cursor):
     """
     Fetches query results from the cursor and returns them as a list of dictionaries.
     This helper function makes it easier to convert database rows to a structured format like JSON.
+    It is best kept for small results; use _fetch_compact for listings.
     """
     # Get column names from the cursor description
-    columns = [col[0].lower() for col in cursor.description]
+    columns = _column_names(cursor)
     # Create a dictionary for each row, mapping column names to row values
     return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def _fetch_compact(cursor):
+    """Fetches all query results from the cursor as a CompactRows object."""
+    return CompactRows(_column_names(cursor), cursor.fetchall())
+
+def _fetch_batches(cursor, batch_size=None):
+    """
+    Generator that yields the query results in lists of row tuples,
+    so a caller never has to hold the whole result in memory.
+    """
+    size = batch_size or cursor.arraysize
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+def _iter_json_array(columns, batches, encoder):
+    """
+    Yields a JSON array of objects built from batches of row tuples.
+    The object keys are encoded once and reused for every row.
+    """
+    encode = encoder.encode
+    # Pre-encode '"column": ' for every column
+    key_prefixes = [json.dumps(name) + ': ' for name in columns]
+    first = True
+    yield '['
+    for batch in batches:
+        parts = []
+        for row in batch:
+            fields = ', '.join([key + encode(value) for key, value in zip(key_prefixes, row)])
+            if first:
+                parts.append('{' + fields + '}')
+                first = False
+            else:
+                parts.append(', {' + fields + '}')
+        if parts:
+            yield ''.join(parts)
+    yield ']'
+
+def _iter_ndjson(columns, batches, encoder):
+    """Yields one JSON object per row, each on its own line, a batch at a time."""
+    encode = encoder.encode
+    key_prefixes = [json.dumps(name) + ': ' for name in columns]
+    for batch in batches:
+        lines = ['{' + ', '.join([key + encode(value) for key, value in zip(key_prefixes, row)]) + '}\n'
+                 for row in batch]
+        if lines:
+            yield ''.join(lines)
+
+def _csv_value(value):
+    """Formats one value for CSV: dates as ISO 8601, None as an empty field."""
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+def _iter_csv(columns, batches):
+    """Yields CSV text: a header line, then the rows a batch at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([[_csv_value(value) for value in row] for row in batch])
+        if buffer.tell():
+            yield buffer.getvalue()
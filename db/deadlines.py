@@ -0,0 +1,98 @@
+# db/deadlines.py
+# Time budgets for requests, and the database timeouts they turn into.
+#
+# When a request starts, the server gives it a budget in seconds for its route
+# (see REQUEST_BUDGETS in the handler modules). get_db_connection() turns whatever
+# is left of it into the connection's call timeout, so Oracle itself cancels a
+# query that would run past the budget, and it refuses to start new database work
+# once the budget is used up by raising DeadlineExceeded. That is not a
+# cx_Oracle.Error, so it is not swallowed by the query functions; the server
+# catches it and answers 504 Gateway Timeout (or 503 if no pooled connection came
+# free in time). A request whose budget ran out before its response was sent gets
+# a 504 as well, since a cancelled query leaves its query function returning an
+# empty result.
+#
+# Routes without a budget (streams, uploads) still have each database call
+# limited to MAX_CALL_SECONDS. Work done outside requests has no limits.
+#
+# Every exceeded budget is counted per route in STATS_PATH, which both servers
+# write to, like the janitor's totals. The admin server shows them at
+# /api/admin/timeouts.
+
+import contextvars
+import json
+import os
+import threading
+import time
+
+STATS_PATH = os.path.join("data", "deadline_stats.json")
+
+MAX_CALL_SECONDS = 30
+
+# Per request: its route and the time its budget runs out (None for no budget)
+_route = contextvars.ContextVar('request_route', default=None)
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+_stats_lock = threading.Lock()
+
+class DeadlineExceeded(Exception):
+    """Raised when a request has run out of time for its database work."""
+
+    def __init__(self, message, status=504):
+        super().__init__(message)
+        self.status = status
+
+def start(route, budget):
+    """Starts the clock for a request. `budget` is in seconds, or None for no budget."""
+    _route.set(route)
+    _deadline.set(time.time() + budget if budget is not None else None)
+
+def in_request():
+    """True on a thread that is working for a request."""
+    return _route.get() is not None
+
+def time_left():
+    """Seconds left in the request's budget, or None if it has none."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def expired():
+    """True once the request's budget is used up."""
+    left = time_left()
+    return left is not None and left <= 0
+
+def call_timeout_ms():
+    """The call timeout for a database connection, in milliseconds (0 means none)."""
+    if not in_request():
+        return 0
+    limit = MAX_CALL_SECONDS
+    left = time_left()
+    if left is not None:
+        limit = min(limit, left)
+    return max(1, int(limit * 1000))
+
+def record_exceeded(status):
+    """Counts an exceeded budget against the current request's route."""
+    route = _route.get() or 'unknown'
+    with _stats_lock:
+        stats = read_stats()
+        entry = stats.setdefault(route, {})
+        entry[str(status)] = entry.get(str(status), 0) + 1
+        entry['last'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        try:
+            os.makedirs(os.path.dirname(STATS_PATH), exist_ok=True)
+            temp_path = f"{STATS_PATH}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(stats, f)
+            os.replace(temp_path, STATS_PATH)
+        except OSError as e:
+            print(f"Could not record timeout: {e}")
+
+def read_stats():
+    """Returns {route: {status: count, 'last': time}} for the requests that ran out of time."""
+    try:
+        with open(STATS_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
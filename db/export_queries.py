@@ -0,0 +1,83 @@
+# db/export_queries.py
+# Queries behind the admin data exports.
+#
+# Each export is streamed straight from an open cursor (see RowStream in
+# db/connection.py), so its size does not matter. Given a `since` time, only rows
+# created or changed at or after it are returned, which allows incremental
+# exports; this relies on the timestamp columns added by migration 006. Deleted
+# rows simply stop appearing, so a full export is still needed now and then to
+# notice deletions.
+#
+# The `since` to use next time comes from the database clock, which is what
+# stamps the rows, and lies EXPORT_OVERLAP before the export started: a
+# transaction that stamped a row before then but committed after the export's
+# query began is not in this export, and would otherwise be skipped for good.
+# Rows in the overlap are sent twice, so consumers should upsert by id.
+
+import datetime
+from db.connection import get_database_time, _open_row_stream, PRIMARY
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_OVERLAP = datetime.timedelta(minutes=5)
+
+# Export name -> (query, column compared with `since`). Passwords and session
+# tokens are never exported.
+EXPORTS = {
+    'users': ("""
+        SELECT u.user_id, u.name, u.email, u.phone, u.updated_at,
+               (
+                   SELECT LISTAGG(c.category_name || ' until ' || TO_CHAR(us.expiry_date, 'YYYY-MM-DD'), '; ')
+                          WITHIN GROUP (ORDER BY c.category_name)
+                   FROM user_subscriptions us
+                   JOIN categories c ON us.category_id = c.category_id
+                   WHERE us.user_id = u.user_id
+               ) AS subscriptions
+        FROM users u
+    """, 'u.updated_at'),
+    'publishers': ("""
+        SELECT p.publisher_id, p.name, p.email, p.phone, p.address, p.description, p.image_path, p.updated_at
+        FROM publishers p
+    """, 'p.updated_at'),
+    'books': ("""
+        SELECT b.book_id, b.name, b.author_name, b.description, b.category_id, c.category_name,
+               b.publisher_id, p.name AS publisher_name, b.cover_path, b.pdf_path, b.updated_at
+        FROM books b
+        LEFT JOIN publishers p ON b.publisher_id = p.publisher_id
+        LEFT JOIN categories c ON b.category_id = c.category_id
+    """, 'b.updated_at'),
+    'bookmarks': ("""
+        SELECT bm.bookmark_id, bm.user_id, bm.book_id, bm.created_at
+        FROM bookmarks bm
+    """, 'bm.created_at'),
+    'history': ("""
+        SELECT rh.history_id, rh.user_id, rh.book_id, rh.last_read_timestamp
+        FROM reading_history rh
+    """, 'rh.last_read_timestamp'),
+}
+
+def get_export_watermark():
+    """
+    Returns the `since` for the next incremental export (the database's time now,
+    less EXPORT_OVERLAP) as a datetime, or None if the query failed. Call it
+    before the export query starts.
+    """
+    now = get_database_time()
+    if now is None:
+        return None
+    return now - EXPORT_OVERLAP
+
+def stream_export(name, since=None):
+    """
+    Returns a RowStream over one export (a key of EXPORTS), oldest change first,
+    or None if the query could not be started. `since` is a datetime or None.
+    """
+    sql, time_column = EXPORTS[name]
+    params = {}
+    if since is not None:
+        # Only rows changed at or after `since`
+        sql += f" WHERE {time_column} >= :since"
+        params['since'] = since
+    sql += f" ORDER BY {time_column}"
+    # From the primary: on a lagging replica, rows changed just before the export
+    # started would be missing, and the next `since` export would skip them for good
+    return _open_row_stream(sql, params, batch_size=EXPORT_BATCH_SIZE, mode=PRIMARY)
@@ -0,0 +1,138 @@
+# db/migrate.py
+# Applies the numbered SQL files in db/migrations to the database.
+#
+# Usage (from the project root):
+#   python -m db.migrate           apply every migration that has not run yet
+#   python -m db.migrate status    list migrations and whether they are applied
+
+import os
+import sys
+import cx_Oracle
+from db.connection import get_db_connection, WRITE, PRIMARY
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+# Oracle errors that mean the object a migration creates is already there:
+# ORA-00955 (name already used), ORA-01408 (column list already indexed) and
+# ORA-01430 (column being added already exists).
+ALREADY_EXISTS_CODES = (955, 1408, 1430)
+
+def list_migrations():
+    """
+    Returns a sorted list of (version, name, path) for every migration file.
+    Files are named like '002_book_filter_indexes.sql'.
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        if not filename.endswith('.sql'):
+            continue
+        prefix = filename.split('_', 1)[0]
+        if not prefix.isdigit():
+            continue
+        migrations.append((int(prefix), filename[:-4], os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+def read_statements(path):
+    """Reads a migration file and splits it into statements, dropping '--' comments."""
+    with open(path, encoding='utf-8') as f:
+        lines = [line for line in f if not line.strip().startswith('--')]
+    statements = []
+    for statement in ''.join(lines).split(';'):
+        statement = statement.strip()
+        if statement:
+            statements.append(statement)
+    return statements
+
+def _ensure_migrations_table(cursor):
+    """Creates the table that records applied versions, if it does not exist yet."""
+    try:
+        cursor.execute("""
+            CREATE TABLE schema_migrations (
+                version NUMBER PRIMARY KEY,
+                name VARCHAR2(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    except cx_Oracle.DatabaseError as e:
+        error, = e.args
+        if error.code not in ALREADY_EXISTS_CODES:
+            raise
+
+def get_applied_versions(cursor):
+    """Returns the set of migration versions already recorded in the database."""
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+def apply_migration(cursor, version, name, path):
+    """
+    Runs every statement of one migration and records its version.
+    Objects that already exist are skipped, so a migration that was applied by
+    hand (or half-applied before a failure) can safely be run again.
+    """
+    for statement in read_statements(path):
+        try:
+            cursor.execute(statement)
+        except cx_Oracle.DatabaseError as e:
+            error, = e.args
+            if error.code in ALREADY_EXISTS_CODES:
+                print(f"  skipped (already exists): {statement.splitlines()[0]}")
+            else:
+                raise
+    cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)",
+                   version=version, name=name)
+
+def migrate():
+    """Applies all pending migrations in version order. Returns True on success."""
+    conn = get_db_connection(WRITE)
+    if not conn:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            _ensure_migrations_table(cursor)
+            applied = get_applied_versions(cursor)
+            pending = [m for m in list_migrations() if m[0] not in applied]
+            if not pending:
+                print("Database is up to date.")
+            for version, name, path in pending:
+                print(f"Applying {name} ...")
+                apply_migration(cursor, version, name, path)
+                # DDL commits on its own in Oracle; this commits the version record
+                conn.commit()
+        return True
+    except cx_Oracle.Error as e:
+        print(f"Database error in migrate: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def print_status():
+    """Prints each migration and whether it has been applied."""
+    conn = get_db_connection(PRIMARY)
+    if not conn:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            _ensure_migrations_table(cursor)
+            applied = get_applied_versions(cursor)
+        for version, name, path in list_migrations():
+            state = "applied" if version in applied else "pending"
+            print(f"{name:45} {state}")
+        return True
+    except cx_Oracle.Error as e:
+        print(f"Database error in print_status: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "up"
+    if command == "up":
+        ok = migrate()
+    elif command == "status":
+        ok = print_status()
+    else:
+        print(f"Unknown command '{command}'. Use 'up' or 'status'.")
+        ok = False
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,9 @@
+-- 001: Session token lookups
+-- get_entity_by_token looks up users, publishers and admins by
+-- session_token and token_expiry on every authenticated request.
+
+CREATE INDEX idx_users_session_token ON users (session_token, token_expiry);
+
+CREATE INDEX idx_publishers_session_token ON publishers (session_token, token_expiry);
+
+CREATE INDEX idx_admins_session_token ON admins (session_token, token_expiry);
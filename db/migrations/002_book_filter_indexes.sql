@@ -0,0 +1,7 @@
+-- 002: Catalog filters and joins
+-- get_all_books filters on category_id, get_books_by_publisher filters on
+-- publisher_id, and delete_category counts books per category_id.
+
+CREATE INDEX idx_books_category_id ON books (category_id);
+
+CREATE INDEX idx_books_publisher_id ON books (publisher_id);
@@ -0,0 +1,5 @@
+-- 003: Reading history ordering
+-- get_reading_history reads one user's rows ordered by last_read_timestamp DESC
+-- and stops after a few rows, which this index answers without a sort.
+
+CREATE INDEX idx_history_user_last_read ON reading_history (user_id, last_read_timestamp DESC);
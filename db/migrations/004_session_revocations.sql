@@ -0,0 +1,16 @@
+-- 004: Revocation list for signed session tokens
+-- A row with a token_id revokes that one token (logout). A row without one
+-- revokes every token issued to the entity before revoked_at (account deleted).
+-- Rows are only needed until expires_at, after which the tokens are dead anyway.
+
+CREATE TABLE session_revocations (
+    revocation_id NUMBER GENERATED BY DEFAULT ON NULL AS IDENTITY,
+    entity_type VARCHAR2(20) NOT NULL,
+    entity_id NUMBER NOT NULL,
+    token_id VARCHAR2(64),
+    revoked_at TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY(revocation_id)
+);
+
+CREATE INDEX idx_session_revocations_expiry ON session_revocations (expires_at);
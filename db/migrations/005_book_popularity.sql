@@ -0,0 +1,12 @@
+-- 005: Snapshot table for the trending / popular rankings
+-- The counters live in memory (services/trending.py). Their decayed values are
+-- saved here periodically so a restart does not reset the rankings.
+
+CREATE TABLE book_popularity (
+    book_id NUMBER NOT NULL,
+    trending_score NUMBER NOT NULL,
+    popular_score NUMBER NOT NULL,
+    updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY(book_id),
+    CONSTRAINT fk_popularity_book FOREIGN KEY (book_id) REFERENCES books(book_id) ON DELETE CASCADE
+);
@@ -0,0 +1,24 @@
+-- 006: Change timestamps for incremental admin exports
+-- The admin export endpoints take a `since` time and return only rows changed
+-- after it. New rows get the current time from the column default, and the
+-- update functions in db/ set updated_at themselves. Subscriptions are exported
+-- with their user, so adding or removing one touches the user's updated_at.
+-- Reading history already has last_read_timestamp.
+
+ALTER TABLE users ADD (updated_at TIMESTAMP DEFAULT SYSTIMESTAMP NOT NULL);
+
+ALTER TABLE publishers ADD (updated_at TIMESTAMP DEFAULT SYSTIMESTAMP NOT NULL);
+
+ALTER TABLE books ADD (updated_at TIMESTAMP DEFAULT SYSTIMESTAMP NOT NULL);
+
+ALTER TABLE bookmarks ADD (created_at TIMESTAMP DEFAULT SYSTIMESTAMP NOT NULL);
+
+CREATE INDEX idx_users_updated_at ON users (updated_at);
+
+CREATE INDEX idx_publishers_updated_at ON publishers (updated_at);
+
+CREATE INDEX idx_books_updated_at ON books (updated_at);
+
+CREATE INDEX idx_bookmarks_created_at ON bookmarks (created_at);
+
+CREATE INDEX idx_history_last_read ON reading_history (last_read_timestamp);
@@ -0,0 +1,57 @@
+# db/popularity_queries.py
+# Contains database operations for the saved trending/popular book scores.
+
+import cx_Oracle
+from db.connection import get_db_connection, _tune_cursor, READ, WRITE
+
+def get_book_popularity():
+    """Returns a list of (book_id, trending_score, popular_score, updated_at) rows."""
+    conn = get_db_connection(READ)
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cursor:
+            _tune_cursor(cursor)
+            cursor.execute("SELECT book_id, trending_score, popular_score, updated_at FROM book_popularity")
+            return cursor.fetchall()
+    except cx_Oracle.Error as e:
+        print(f"Database error in get_book_popularity: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def save_book_popularity(rows):
+    """
+    Saves (book_id, trending_score, popular_score, updated_at) rows in one batch,
+    inserting new books and overwriting the scores of known ones.
+    """
+    if not rows:
+        return True
+    conn = get_db_connection(WRITE)
+    if not conn:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            # Use MERGE so each book keeps exactly one row
+            sql = """
+                MERGE INTO book_popularity bp
+                USING (SELECT :1 AS book_id, :2 AS trending_score, :3 AS popular_score, :4 AS updated_at FROM dual) d
+                ON (bp.book_id = d.book_id)
+                WHEN MATCHED THEN UPDATE SET bp.trending_score = d.trending_score,
+                                             bp.popular_score = d.popular_score,
+                                             bp.updated_at = d.updated_at
+                WHEN NOT MATCHED THEN INSERT (book_id, trending_score, popular_score, updated_at)
+                                      VALUES (d.book_id, d.trending_score, d.popular_score, d.updated_at)
+            """
+            # Rows for books deleted since the last snapshot fail the foreign key;
+            # batcherrors lets the rest of the batch go through
+            cursor.executemany(sql, rows, batcherrors=True)
+            conn.commit()
+            return True
+    except cx_Oracle.Error as e:
+        print(f"Database error in save_book_popularity: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
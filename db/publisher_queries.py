@@ -2,12 +2,11 @@
 # Contains all database operations related to publishers.
 
 import cx_Oracle
-from db.connection import get_db_connection, _fetch_as_dict
-from db.user_queries import set_session_token
+from db.connection import get_db_connection, _fetch_as_dict, READ, WRITE
 
 def create_publisher(name, email, phone, address, description, image_path, password):
     """Inserts a new publisher into the 'publishers' table."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return None
     try:
@@ -28,50 +27,40 @@ def create_publisher(name, email, phone, address, description, image_path, passw
         if conn:
             conn.close()
 
-def verify_publisher_login(email, password):
-    """
-    Verifies publisher credentials and returns publisher data with a new session token.
-    """
-    conn = get_db_connection()
+def get_publisher_details(publisher_id):
+    """Fetches public details for a single publisher by their ID."""
+    conn = get_db_connection(READ)
     if not conn:
         return None
     try:
         with conn.cursor() as cursor:
-            # SQL query to find a publisher by email and password
-            sql = "SELECT publisher_id, name, email FROM publishers WHERE email = :email AND password = :password"
-            cursor.execute(sql, email=email, password=password)
-            pub_data = _fetch_as_dict(cursor)
-
-            if pub_data:
-                publisher = pub_data[0]
-                # Generate a session token upon successful login
-                token = set_session_token(publisher['publisher_id'], 'publisher')
-                if token:
-                    publisher['session_token'] = token
-                    publisher['type'] = 'publisher'
-                    return publisher
-            return None
+            # SQL query to get public-facing publisher details
+            sql = "SELECT name, email, phone, address, description, image_path FROM publishers WHERE publisher_id = :id"
+            cursor.execute(sql, id=publisher_id)
+            data = _fetch_as_dict(cursor)
+            return data[0] if data else None
     except cx_Oracle.Error as e:
-        print(f"Database error in verify_publisher_login: {e}")
+        print(f"Database error in get_publisher_details: {e}")
         return None
     finally:
         if conn:
             conn.close()
 
-def get_publisher_details(publisher_id):
-    """Fetches public details for a single publisher by their ID."""
-    conn = get_db_connection()
+def get_publisher_ids_changed_since(since):
+    """
+    Returns the ids of the publishers changed at or after `since` (a datetime),
+    or None if the query failed. Their names are shown on their books.
+    """
+    conn = get_db_connection(READ)
     if not conn:
         return None
     try:
         with conn.cursor() as cursor:
-            # SQL query to get public-facing publisher details
-            sql = "SELECT name, email, phone, address, description, image_path FROM publishers WHERE publisher_id = :id"
-            cursor.execute(sql, id=publisher_id)
-            data = _fetch_as_dict(cursor)
-            return data[0] if data else None
+            # SQL query using the updated_at index (migration 006)
+            cursor.execute("SELECT publisher_id FROM publishers WHERE updated_at >= :since", since=since)
+            return [row[0] for row in cursor.fetchall()]
     except cx_Oracle.Error as e:
-        print(f"Database error in get_publisher_details: {e}")
+        print(f"Database error in get_publisher_ids_changed_since: {e}")
         return None
     finally:
         if conn:
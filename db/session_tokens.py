@@ -0,0 +1,271 @@
+# db/session_tokens.py
+# Optional signed session tokens that can be verified without a database lookup.
+#
+# Signed mode is turned on by pointing the SESSION_KEYS_FILE environment variable
+# at a key file. Each non-empty line holds "<key_id> <secret>". The first line is
+# the key used to sign new tokens; the others are still accepted, so a key can be
+# rotated by adding a new first line and removing the old one once its tokens have
+# expired. The file is re-read when it changes, without restarting the servers.
+#
+# A token looks like "s1.<key_id>.<payload>.<signature>", where the payload holds
+# the entity type, entity id, issue time, expiry time and a random token id.
+
+import base64
+import datetime
+import hashlib
+import hmac
+import os
+import threading
+import time
+import uuid
+import cx_Oracle
+from db.connection import get_db_connection, WRITE, PRIMARY
+
+TOKEN_PREFIX = "s1."
+ENTITY_TYPES = ('user', 'publisher', 'admin')
+KEYS_FILE = os.environ.get("SESSION_KEYS_FILE")
+
+# How often (in seconds) the key file and the revocation list are checked for changes
+KEYS_CHECK_INTERVAL = 5
+REVOCATIONS_REFRESH_INTERVAL = 30
+
+# Tokens can never live longer than this, which bounds how long revocations are kept
+MAX_TOKEN_LIFETIME_MINUTES = 24 * 60
+
+_lock = threading.Lock()
+_keys = {'mtime': None, 'checked': 0, 'signing': None, 'all': {}}
+# Revocation list: single revoked token ids, and per-entity "not before" times.
+# 'pending' holds revocations that could not be saved yet; they are saved again
+# on the next refresh.
+_revocations = {'loaded': 0, 'tokens': {}, 'entities': {}, 'pending': []}
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _load_keys():
+    """Reads the key file again if it has changed since the last check."""
+    now = time.time()
+    if now - _keys['checked'] < KEYS_CHECK_INTERVAL:
+        return
+    _keys['checked'] = now
+    try:
+        mtime = os.path.getmtime(KEYS_FILE)
+        if mtime == _keys['mtime']:
+            return
+        keys = []
+        with open(KEYS_FILE, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and not parts[0].startswith('#'):
+                    keys.append((parts[0], parts[1].encode('utf-8')))
+    except OSError as e:
+        print(f"Could not read session keys file: {e}")
+        return
+    if not keys:
+        print("Session keys file has no keys; signed tokens are disabled.")
+    with _lock:
+        _keys['mtime'] = mtime
+        _keys['signing'] = keys[0] if keys else None
+        _keys['all'] = dict(keys)
+
+def signed_tokens_enabled():
+    """Returns True if signed session tokens are configured."""
+    if not KEYS_FILE:
+        return False
+    _load_keys()
+    return _keys['signing'] is not None
+
+def _sign(secret, message):
+    return _b64encode(hmac.new(secret, message.encode('ascii'), hashlib.sha256).digest())
+
+def issue_signed_token(entity_id, entity_type, expiry_minutes=60):
+    """Creates a signed token for the entity. Returns None if signed mode is off."""
+    if entity_type not in ENTITY_TYPES or not signed_tokens_enabled():
+        return None
+    key_id, secret = _keys['signing']
+    issued_at = int(time.time())
+    expires_at = issued_at + min(expiry_minutes, MAX_TOKEN_LIFETIME_MINUTES) * 60
+    payload = f"{entity_type}:{int(entity_id)}:{issued_at}:{expires_at}:{uuid.uuid4().hex}"
+    message = f"{TOKEN_PREFIX}{key_id}.{_b64encode(payload.encode('ascii'))}"
+    return f"{message}.{_sign(secret, message)}"
+
+def is_signed_token(token):
+    """Returns True if the token uses the signed format (legacy tokens are plain letters)."""
+    return token.startswith(TOKEN_PREFIX)
+
+def _decode_token(token):
+    """
+    Checks the signature of a signed token and returns its claims as a dictionary,
+    or None if the token is malformed or the signature does not match.
+    Expiry and revocation are not checked here.
+    """
+    if not signed_tokens_enabled():
+        return None
+    try:
+        key_id, payload, signature = token[len(TOKEN_PREFIX):].split('.')
+        secret = _keys['all'].get(key_id)
+        if secret is None:
+            return None
+        message = f"{TOKEN_PREFIX}{key_id}.{payload}"
+        if not hmac.compare_digest(signature, _sign(secret, message)):
+            return None
+        entity_type, entity_id, issued_at, expires_at, token_id = _b64decode(payload).decode('ascii').split(':')
+        return {'type': entity_type, 'id': int(entity_id), 'iat': int(issued_at),
+                'exp': int(expires_at), 'jti': token_id}
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def verify_signed_token(token, entity_type):
+    """
+    Verifies a signed token for the given entity type without querying the entity table.
+    Returns a dictionary with the entity's id column (e.g. {'user_id': 5}) or None.
+    """
+    claims = _decode_token(token)
+    if not claims or claims['type'] != entity_type:
+        return None
+    if claims['exp'] <= time.time():
+        return None
+    _refresh_revocations()
+    if claims['jti'] in _revocations['tokens']:
+        return None
+    not_before = _revocations['entities'].get((entity_type, claims['id']))
+    if not_before is not None and claims['iat'] <= not_before:
+        return None
+    return {f"{entity_type}_id": claims['id']}
+
+def token_subject(token):
+    """
+    Returns (entity_type, entity_id) from a signed token with a good signature,
+    or None. Expiry and revocations are not checked, so this is only for telling
+    clients apart (e.g. for rate limits), never for authentication.
+    """
+    claims = _decode_token(token)
+    if not claims:
+        return None
+    return claims['type'], claims['id']
+
+# --- Revocation list ---
+
+def _prune_revocations(now):
+    """Forgets revocations whose tokens have expired anyway. Called with _lock held."""
+    for token_id, expires_at in list(_revocations['tokens'].items()):
+        if expires_at <= now:
+            del _revocations['tokens'][token_id]
+    for key, not_before in list(_revocations['entities'].items()):
+        if not_before + MAX_TOKEN_LIFETIME_MINUTES * 60 <= now:
+            del _revocations['entities'][key]
+
+def _retry_pending_saves():
+    """Saves again the revocations that could not be saved when they were made."""
+    with _lock:
+        pending = _revocations['pending']
+        _revocations['pending'] = []
+    failed = [revocation for revocation in pending
+              if revocation[4] > time.time() and not _save_revocation(*revocation)]
+    if failed:
+        with _lock:
+            _revocations['pending'].extend(failed)
+
+def _refresh_revocations(force=False):
+    """
+    Adds the unexpired revocations in the database to the ones in memory. This
+    runs at most once per REVOCATIONS_REFRESH_INTERVAL, so other processes'
+    logouts and deletions are picked up within that time without a query on
+    every request.
+
+    Rows are merged in rather than replacing the list: a revocation made here
+    whose save failed, or one committed while the query ran, is not in the rows
+    but must stay in force. Entries are only dropped once their tokens expire.
+    """
+    now = time.time()
+    if not force and now - _revocations['loaded'] < REVOCATIONS_REFRESH_INTERVAL:
+        return
+    _revocations['loaded'] = now
+    if _revocations['pending']:
+        _retry_pending_saves()
+    conn = get_db_connection(PRIMARY)
+    if not conn:
+        return
+    try:
+        with conn.cursor() as cursor:
+            sql = """
+                SELECT entity_type, entity_id, token_id, revoked_at, expires_at
+                FROM session_revocations WHERE expires_at > :now
+            """
+            cursor.execute(sql, now=datetime.datetime.now())
+            rows = cursor.fetchall()
+        with _lock:
+            tokens, entities = _revocations['tokens'], _revocations['entities']
+            for entity_type, entity_id, token_id, revoked_at, expires_at in rows:
+                if token_id:
+                    tokens[token_id] = max(tokens.get(token_id, 0), expires_at.timestamp())
+                else:
+                    key = (entity_type, int(entity_id))
+                    entities[key] = max(entities.get(key, 0), revoked_at.timestamp())
+            _prune_revocations(time.time())
+    except cx_Oracle.Error as e:
+        print(f"Database error in _refresh_revocations: {e}")
+    finally:
+        conn.close()
+
+def reload_revocations():
+    """Reloads the revocation list now, after another process revoked something."""
+    _refresh_revocations(force=True)
+
+def _save_revocation(entity_type, entity_id, token_id, revoked_at, expires_at):
+    """Stores one revocation so the other server processes see it too."""
+    conn = get_db_connection(WRITE)
+    if not conn:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            # Drop revocations for tokens that have expired anyway
+            cursor.execute("DELETE FROM session_revocations WHERE expires_at <= :now",
+                           now=datetime.datetime.now())
+            sql = """
+                INSERT INTO session_revocations (entity_type, entity_id, token_id, revoked_at, expires_at)
+                VALUES (:etype, :eid, :jti, :revoked_at, :expires_at)
+            """
+            cursor.execute(sql, etype=entity_type, eid=entity_id, jti=token_id,
+                           revoked_at=datetime.datetime.fromtimestamp(revoked_at),
+                           expires_at=datetime.datetime.fromtimestamp(expires_at))
+            conn.commit()
+            return True
+    except cx_Oracle.Error as e:
+        print(f"Database error in _save_revocation: {e}")
+        return False
+    finally:
+        conn.close()
+
+def _save_or_queue(entity_type, entity_id, token_id, revoked_at, expires_at):
+    """Saves a revocation, or keeps it to be saved again on the next refresh."""
+    if _save_revocation(entity_type, entity_id, token_id, revoked_at, expires_at):
+        return True
+    with _lock:
+        _revocations['pending'].append((entity_type, entity_id, token_id, revoked_at, expires_at))
+    return False
+
+def revoke_token(token):
+    """Revokes a single signed token (used on logout). Returns True if it was revoked."""
+    claims = _decode_token(token)
+    if not claims:
+        return False
+    with _lock:
+        _revocations['tokens'][claims['jti']] = claims['exp']
+    return _save_or_queue(claims['type'], claims['id'], claims['jti'], time.time(), claims['exp'])
+
+def revoke_entity_sessions(entity_type, entity_id):
+    """
+    Revokes every signed token issued so far to an entity (used when an admin
+    deletes an account). Does nothing if signed mode is off.
+    """
+    if not signed_tokens_enabled():
+        return False
+    now = time.time()
+    key = (entity_type, int(entity_id))
+    with _lock:
+        _revocations['entities'][key] = now
+    return _save_or_queue(entity_type, int(entity_id), None, now, now + MAX_TOKEN_LIFETIME_MINUTES * 60)
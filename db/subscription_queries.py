@@ -3,7 +3,11 @@
 
 import datetime
 import cx_Oracle
-from db.connection import get_db_connection, _fetch_as_dict
+from db.connection import get_db_connection, _fetch_as_dict, READ, WRITE
+from db.change_events import emit
+
+# SQL statement to record that a user's subscriptions changed (see db/export_queries.py)
+_TOUCH_USER_SQL = "UPDATE users SET updated_at = SYSTIMESTAMP WHERE user_id = :user_id"
 
 def get_user_active_subscriptions(user_id, conn_or_none=None):
     """
@@ -12,7 +16,7 @@ def get_user_active_subscriptions(user_id, conn_or_none=None):
     Can use an existing database connection for efficiency.
     """
     # Use the provided connection or establish a new one
-    conn = conn_or_none if conn_or_none else get_db_connection()
+    conn = conn_or_none if conn_or_none else get_db_connection(READ)
     if not conn:
         return {}
 
@@ -39,7 +43,7 @@ def check_user_subscription_for_book(user_id, book_id):
     Checks if a user has an active subscription for a specific book's category.
     Returns True if a valid subscription exists, otherwise False.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return False
     try:
@@ -66,7 +70,7 @@ def add_subscription_for_user(user_id, category_id, duration_days=30):
     """
     Adds a new subscription or extends an existing one for a user to a specific category.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
 
@@ -88,7 +92,11 @@ def add_subscription_for_user(user_id, category_id, duration_days=30):
                     VALUES (d.user_id, d.category_id, d.expiry_date)
             """
             cursor.execute(sql, user_id=user_id, cat_id=category_id, expiry=new_expiry_date)
+            # Subscriptions are exported with their user, so mark the user as changed
+            cursor.execute(_TOUCH_USER_SQL, user_id=user_id)
             conn.commit()
+            emit('subscriptions-changed', {'action': 'added', 'category_id': int(category_id),
+                                           'expiry_date': new_expiry_date.isoformat()}, user_id=int(user_id))
             return True
     except cx_Oracle.Error as e:
         print(f"Database error in add_subscription_for_user: {e}")
@@ -99,7 +107,7 @@ def add_subscription_for_user(user_id, category_id, duration_days=30):
 
 def remove_subscription_for_user(user_id, category_id):
     """Removes a specific subscription from a user's account."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
@@ -107,8 +115,15 @@ def remove_subscription_for_user(user_id, category_id):
             # SQL statement to delete a subscription
             sql = "DELETE FROM user_subscriptions WHERE user_id = :user_id AND category_id = :cat_id"
             cursor.execute(sql, user_id=user_id, cat_id=category_id)
+            removed = cursor.rowcount > 0
+            if removed:
+                # Subscriptions are exported with their user, so mark the user as changed
+                cursor.execute(_TOUCH_USER_SQL, user_id=user_id)
             conn.commit()
-            return cursor.rowcount > 0
+            if removed:
+                emit('subscriptions-changed', {'action': 'removed', 'category_id': int(category_id)},
+                     user_id=int(user_id))
+            return removed
     except cx_Oracle.Error as e:
         print(f"Database error in remove_subscription_for_user: {e}")
         return False
@@ -5,8 +5,8 @@ import datetime
 import random
 import string
 import cx_Oracle
-from db.connection import get_db_connection, _fetch_as_dict
-from db.subscription_queries import get_user_active_subscriptions
+from db.connection import get_db_connection, _fetch_as_dict, _tune_cursor, READ, WRITE, PRIMARY
+from db.session_tokens import issue_signed_token, signed_tokens_enabled
 
 def _generate_session_token(length=40):
     """Generates a random alphanumeric string to use as a session token."""
@@ -19,9 +19,13 @@ def set_session_token(entity_id, entity_type, expiry_minutes=60):
     """
     Sets a new session token for a given entity (user, publisher, or admin)
     and stores it in the database.
+    In signed token mode the token is self-contained and nothing is written.
     """
+    if signed_tokens_enabled():
+        return issue_signed_token(entity_id, entity_type, expiry_minutes)
+
     # Establish a database connection
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return None
 
@@ -60,7 +64,7 @@ def get_entity_by_token(token, entity_type):
     Retrieves an entity's data from the database using their session token.
     The token is only valid if it has not expired.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(PRIMARY)
     if not conn:
         return None
 
@@ -89,9 +93,37 @@ def get_entity_by_token(token, entity_type):
         if conn:
             conn.close()
 
+def clear_session_token(token, entity_type):
+    """Removes a stored session token so it can no longer be used (logout)."""
+    if entity_type == 'user':
+        table = 'users'
+    elif entity_type == 'publisher':
+        table = 'publishers'
+    elif entity_type == 'admin':
+        table = 'admins'
+    else:
+        return False  # Invalid entity type
+
+    conn = get_db_connection(WRITE)
+    if not conn:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            # SQL statement to clear the token and its expiry
+            sql = f"UPDATE {table} SET session_token = NULL, token_expiry = NULL WHERE session_token = :token"
+            cursor.execute(sql, token=token)
+            conn.commit()
+            return cursor.rowcount > 0
+    except cx_Oracle.Error as e:
+        print(f"Database error in clear_session_token for type {entity_type}: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
 def create_user(name, email, phone, password):
     """Inserts a new user record into the 'users' table."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return None
     try:
@@ -108,34 +140,66 @@ def create_user(name, email, phone, password):
         if conn:
             conn.close()
 
-def verify_user_login(email, password):
+# One query finds the account in either table and, for users, their active
+# subscriptions. A user account wins if the same login exists in both tables.
+_LOGIN_SQL = """
+    SELECT 1 AS account_rank, 'user' AS account_type, u.user_id AS entity_id, u.name, u.email,
+           us.category_id, us.expiry_date
+    FROM users u
+    LEFT JOIN user_subscriptions us ON us.user_id = u.user_id AND us.expiry_date >= :today
+    WHERE u.email = :email AND u.password = :password
+    UNION ALL
+    SELECT 2, 'publisher', p.publisher_id, p.name, p.email, NULL, NULL
+    FROM publishers p
+    WHERE p.email = :email AND p.password = :password
+    ORDER BY 1
+"""
+
+def verify_login(email, password):
     """
-    Verifies user credentials, fetches their active subscriptions, and returns user data
-    along with a new session token.
+    Verifies user or publisher credentials and returns the account data with a new
+    session token. Users also get their active subscriptions attached.
+    Everything happens on one connection in at most two round trips: the login
+    query, then the token update (which commits in the same call). In signed
+    token mode the second round trip is skipped.
     """
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return None
     try:
         with conn.cursor() as cursor:
-            # SQL query to find a user by email and password
-            sql = "SELECT user_id, name, email FROM users WHERE email = :email AND password = :password"
-            cursor.execute(sql, email=email, password=password)
-            user_data = _fetch_as_dict(cursor)
-
-            if user_data:
-                user = user_data[0]
-                # Generate a new session token for the user
-                token = set_session_token(user['user_id'], 'user')
-                if token:
-                    user['session_token'] = token
-                    user['type'] = 'user'
-                    # Fetch and attach the user's active subscriptions
-                    user['subscriptions'] = get_user_active_subscriptions(user['user_id'], conn)
-                    return user
-            return None
+            # A user with many subscriptions still comes back with the execute call
+            _tune_cursor(cursor, arraysize=100, prefetchrows=101)
+            cursor.execute(_LOGIN_SQL, email=email, password=password, today=datetime.date.today())
+            rows = cursor.fetchall()
+            if not rows:
+                return None
+
+            account_type, entity_id, name, account_email = rows[0][1:5]
+            account = {f"{account_type}_id": entity_id, 'name': name, 'email': account_email}
+
+            if signed_tokens_enabled():
+                token = issue_signed_token(entity_id, account_type)
+            else:
+                token = _generate_session_token()
+                expiry_time = datetime.datetime.now() + datetime.timedelta(minutes=60)
+                table = 'users' if account_type == 'user' else 'publishers'
+                # Autocommit lets the update and the commit share one round trip
+                conn.autocommit = True
+                sql = f"UPDATE {table} SET session_token = :token, token_expiry = :expiry WHERE {account_type}_id = :id"
+                cursor.execute(sql, token=token, expiry=expiry_time, id=entity_id)
+            if not token:
+                return None
+
+            account['session_token'] = token
+            account['type'] = account_type
+            if account_type == 'user':
+                # Rows without a category come from the LEFT JOIN of a user with no subscriptions
+                account['subscriptions'] = {row[5]: row[6] for row in rows
+                                            if row[1] == 'user' and row[5] is not None}
+            return account
     except cx_Oracle.Error as e:
-        print(f"Database error in verify_user_login: {e}")
+        print(f"Database error in verify_login: {e}")
         return None
     finally:
         if conn:
@@ -143,13 +207,13 @@ def verify_user_login(email, password):
 
 def update_user_profile(user_id, name, password):
     """Updates a user's name and password in the database."""
-    conn = get_db_connection()
+    conn = get_db_connection(WRITE)
     if not conn:
         return False
     try:
         with conn.cursor() as cursor:
             # SQL statement to update user details
-            sql = "UPDATE users SET name = :name, password = :password WHERE user_id = :user_id"
+            sql = "UPDATE users SET name = :name, password = :password, updated_at = SYSTIMESTAMP WHERE user_id = :user_id"
             cursor.execute(sql, name=name, password=password, user_id=user_id)
             conn.commit()
             # Return True if the update was successful
@@ -163,7 +227,7 @@ def update_user_profile(user_id, name, password):
 
 def get_user_by_id(user_id):
     """Fetches a single user's details, including their password, by user ID."""
-    conn = get_db_connection()
+    conn = get_db_connection(READ)
     if not conn:
         return None
     try:
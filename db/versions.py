@@ -0,0 +1,94 @@
+# db/versions.py
+# Version stamps for answering conditional GET requests (ETag / If-None-Match).
+#
+# A stamp is a short random string that is replaced whenever the data behind it
+# changes. The write functions in the db package bump the stamps they affect
+# after committing, and the GET handlers build an ETag from the stamps before
+# running any query, so a client that already has the current version gets a
+# 304 Not Modified without the database being touched.
+#
+# Stamps live in small files under VERSIONS_DIR so that the main server and the
+# admin server see each other's changes. A new stamp is written to a temporary
+# file and renamed into place, so a reader never sees a half-written stamp.
+# Changes made directly in the database (not through these functions) do not
+# bump anything; clients then see them once another write changes the stamp.
+#
+# An ETag is only sent with data that was actually read. Right after a bump a
+# read replica may not have the change yet, so the handlers read such data from
+# the primary (see changed_within), rather than pin the old rows under the new
+# stamp.
+
+import os
+import time
+import uuid
+
+VERSIONS_DIR = os.path.join("data", "versions")
+
+# Books, categories and publishers. Every book list shows category and publisher
+# names, so any of them changing invalidates all the book lists.
+CATALOG = 'catalog'
+
+def bookmarks_stamp_name(user_id):
+    return f"bookmarks-{int(user_id)}"
+
+def history_stamp_name(user_id):
+    return f"history-{int(user_id)}"
+
+def _stamp_path(name):
+    return os.path.join(VERSIONS_DIR, name)
+
+def bump(*names):
+    """Gives each named stamp a new value. Call after the change is committed."""
+    try:
+        os.makedirs(VERSIONS_DIR, exist_ok=True)
+        for name in names:
+            temp_path = _stamp_path(f"{name}.{uuid.uuid4().hex}.tmp")
+            with open(temp_path, 'w', encoding='ascii') as f:
+                f.write(uuid.uuid4().hex[:16])
+            os.replace(temp_path, _stamp_path(name))
+    except OSError as e:
+        print(f"Could not update version stamp: {e}")
+
+def current(name):
+    """Returns the current value of a stamp, creating it on first use."""
+    try:
+        with open(_stamp_path(name), encoding='ascii') as f:
+            stamp = f.read()
+        if stamp:
+            return stamp
+    except OSError:
+        pass
+    bump(name)
+    try:
+        with open(_stamp_path(name), encoding='ascii') as f:
+            return f.read()
+    except OSError:
+        # Without a stamp there is nothing to compare with, so never match
+        return uuid.uuid4().hex[:16]
+
+def changed_within(seconds, *names):
+    """True if any of the named stamps was bumped less than `seconds` ago."""
+    cutoff = time.time() - seconds
+    for name in names:
+        try:
+            if os.path.getmtime(_stamp_path(name)) > cutoff:
+                return True
+        except OSError:
+            pass
+    return False
+
+def make_etag(resource, *names):
+    """Returns a quoted ETag for a response built from the given stamps."""
+    return '"' + '.'.join([resource] + [current(name) for name in names]) + '"'
+
+def etag_matches(if_none_match, etag):
+    """Checks an If-None-Match header value against an ETag."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag or candidate == '*':
+            return True
+    return False
@@ -3,26 +3,58 @@
 
 import json
 import os
-from urllib.parse import urlparse
+import datetime
+from urllib.parse import urlparse, parse_qs
 
 # Import database functions
-from db.user_queries import get_entity_by_token
+from db.user_queries import get_entity_by_token, clear_session_token
+from db.session_tokens import is_signed_token, revoke_token, revoke_entity_sessions
 from db.admin_queries import (
-    verify_admin_login, get_all_users_for_admin, delete_user_by_admin,
-    get_all_publishers_for_admin, delete_publisher_by_admin,
+    verify_admin_login, stream_all_users_for_admin, delete_user_by_admin,
+    stream_all_publishers_for_admin, delete_publisher_by_admin,
     get_user_by_id_for_admin, update_user_by_admin,
     get_publisher_by_id_for_admin, update_publisher_by_admin
 )
-from db.book_queries import get_all_books, delete_book
+from db.book_queries import stream_all_books, delete_book
+from db.export_queries import EXPORTS, stream_export, get_export_watermark
 from db.category_queries import get_all_categories, add_category, delete_category
 from db.subscription_queries import add_subscription_for_user, remove_subscription_for_user
+from db.deadlines import read_stats as read_timeout_stats
+from services.janitor import queue_file_deletions, read_stats
+from services import invalidation
+from services.admission import HIGH, NORMAL, override_rate_limits
+from services import warmup
 
 # Constants
 UPLOADS_DIR = os.path.join("static", "uploads")
+# Time budget in seconds for admin requests (see db/deadlines.py). The streamed
+# listings and exports have none; each of their database calls is still limited.
+DEFAULT_BUDGET = 15
+UNBUDGETED_PATHS = ('/api/admin/users', '/api/admin/publishers', '/api/admin/books')
+UNBUDGETED_PREFIXES = ('/api/admin/export/',)
+
+# Rate limits per route as (requests per second, burst), per client address and
+# per admin (see services/admission.py)
+RATE_LIMITS = override_rate_limits({
+    '/api/admin/login': (0.2, 5),       # after five tries, one every five seconds
+    '/api/admin/export/': (0.2, 3),
+})
+
+def request_priority(command, path):
+    """Admin writes go ahead of everything else when the server is busy."""
+    return HIGH if command == 'POST' else NORMAL
+
+def request_budget(path):
+    """Returns the time budget in seconds for an admin request path, or None for no budget."""
+    path = urlparse(path).path
+    if path in UNBUDGETED_PATHS or path.startswith(UNBUDGETED_PREFIXES):
+        return None
+    return DEFAULT_BUDGET
 
 def handle_admin_get_request(handler):
     """Handles all GET requests for the admin server."""
-    path = urlparse(handler.path).path
+    parsed_path = urlparse(handler.path)
+    path = parsed_path.path
 
     if path.startswith('/api/admin/'):
         # Admin API routes require authentication
@@ -31,22 +63,28 @@ def handle_admin_get_request(handler):
             handler._send_response(401, {'error': 'Unauthorized: Admin access required'})
             return
 
-        if path.startswith('/api/admin/users/'):
+        if path.startswith('/api/admin/export/'):
+            handle_export(handler, path, parse_qs(parsed_path.query))
+        elif path.startswith('/api/admin/users/'):
             handle_get_user_by_id(handler, path)
         elif path.startswith('/api/admin/publishers/'):
             handle_get_publisher_by_id(handler, path)
         elif path == '/api/admin/users':
-            users = get_all_users_for_admin()
-            handler._send_response(200, users)
+            # Large listings are streamed to the client batch by batch
+            handler._send_json_stream(200, stream_all_users_for_admin())
         elif path == '/api/admin/publishers':
-            publishers = get_all_publishers_for_admin()
-            handler._send_response(200, publishers)
+            handler._send_json_stream(200, stream_all_publishers_for_admin())
         elif path == '/api/admin/books':
-            books = get_all_books()
-            handler._send_response(200, books)
+            handler._send_json_stream(200, stream_all_books())
         elif path == '/api/admin/categories':
             categories = get_all_categories()
             handler._send_response(200, categories)
+        elif path == '/api/admin/storage':
+            # How many uploads the janitor has deleted and how much space that freed
+            handler._send_response(200, read_stats())
+        elif path == '/api/admin/timeouts':
+            # How many requests ran out of time, per route (see db/deadlines.py)
+            handler._send_response(200, read_timeout_stats())
         else:
             handler._send_response(404, {'error': 'Admin API endpoint not found'})
 
@@ -54,6 +92,14 @@ def handle_admin_get_request(handler):
         # Serve static files for the admin panel
         handle_admin_static_files(handler, path)
 
+    elif path == '/healthz':
+        handler._send_response(200, warmup.health(), extra_headers={'Cache-Control': 'no-store'})
+
+    elif path == '/readyz':
+        # Ready once the session pools are open (see services/warmup.py)
+        ready, details = warmup.readiness()
+        handler._send_response(200 if ready else 503, details, extra_headers={'Cache-Control': 'no-store'})
+
     else:
         # Serve the main admin.html file
         serve_admin_index(handler)
@@ -72,6 +118,9 @@ def handle_admin_post_request(handler):
     if path == '/api/admin/login':
         handle_admin_login(handler, post_data)
         return
+    if path == '/api/admin/logout':
+        handle_admin_logout(handler, post_data)
+        return
 
     # All other POST routes require admin authentication
     admin = handler._get_auth_admin()
@@ -98,6 +147,39 @@ def handle_admin_post_request(handler):
 
 # --- GET Request Handlers ---
 
+def handle_export(handler, path, query):
+    """
+    Streams one dataset (users, publishers, books, bookmarks or history) as NDJSON
+    or CSV. With ?since=<ISO date or time> only rows changed since then are sent.
+    The X-Export-Started-At header gives the value to pass as `since` next time:
+    the database's time when the export started, less a safety overlap (see
+    db/export_queries.py), so some rows are sent again in the next export.
+    """
+    name = path.split('/')[-1]
+    if name not in EXPORTS:
+        handler._send_response(404, {'error': f"Unknown export; choose one of {', '.join(EXPORTS)}"})
+        return
+    export_format = query.get('format', ['ndjson'])[0]
+    if export_format not in ('ndjson', 'csv'):
+        handler._send_response(400, {'error': 'format must be ndjson or csv'})
+        return
+    since = None
+    if query.get('since', [''])[0]:
+        try:
+            since = datetime.datetime.fromisoformat(query['since'][0])
+        except ValueError:
+            handler._send_response(400, {'error': 'since must be an ISO 8601 date or time'})
+            return
+
+    # Taken before the query runs, so nothing changed during the export is missed next time
+    watermark = get_export_watermark()
+    stream = stream_export(name, since) if watermark is not None else None
+    if stream is None:
+        handler._send_response(500, {'error': 'Export could not be started'})
+        return
+    handler._send_export_stream(stream, export_format, f"{name}.{export_format}",
+                                {'X-Export-Started-At': watermark.isoformat(timespec='seconds')})
+
 def handle_get_user_by_id(handler, path):
     """Gets a single user's details for editing."""
     try:
@@ -160,6 +242,17 @@ def handle_admin_login(handler, post_data):
     else:
         handler._send_response(401, {'error': 'Invalid admin credentials'})
 
+def handle_admin_logout(handler, post_data):
+    """Ends the admin session that sent the request."""
+    token = handler._get_auth_token()
+    if token:
+        if is_signed_token(token):
+            revoke_token(token)
+            invalidation.publish('sessions')
+        else:
+            clear_session_token(token, 'admin')
+    handler._send_response(200, {'message': 'Logged out'})
+
 def handle_update_user(handler, post_data):
     """Updates user details from the admin panel."""
     success = update_user_by_admin(
@@ -199,19 +292,22 @@ def handle_remove_subscription(handler, post_data):
 def handle_delete_user(handler, post_data):
     """Deletes a user."""
     success = delete_user_by_admin(post_data.get('user_id'))
+    if success:
+        # Signed tokens stay valid until they expire unless revoked
+        revoke_entity_sessions('user', post_data.get('user_id'))
+        # The main servers drop the user's sessions now instead of at their next refresh
+        invalidation.publish('sessions')
     handler._send_response(200 if success else 400, {'success': success})
 
 def handle_delete_publisher(handler, post_data):
     """Deletes a publisher and their assets."""
     files_to_delete = delete_publisher_by_admin(post_data.get('publisher_id'))
     if files_to_delete:
-        if files_to_delete.get('publisher_images'):
-            for img in files_to_delete['publisher_images']:
-                if img:
-                    try:
-                        os.remove(os.path.join(UPLOADS_DIR, img))
-                    except OSError as e:
-                        print(f"Error deleting file {img}: {e}")
+        revoke_entity_sessions('publisher', post_data.get('publisher_id'))
+        invalidation.publish('sessions')
+        # The image, covers and PDFs are removed by the janitor in the main server
+        queue_file_deletions(files_to_delete['publisher_images'] + files_to_delete['covers']
+                             + files_to_delete['pdfs'])
         handler._send_response(200, {'success': True, 'message': 'Publisher and assets deleted'})
     else:
         handler._send_response(400, {'success': False})
@@ -230,6 +326,7 @@ def handle_admin_delete_book(handler, post_data):
     """Deletes a book from the admin panel."""
     file_paths = delete_book(post_data.get('book_id'))
     if file_paths:
+        queue_file_deletions([file_paths.get('cover_path'), file_paths.get('pdf_path')])
         handler._send_response(200, {'message': 'Book deleted'})
     else:
         handler._send_response(404, {'error': 'Book not found'})
@@ -0,0 +1,230 @@
+# handlers/base_handler.py
+# The request handler class both servers build on.
+#
+# server.py and admin_server.py answer requests the same way: JSON responses,
+# chunked streams, rate limits and admission control, time budgets, and breaking
+# off a response that fails after its headers went out. That is all here, once.
+# Each server's handler class subclasses BaseRequestHandler and only sets what
+# differs: its rate limits, how it ranks and budgets its routes, and its own
+# do_GET/do_POST and authentication.
+
+import datetime
+import http.server
+import json
+import socket
+import struct
+from urllib.parse import urlparse
+
+from db.connection import CompactRows, StreamInterrupted, begin_request
+from db.session_tokens import is_signed_token, token_subject
+from db.deadlines import DeadlineExceeded, expired, record_exceeded, start as start_deadline
+from services.admission import NORMAL, check_rate, try_admit, release
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    """Custom JSON encoder to handle datetime objects and nested CompactRows results."""
+    def default(self, obj):
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        if isinstance(obj, CompactRows):
+            return obj.to_dicts()
+        return super(DateTimeEncoder, self).default(obj)
+
+class BaseRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Response helpers and request dispatching shared by the servers' handlers.
+    Subclasses set rate_limits, request_priority and request_budget.
+    """
+
+    # HTTP/1.1 is needed for chunked transfer encoding. Every response still
+    # closes its connection; each connection gets its own thread.
+    protocol_version = 'HTTP/1.1'
+
+    # The server's RATE_LIMITS (see services/admission.py)
+    rate_limits = {}
+    # Methods allowed in answers to CORS pre-flight requests
+    cors_methods = 'GET, POST, OPTIONS'
+    # Set once a status line has been sent for the current request
+    response_started = False
+
+    @staticmethod
+    def request_priority(command, path):
+        """The priority class of a request (see services/admission.py)."""
+        return NORMAL
+
+    @staticmethod
+    def request_budget(path):
+        """The time budget in seconds for a request path, or None for no budget."""
+        return None
+
+    # --- HELPER METHODS ---
+
+    def send_response(self, code, message=None):
+        """Sends the status line, noting that the response has started."""
+        self.response_started = True
+        super().send_response(code, message)
+
+    def end_headers(self):
+        """Marks every response as the last one on its connection."""
+        self.send_header('Connection', 'close')
+        super().end_headers()
+
+    def _send_response(self, status_code, data, content_type='application/json', extra_headers=None):
+        """Helper to send a standardized HTTP response."""
+        if status_code < 400 and expired():
+            # A database call may have been cancelled, leaving the data incomplete
+            raise DeadlineExceeded("The request ran out of time")
+        if isinstance(data, CompactRows):
+            # Encode straight from the row tuples without building dicts
+            response_data = ''.join(data.iter_json(DateTimeEncoder())).encode('utf-8')
+        elif data is not None:
+            response_data = json.dumps(data, cls=DateTimeEncoder).encode('utf-8')
+        else:
+            response_data = b''
+        self.send_response(status_code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        if status_code == 304:
+            # Not Modified never has a body
+            self.end_headers()
+            return
+        self.send_header('Content-Length', str(len(response_data)))
+        self.end_headers()
+        self.wfile.write(response_data)
+
+    def _send_chunks(self, status_code, content_type, pieces, extra_headers=None):
+        """
+        Sends text pieces as they are produced, using chunked transfer encoding.
+        HTTP/1.0 clients do not understand chunks; they read until the connection closes.
+        """
+        chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(status_code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for piece in pieces:
+                data = piece.encode('utf-8')
+                if chunked:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                else:
+                    self.wfile.write(data)
+        except StreamInterrupted:
+            self._abort_response()
+            return
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _send_json_stream(self, status_code, stream):
+        """
+        Sends a RowStream as a JSON array, writing each batch of rows as soon as it
+        is fetched using chunked transfer encoding. A stream of None (the query could
+        not be started) is sent as an empty array.
+        """
+        if stream is None:
+            self._send_response(status_code, [])
+            return
+        try:
+            self._send_chunks(status_code, 'application/json', stream.iter_json(DateTimeEncoder()))
+        finally:
+            stream.close()
+
+    def _abort_response(self):
+        """
+        Breaks off a response whose headers are already sent: the connection is
+        reset without the closing chunk, so the client sees a failed download
+        rather than a complete-looking but short one.
+        """
+        self.close_connection = True
+        try:
+            # Linger 0 makes close() send a reset instead of a normal end of stream
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.connection.close()
+        except OSError:
+            pass
+
+    def _get_auth_token(self):
+        """Extracts the Bearer token from the Authorization header."""
+        auth_header = self.headers.get('Authorization')
+        if auth_header and auth_header.startswith('Bearer '):
+            return auth_header.split(' ')[1]
+        return None
+
+    # --- REQUEST DISPATCHING ---
+
+    def do_OPTIONS(self):
+        """Handle pre-flight CORS requests."""
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', self.cors_methods)
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.end_headers()
+
+    def _begin_request(self):
+        """
+        Starts a request's database bookkeeping: keyed by session so a client reads
+        its own writes, and with the time budget for its route.
+        """
+        begin_request(self._get_auth_token() or self.client_address[0])
+        start_deadline(urlparse(self.path).path, self.request_budget(self.path))
+
+    def _client_keys(self):
+        """
+        Names the client for rate limiting: its address, plus its user, publisher
+        or admin when it sends a signed token with a good signature. Other tokens
+        cannot be checked without the database, and keying on them would let
+        made-up tokens create buckets, so those clients go by address alone.
+        """
+        keys = ['ip:' + self.client_address[0]]
+        token = self._get_auth_token()
+        subject = token_subject(token) if token and is_signed_token(token) else None
+        if subject:
+            keys.append('%s:%s' % subject)
+        return keys
+
+    def _admit(self):
+        """
+        Sheds load before the body is read or the database is touched: 429 when the
+        client is over the route's rate limit, 503 when the server is too busy for
+        the request's priority class. Returns True if the request took a slot.
+        """
+        path = urlparse(self.path).path
+        wait = check_rate(path, self.rate_limits, self._client_keys())
+        if wait:
+            self._send_response(429, {'error': 'Too many requests, please slow down'},
+                                extra_headers={'Retry-After': str(int(wait) + 1)})
+            return False
+        if not try_admit(self.request_priority(self.command, self.path)):
+            self._send_response(503, {'error': 'The server is busy, please try again shortly'},
+                                extra_headers={'Retry-After': '1'})
+            return False
+        return True
+
+    def _dispatch(self, handle):
+        """
+        Runs a request handler, answering 503/504 if the request runs out of time.
+        If the response had already started, a second status line would only
+        garble it, so the connection is reset instead.
+        """
+        self.response_started = False
+        if not self._admit():
+            return
+        try:
+            self._begin_request()
+            handle(self)
+        except DeadlineExceeded as e:
+            print(f"Request {self.command} {urlparse(self.path).path} cancelled: {e}")
+            record_exceeded(e.status)
+            if self.response_started:
+                self._abort_response()
+            else:
+                headers = {'Retry-After': '5'} if e.status == 503 else None
+                self._send_response(e.status, {'error': str(e)}, extra_headers=headers)
+        finally:
+            release()
@@ -1,23 +1,113 @@
 # handlers/main_handler.py
 # Contains the request handling logic for the main server.
 
+import contextvars
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 
 # Import database functions
-from db.user_queries import (get_entity_by_token, verify_user_login, create_user,
-                             get_user_by_id, update_user_profile)
-from db.publisher_queries import verify_publisher_login, get_publisher_details, create_publisher
+from db.user_queries import (get_entity_by_token, verify_login, create_user,
+                             get_user_by_id, update_user_profile, clear_session_token)
+from db.session_tokens import is_signed_token, revoke_token
+from db.publisher_queries import get_publisher_details, create_publisher
 from db.book_queries import (get_all_books, get_books_by_publisher, get_book_pdf_path,
-                             add_book, update_book, delete_book)
+                             add_book, update_book, delete_book, get_books_by_ids, get_pdf_access)
 from db.category_queries import get_all_categories
 from db.subscription_queries import check_user_subscription_for_book, add_subscription_for_user
 from db.bookmark_queries import (get_user_bookmarks, add_bookmark, remove_bookmark,
                                  get_reading_history, add_to_reading_history)
+from db.connection import (CompactRows, PROBE_INTERVAL, READ_YOUR_WRITES_WINDOW, read_primary_for_request,
+                           seconds_since_database_contact)
+from db.deadlines import DeadlineExceeded, expired, record_exceeded
+from db.versions import (CATALOG, make_etag, etag_matches, changed_within, bookmarks_stamp_name,
+                         history_stamp_name)
+from services.recommendations import get_similar_books, record_interaction
+from services.trending import SORT_MODES, rank_rows, record_read, forget_book
+from services.catalog import browse, refresh_book, remove_book, get_books
+from services.search import fuzzy_search
+from services.fulltext import queue_book_pdf, forget_book_pdf, search_pdf_text
+from services.pdf_links import FILE_PATH_PREFIX, issue_pdf_link, verify_pdf_link
+from services.file_cache import get_file_view
+from services.janitor import queue_file_deletions
+from services.book_import import ArchiveError, start_import, get_import_job
+from services import event_stream, invalidation
+from services.admission import HIGH, NORMAL, LOW, route_setting, override_rate_limits
+from services.static_gzip import is_compressible, gzipped_version
+from services import warmup, snapshots
+from db.subscription_queries import get_user_active_subscriptions
 
 # Constants
-UPLOADS_DIR = os.path.join("static", "uploads")
+STATIC_DIR = "static"
+UPLOADS_DIR = os.path.join(STATIC_DIR, "uploads")
+MAX_FULLTEXT_RESULTS = 50
+MAX_PAGES_PER_BOOK = 20
+# Oracle allows 1000 values in an IN list, so longer id lists are read in parts
+MAX_BOOKS_PER_QUERY = 500
+# Files too big for the file cache are sent in pieces of this size
+FILE_CHUNK_SIZE = 64 * 1024
+# Time budget in seconds for each route (see db/deadlines.py). Other routes get
+# DEFAULT_BUDGET; None means no overall budget, for streams and uploads.
+DEFAULT_BUDGET = 10
+REQUEST_BUDGETS = {
+    '/api/categories': 3,
+    '/api/books': 5,
+    '/api/books/browse': 5,
+    '/api/search': 3,
+    '/api/batch': 8,
+    '/api/events': None,
+    '/api/books/import': None,
+    '/api/books/add': None,
+    '/api/books/update': None,
+    '/api/publisher/register': None,
+}
+# Rate limits per route as (requests per second, burst), applied to each client
+# address and each signed-in user or publisher (see services/admission.py).
+# Keys ending in '/' cover every path under them.
+RATE_LIMITS = override_rate_limits({
+    '/api/search': (5, 20),             # search-as-you-type sends one per keystroke
+    '/api/books': (5, 20),
+    '/api/books/browse': (5, 20),
+    '/api/books/fulltext': (1, 5),
+    '/api/login': (0.2, 5),             # after five tries, one every five seconds
+    '/api/user/register': (0.1, 3),
+    '/api/publisher/register': (0.1, 3),
+    '/api/books/read/': (1, 10),
+    '/api/books/read-link/': (1, 10),
+    FILE_PATH_PREFIX: (20, 100),        # PDF viewers fetch a book in many Range requests
+})
+# Priority class of each route for when the server is busy; the rest are NORMAL
+PRIORITIES = {
+    '/healthz': HIGH,
+    '/readyz': HIGH,
+    '/api/books/read/': HIGH,
+    '/api/books/read-link/': HIGH,
+    FILE_PATH_PREFIX: HIGH,
+    '/api/search': LOW,
+    '/api/books/browse': LOW,
+    '/api/books/fulltext': LOW,
+}
+# The last categories list read from the database: (categories, time read). It
+# is served, marked stale, while the database cannot be reached.
+_last_good_categories = {'value': None, 'time': 0}
+# Read-only JSON endpoints that may be combined into one /api/batch request
+BATCH_PATHS = ('/api/categories', '/api/books', '/api/books/publisher', '/api/books/browse',
+               '/api/books/recommendations', '/api/search', '/api/publisher-details',
+               '/api/user/bookmarks', '/api/user/history')
+MAX_BATCH_REQUESTS = 10
+BATCH_WORKERS = 4
+
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+
+def request_budget(path):
+    """Returns the time budget in seconds for a request path, or None for no budget."""
+    return REQUEST_BUDGETS.get(urlparse(path).path, DEFAULT_BUDGET)
+
+def request_priority(command, path):
+    """Returns the priority class of a request (see PRIORITIES)."""
+    return route_setting(urlparse(path).path, PRIORITIES, NORMAL)
 
 def handle_get_request(handler):
     """Handles all GET requests for the main server."""
@@ -29,10 +119,22 @@ def handle_get_request(handler):
         # API routes
         if path.startswith('/api/books/read/'):
             handle_read_book(handler, path)
+        elif path.startswith('/api/books/read-link/'):
+            handle_get_read_link(handler, path)
+        elif path.startswith('/api/books/import/'):
+            handle_get_import_job(handler, path)
         elif path == '/api/books':
             handle_get_all_books(handler, query)
         elif path == '/api/books/publisher':
             handle_get_publisher_books(handler)
+        elif path == '/api/search':
+            handle_fuzzy_search(handler, query)
+        elif path == '/api/books/fulltext':
+            handle_fulltext_search(handler, query)
+        elif path == '/api/books/browse':
+            handle_browse_books(handler, query)
+        elif path == '/api/books/recommendations':
+            handle_get_recommendations(handler, query)
         elif path == '/api/categories':
             handle_get_all_categories(handler)
         elif path == '/api/publisher-details':
@@ -41,11 +143,18 @@ def handle_get_request(handler):
             handle_get_user_bookmarks(handler)
         elif path == '/api/user/history':
             handle_get_user_history(handler)
+        elif path == '/api/events':
+            handle_event_stream(handler, query)
         else:
             handler._send_response(404, {'error': 'API endpoint not found'})
+    elif path.startswith(FILE_PATH_PREFIX):
+        # Serve a book PDF through a signed reading link
+        handle_pdf_file(handler, path, query)
     elif path.startswith('/static/'):
         # Serve static files
         handle_static_files(handler, path)
+    elif path in ('/healthz', '/readyz'):
+        handle_health_check(handler, path)
     else:
         # Serve the main index.html file
         serve_index(handler)
@@ -60,7 +169,10 @@ def handle_post_request(handler):
         handler._send_response(404, {'error': 'Endpoint not found'})
         return
 
-    if 'application/json' in content_type:
+    if path == '/api/books/import':
+        # The body is the archive itself, read as it arrives
+        handle_book_import(handler)
+    elif 'application/json' in content_type:
         handle_json_post(handler, path)
     elif 'multipart/form-data' in content_type:
         handle_multipart_post(handler, path)
@@ -88,38 +200,372 @@ def handle_read_book(handler, path):
             return
 
         pdf_full_path = os.path.join(UPLOADS_DIR, pdf_relative_path)
-        if os.path.exists(pdf_full_path):
-            handler.send_response(200)
-            handler.send_header('Content-type', 'application/pdf')
-            handler.end_headers()
-            with open(pdf_full_path, 'rb') as f:
-                handler.wfile.write(f.read())
-        else:
+        status = _send_file(handler, pdf_full_path, 'application/pdf')
+        if status == 200:
+            # Range requests fetch parts of a book already counted, so only whole reads count
+            record_read(book_id)
+        elif not status:
             handler._send_response(404, {'error': 'PDF file missing from server storage'})
 
     except (ValueError, IndexError):
         handler._send_response(400, {'error': 'Invalid book ID format'})
 
+def handle_get_read_link(handler, path):
+    """
+    Checks once that the user may read the book, then returns a short-lived
+    signed link to its PDF. Requests for the link need no database access.
+    """
+    user, user_type = handler._get_authenticated_entity()
+    if not (user and user_type == 'user'):
+        handler._send_response(401, {'error': 'Authentication required to read books'})
+        return
+    try:
+        book_id = int(path.split('/')[-1])
+    except ValueError:
+        handler._send_response(400, {'error': 'Invalid book ID format'})
+        return
+
+    access = get_pdf_access(user['user_id'], book_id)
+    if not access or not access[0]:
+        handler._send_response(404, {'error': 'PDF file not found for this book'})
+        return
+    pdf_relative_path, is_subscribed = access
+    if not is_subscribed:
+        handler._send_response(403, {'error': 'Subscription required for this category'})
+        return
+    url, expires_at = issue_pdf_link(user['user_id'], book_id, pdf_relative_path)
+    handler._send_response(200, {'url': url, 'expires_at': expires_at})
+
+def _parse_range(range_header, size):
+    """
+    Parses a single "bytes=start-end" Range header. Returns (start, end) with end
+    inclusive, or None if the range is malformed or outside the file.
+    """
+    if not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    start_text, _, end_text = range_header[len('bytes='):].strip().partition('-')
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            # "bytes=-500" means the last 500 bytes
+            start = max(0, size - int(end_text))
+            end = size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end:
+        return None
+    return start, end
+
+def _send_file(handler, filepath, content_type, cache_control=None, extra_headers=None):
+    """
+    Sends a file, honouring a Range header so PDF.js can fetch just the parts of a
+    document it needs. Files come from the memory-mapped file cache and are written
+    straight from the mapping; files too big for the cache are read from disk in
+    chunks. Returns the status sent (200, 206 or 416), or False, without sending
+    anything, if the file does not exist.
+    """
+    view = get_file_view(filepath)
+    f = None
+    if view is None:
+        try:
+            f = open(filepath, 'rb')
+        except OSError:
+            return False
+        size = os.fstat(f.fileno()).st_size
+    else:
+        size = len(view)
+
+    try:
+        start, end = 0, size - 1
+        range_header = handler.headers.get('Range')
+        if range_header:
+            byte_range = _parse_range(range_header, size)
+            if byte_range is None:
+                handler.send_response(416)
+                handler.send_header('Content-Range', f'bytes */{size}')
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return 416
+            start, end = byte_range
+            status = 206
+            handler.send_response(status)
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            status = 200
+            handler.send_response(status)
+        handler.send_header('Content-type', content_type)
+        handler.send_header('Content-Length', str(end - start + 1))
+        handler.send_header('Accept-Ranges', 'bytes')
+        if cache_control:
+            handler.send_header('Cache-Control', cache_control)
+        for name, value in (extra_headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+
+        if view is not None:
+            # A slice of the mapping is sent without copying the data
+            handler.wfile.write(view[start:end + 1])
+            return status
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            handler.wfile.write(chunk)
+            remaining -= len(chunk)
+        return status
+    finally:
+        if f:
+            f.close()
+        if view is not None:
+            # Lets the mapping close if the cache dropped it meanwhile
+            view.release()
+
+def handle_pdf_file(handler, path, query):
+    """Serves a book PDF after checking only the signature and expiry of its link."""
+    try:
+        book_id = int(path[len(FILE_PATH_PREFIX):])
+    except ValueError:
+        handler._send_response(400, {'error': 'Invalid book ID format'})
+        return
+    link = verify_pdf_link(book_id, query.get('t', [''])[0])
+    if not link:
+        handler._send_response(403, {'error': 'This reading link is invalid or has expired'})
+        return
+    pdf_full_path = os.path.join(UPLOADS_DIR, link['pdf_path'])
+    # The link itself is the permission, so only the reader's own browser may cache it
+    max_age = max(0, int(link['expires_at'] - time.time()))
+    if not _send_file(handler, pdf_full_path, 'application/pdf', f'private, max-age={max_age}'):
+        handler._send_response(404, {'error': 'PDF file missing from server storage'})
+
 def handle_get_all_books(handler, query):
     """Handles requests to get all books with optional filters."""
     search_term = query.get('search', [''])[0]
     category_id = query.get('category_id', [None])[0]
+    sort = query.get('sort', [''])[0]
     books = get_all_books(search_term=search_term, category_id=category_id)
-    handler._send_response(200, books)
+    stale_age = None
+    if not isinstance(books, CompactRows):
+        # The database could not be read; answer from the last catalog it gave us
+        books = _books_from_catalog(search_term, category_id)
+        if books is None:
+            _send_unavailable(handler)
+            return
+        stale_age = seconds_since_database_contact()
+    if search_term and not books and not category_id:
+        # Nothing contains the exact text; fall back to typo-tolerant matches
+        books = _fuzzy_matching_books(search_term) or books
+    if sort in SORT_MODES and books:
+        # Put the most read books first; the rest keep the database order
+        books = CompactRows(books.columns, rank_rows(books.rows, sort, books.columns.index('book_id')))
+    if stale_age is None:
+        handler._send_response(200, books)
+    else:
+        handler._send_response(200, books, extra_headers=_stale_headers(stale_age))
+
+def _books_from_catalog(search_term, category_id):
+    """
+    Runs the /api/books filters against the in-memory catalog instead of the
+    database. Returns CompactRows, or None if the catalog was never loaded.
+    """
+    filters = {}
+    try:
+        if category_id and int(category_id) > 0:
+            filters['category'] = [int(category_id)]
+    except (ValueError, TypeError):
+        pass  # Ignore invalid category IDs, like the database query does
+    result = browse(filters, search_term=search_term)
+    return result[0] if result else None
+
+def _stale_headers(age):
+    """
+    Headers for data served from memory because the database is unreachable.
+    X-Stale-Age says how many seconds old it may be.
+    """
+    headers = {'Cache-Control': 'no-store', 'Warning': '110 - "Response is Stale"'}
+    if age is not None:
+        headers['X-Stale-Age'] = str(int(age))
+    return headers
+
+def _send_unavailable(handler):
+    """Tells the client the database is down and there is no earlier copy to give it."""
+    if expired():
+        # The database is not down; the query was cancelled for taking too long
+        raise DeadlineExceeded("The request ran out of time")
+    handler._send_response(503, {'error': 'The service is temporarily unavailable, please try again shortly'},
+                           extra_headers={'Retry-After': str(PROBE_INTERVAL)})
+
+def _fuzzy_matching_books(search_term, limit=20):
+    """
+    Returns catalog rows for books whose title, author or publisher is a near
+    match for the search term, best title matches first.
+    """
+    matches = fuzzy_search(search_term, limit)
+    book_ids = [book['book_id'] for book in matches['books']]
+    for facet, values in (('author', [a['name'] for a in matches['authors']]),
+                          ('publisher', [p['publisher_id'] for p in matches['publishers']])):
+        if values:
+            result = browse({facet: values})
+            if result:
+                rows = result[0]
+                id_index = rows.columns.index('book_id')
+                book_ids.extend(row[id_index] for row in rows.rows)
+    # Remove duplicates but keep the order
+    return get_books(list(dict.fromkeys(book_ids)))
+
+def handle_fuzzy_search(handler, query):
+    """Handles typo-tolerant search over titles, authors and publishers."""
+    term = query.get('q', [''])[0]
+    try:
+        limit = max(1, min(int(query.get('limit', ['10'])[0]), 50))
+    except ValueError:
+        limit = 10
+    handler._send_response(200, fuzzy_search(term, limit))
+
+def handle_fulltext_search(handler, query):
+    """
+    Handles search inside the book PDFs. Like reading a book, this needs a logged
+    in user, and only books in categories they are subscribed to are returned.
+    """
+    user, user_type = handler._get_authenticated_entity()
+    if not (user and user_type == 'user'):
+        handler._send_response(401, {'error': 'Authentication required to search inside books'})
+        return
+    term = query.get('q', [''])[0].strip()
+    if not term:
+        handler._send_response(400, {'error': 'A search term is required'})
+        return
+
+    matches = search_pdf_text(term)
+    if not matches:
+        handler._send_response(200, [])
+        return
+    # One query for the user's subscriptions instead of one check per book
+    subscribed = get_user_active_subscriptions(user['user_id'])
+    pages = dict(matches)
+    # Every match is checked against the subscriptions before the list is cut,
+    # so books the user may read are never crowded out by ones they may not
+    books = get_books(list(pages))
+    if books is not None:
+        books = list(books)
+    else:
+        book_ids = list(pages)
+        books = []
+        for start in range(0, len(book_ids), MAX_BOOKS_PER_QUERY):
+            books.extend(get_books_by_ids(book_ids[start:start + MAX_BOOKS_PER_QUERY]))
+    results = []
+    for book in books:
+        if book['category_id'] in subscribed:
+            book['pages'] = pages[book['book_id']][:MAX_PAGES_PER_BOOK]
+            book['matching_page_count'] = len(pages[book['book_id']])
+            results.append(book)
+            if len(results) == MAX_FULLTEXT_RESULTS:
+                break
+    handler._send_response(200, results)
+
+def _send_if_changed(handler, etag, load, stamps=(CATALOG,)):
+    """
+    Sends the result of load() with an ETag, or a 304 without calling load() at
+    all when the client's If-None-Match shows it already has this version.
+    `stamps` are the version stamps the ETag was built from. The ETag is only
+    sent with rows that were really read: if load() failed the client gets a 503
+    without one, so it never keeps an empty list as the current version.
+    """
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'Authorization'}
+    if etag_matches(handler.headers.get('If-None-Match'), etag):
+        handler._send_response(304, None, extra_headers=headers)
+        return
+    if changed_within(READ_YOUR_WRITES_WINDOW, *stamps):
+        # A replica may not have the change behind the new stamp yet
+        read_primary_for_request()
+    result = load()
+    if isinstance(result, CompactRows):
+        handler._send_response(200, result, extra_headers=headers)
+    else:
+        _send_unavailable(handler)
 
 def handle_get_publisher_books(handler):
     """Handles requests to get books by a specific publisher."""
     pub, pub_type = handler._get_authenticated_entity()
     if pub and pub_type == 'publisher':
-        books = get_books_by_publisher(pub['publisher_id'])
-        handler._send_response(200, books)
+        pub_id = pub['publisher_id']
+        etag = make_etag(f"publisher-books-{int(pub_id)}", CATALOG)
+        _send_if_changed(handler, etag, lambda: get_books_by_publisher(pub_id))
     else:
         handler._send_response(401, {'error': 'Unauthorized'})
 
+def _query_list(query, name):
+    """Returns every value of a query parameter, allowing both ?a=1&a=2 and ?a=1,2."""
+    values = []
+    for value in query.get(name, []):
+        values.extend(v for v in value.split(',') if v)
+    return values
+
+def handle_browse_books(handler, query):
+    """
+    Handles faceted browsing: several categories, publishers and authors can be
+    selected at once, optionally limited to the user's subscribed categories.
+    Returns the matching books plus the book count for each facet value.
+    """
+    filters = {
+        'category': _query_list(query, 'category_id'),
+        'publisher': _query_list(query, 'publisher_id'),
+        'author': _query_list(query, 'author'),
+    }
+    subscribed_categories = None
+    if query.get('subscribed', [''])[0] == '1':
+        user, user_type = handler._get_authenticated_entity()
+        if not (user and user_type == 'user'):
+            handler._send_response(401, {'error': 'Log in to filter by your subscriptions'})
+            return
+        subscribed_categories = list(get_user_active_subscriptions(user['user_id']))
+
+    result = browse(filters, subscribed_categories, query.get('search', [''])[0])
+    if result is None:
+        handler._send_response(503, {'error': 'Catalog is still loading, please try again'})
+        return
+    books, facets = result
+    handler._send_response(200, {'books': books, 'facets': facets})
+
+def handle_get_recommendations(handler, query):
+    """Handles "readers also read" requests for a book."""
+    try:
+        book_id = int(query.get('book_id', [None])[0])
+        limit = max(1, min(int(query.get('limit', ['10'])[0]), 50))
+    except (TypeError, ValueError):
+        handler._send_response(400, {'error': 'A valid book_id is required'})
+        return
+    similar = get_similar_books(book_id, limit)
+    books = get_books_by_ids([other_id for other_id, score in similar])
+    scores = dict(similar)
+    for book in books:
+        book['score'] = scores[book['book_id']]
+    handler._send_response(200, books)
+
 def handle_get_all_categories(handler):
-    """Handles requests to get all book categories."""
+    """
+    Handles requests to get all book categories. While the database is down, the
+    last list read from it is sent instead, without an ETag so the client does
+    not keep it once the database is back.
+    """
+    etag = make_etag('categories', CATALOG)
+    if etag_matches(handler.headers.get('If-None-Match'), etag):
+        _send_if_changed(handler, etag, get_all_categories)
+        return
     categories = get_all_categories()
-    handler._send_response(200, categories)
+    if isinstance(categories, CompactRows):
+        _last_good_categories['value'] = categories
+        _last_good_categories['time'] = time.time()
+        _send_if_changed(handler, etag, lambda: categories)
+    elif _last_good_categories['value'] is not None:
+        age = time.time() - _last_good_categories['time']
+        handler._send_response(200, _last_good_categories['value'], extra_headers=_stale_headers(age))
+    else:
+        _send_unavailable(handler)
 
 def handle_get_publisher_details(handler, query):
     """Handles requests to get details for a specific publisher."""
@@ -134,8 +580,10 @@ def handle_get_user_bookmarks(handler):
     """Handles requests to get a user's bookmarked books."""
     user, user_type = handler._get_authenticated_entity()
     if user and user_type == 'user':
-        bookmarks = get_user_bookmarks(user['user_id'])
-        handler._send_response(200, bookmarks)
+        user_id = user['user_id']
+        stamp = bookmarks_stamp_name(user_id)
+        _send_if_changed(handler, make_etag(stamp, CATALOG, stamp), lambda: get_user_bookmarks(user_id),
+                         (stamp, CATALOG))
     else:
         handler._send_response(401, {'error': 'Unauthorized'})
 
@@ -143,37 +591,126 @@ def handle_get_user_history(handler):
     """Handles requests to get a user's reading history."""
     user, user_type = handler._get_authenticated_entity()
     if user and user_type == 'user':
-        history = get_reading_history(user['user_id'])
-        handler._send_response(200, history)
+        user_id = user['user_id']
+        stamp = history_stamp_name(user_id)
+        _send_if_changed(handler, make_etag(stamp, CATALOG, stamp), lambda: get_reading_history(user_id),
+                         (stamp, CATALOG))
     else:
         handler._send_response(401, {'error': 'Unauthorized'})
 
+def handle_event_stream(handler, query):
+    """
+    Opens a server-sent event stream of catalog changes. EventSource cannot send
+    an Authorization header, so a logged in user passes ?token= to also receive
+    changes to their own subscriptions. The connection is then handed to the
+    event hub and this request thread moves on.
+    """
+    user_id = None
+    token = query.get('token', [''])[0]
+    if token:
+        user, user_type = handler._get_authenticated_entity(token)
+        if not user:
+            handler._send_response(401, {'error': 'Invalid or expired session'})
+            return
+        if user_type == 'user':
+            user_id = user['user_id']
+    if not event_stream.can_subscribe():
+        handler._send_response(503, {'error': 'Too many open event streams, please try again later'},
+                               extra_headers={'Retry-After': '30'})
+        return
+    last_event_id = handler.headers.get('Last-Event-ID') or query.get('lastEventId', [''])[0]
+
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/event-stream')
+    handler.send_header('Cache-Control', 'no-cache')
+    handler.send_header('Access-Control-Allow-Origin', '*')
+    handler.end_headers()
+    handler.wfile.flush()
+    event_stream.subscribe(handler.connection, user_id, last_event_id)
+
 def handle_static_files(handler, path):
     """Handles serving static files."""
-    filepath = path.lstrip('/')
-    normalized_path = os.path.normpath(filepath).replace('\\', '/')
+    filepath = os.path.normpath(path.lstrip('/'))
+    normalized_path = filepath.replace('\\', '/')
+
+    # Only files under static/ are served; "/static/../data/..." must not reach data/
+    static_root = os.path.abspath(STATIC_DIR)
+    if os.path.commonpath([os.path.abspath(filepath), static_root]) != static_root:
+        handler._send_response(404, {'error': 'File not found'})
+        return
 
     if 'uploads/pdfs' in normalized_path:
         handler._send_response(403, {'error': 'Direct access to PDF files is forbidden'})
         return
 
-    if os.path.exists(filepath) and not os.path.isdir(filepath):
-        mime_type = 'text/plain'
-        if filepath.endswith('.html'): mime_type = 'text/html'
-        elif filepath.endswith('.css'): mime_type = 'text/css'
-        elif filepath.endswith(('.js', '.mjs')): mime_type = 'application/javascript'
-        elif filepath.endswith(('.png', '.jpg', '.jpeg', '.gif')):
-            ext = filepath.split('.')[-1]
-            mime_type = f'image/{ext}'
-
-        handler.send_response(200)
-        handler.send_header('Content-type', mime_type)
-        handler.end_headers()
-        with open(filepath, 'rb') as f:
-            handler.wfile.write(f.read())
-    else:
+    mime_type = 'text/plain'
+    if filepath.endswith('.html'): mime_type = 'text/html'
+    elif filepath.endswith('.css'): mime_type = 'text/css'
+    elif filepath.endswith(('.js', '.mjs')): mime_type = 'application/javascript'
+    elif filepath.endswith(('.png', '.jpg', '.jpeg', '.gif')):
+        ext = filepath.split('.')[-1]
+        mime_type = f'image/{ext}'
+
+    headers = None
+    if is_compressible(filepath) and not os.path.isdir(filepath):
+        headers = {'Vary': 'Accept-Encoding'}
+        # Send the copy gzipped at startup if the browser takes it (not for ranges of it)
+        gzipped = gzipped_version(filepath)
+        if gzipped and 'gzip' in handler.headers.get('Accept-Encoding', '') and not handler.headers.get('Range'):
+            filepath = gzipped
+            headers['Content-Encoding'] = 'gzip'
+
+    if os.path.isdir(filepath) or not _send_file(handler, filepath, mime_type, extra_headers=headers):
         handler._send_response(404, {'error': 'File not found'})
 
+def handle_health_check(handler, path):
+    """
+    Handles /healthz (is the process alive) and /readyz (has it finished warming
+    up), see services/warmup.py.
+    """
+    headers = {'Cache-Control': 'no-store'}
+    if path == '/healthz':
+        handler._send_response(200, warmup.health(), extra_headers=headers)
+        return
+    ready, details = warmup.readiness()
+    handler._send_response(200 if ready else 503, details, extra_headers=headers)
+
+def preload_categories():
+    """
+    Reads the categories once at startup, so the database has the query ready and
+    there is a last known good list from the start. Returns True if it worked.
+    """
+    categories = get_all_categories()
+    if not isinstance(categories, CompactRows):
+        return False
+    _last_good_categories['value'] = categories
+    _last_good_categories['time'] = time.time()
+    return True
+
+def _categories_snapshot():
+    """The categories' section of the read-model snapshots, or None before they are read."""
+    categories = _last_good_categories['value']
+    if categories is None:
+        return None
+    value = {'columns': tuple(categories.columns), 'rows': list(categories.rows)}
+    return value, {'as_of': _last_good_categories['time']}
+
+def restore_categories():
+    """
+    Takes the last known good categories from the snapshot, so they can be served
+    even if the database is down when the server starts, and saves them in later
+    snapshots. Returns True if there were any.
+    """
+    snapshots.register('categories', _categories_snapshot)
+    saved = snapshots.load('categories')
+    if saved is None:
+        return False
+    value, watermark = saved
+    if _last_good_categories['value'] is None:
+        _last_good_categories['value'] = CompactRows(value['columns'], value['rows'])
+        _last_good_categories['time'] = watermark['as_of']
+    return True
+
 def serve_index(handler):
     """Serves the main index.html file."""
     try:
@@ -194,6 +731,8 @@ def handle_json_post(handler, path):
 
     if path == '/api/login':
         handle_login(handler, post_data)
+    elif path == '/api/logout':
+        handle_logout(handler, post_data)
     elif path == '/api/user/register':
         handle_user_register(handler, post_data)
     elif path == '/api/user/profile':
@@ -204,25 +743,101 @@ def handle_json_post(handler, path):
         handle_book_delete(handler, post_data)
     elif path in ['/api/user/bookmarks/add', '/api/user/bookmarks/remove', '/api/user/history/add']:
         handle_bookmark_and_history(handler, path, post_data)
+    elif path == '/api/batch':
+        handle_batch(handler, post_data)
     else:
         handler._send_response(404, {'error': 'API endpoint not found for JSON POST'})
 
+class _BatchSubRequest:
+    """
+    Stands in for the request handler while one part of a batch runs. It answers
+    with the caller's identity, which was looked up once for the whole batch, and
+    keeps the response instead of writing it to the socket. It has no headers of
+    its own, so a part is never answered with 304 Not Modified.
+    """
+
+    def __init__(self, path, auth):
+        self.path = path
+        self.headers = {}
+        self.auth = auth
+        self.status = 500
+        self.body = {'error': 'No response'}
+
+    def _get_authenticated_entity(self, token=None):
+        return self.auth
+
+    def _send_response(self, status_code, data, content_type='application/json', extra_headers=None):
+        self.status = status_code
+        self.body = data
+
+def _run_batch_part(sub_request):
+    try:
+        handle_get_request(sub_request)
+        if expired() and sub_request.status < 400:
+            raise DeadlineExceeded("The request ran out of time")
+    except DeadlineExceeded as e:
+        record_exceeded(e.status)
+        sub_request._send_response(e.status, {'error': str(e)})
+    except Exception as e:
+        print(f"Error in batch request {sub_request.path}: {e}")
+        sub_request._send_response(500, {'error': 'Internal server error'})
+    return {'status': sub_request.status, 'body': sub_request.body}
+
+def handle_batch(handler, post_data):
+    """
+    Handles several GET requests sent together, e.g. everything the first page
+    needs. Body: {"requests": [{"id": "books", "path": "/api/books?sort=popular"}, ...]}.
+    The caller is authenticated once, the parts run at the same time on pooled
+    database connections, and the reply maps each id to {"status", "body"}.
+    """
+    parts = post_data.get('requests')
+    if not isinstance(parts, list) or not parts:
+        handler._send_response(400, {'error': 'A list of requests is required'})
+        return
+    if len(parts) > MAX_BATCH_REQUESTS:
+        handler._send_response(400, {'error': f'At most {MAX_BATCH_REQUESTS} requests per batch'})
+        return
+
+    auth = None
+    futures = {}
+    responses = {}
+    for index, part in enumerate(parts):
+        part_id = str(part.get('id', index)) if isinstance(part, dict) else str(index)
+        path = part.get('path', '') if isinstance(part, dict) else ''
+        if not isinstance(path, str) or urlparse(path).path not in BATCH_PATHS:
+            responses[part_id] = {'status': 400, 'body': {'error': 'This path cannot be batched'}}
+            continue
+        if auth is None:
+            auth = handler._get_authenticated_entity()
+        sub_request = _BatchSubRequest(path, auth)
+        # Each part carries the request's context, so its reads still see the request's writes
+        context = contextvars.copy_context()
+        futures[part_id] = _batch_executor.submit(context.run, _run_batch_part, sub_request)
+    for part_id, future in futures.items():
+        responses[part_id] = future.result()
+    handler._send_response(200, {'responses': responses})
+
 def handle_login(handler, post_data):
     """Handles user and publisher login."""
     email = post_data.get('email')
     password = post_data.get('password')
 
-    user_data = verify_user_login(email, password)
-    if user_data:
-        handler._send_response(200, user_data)
-        return
-
-    pub_data = verify_publisher_login(email, password)
-    if pub_data:
-        handler._send_response(200, pub_data)
-        return
+    account = verify_login(email, password)
+    if account:
+        handler._send_response(200, account)
+    else:
+        handler._send_response(401, {'error': 'Invalid credentials'})
 
-    handler._send_response(401, {'error': 'Invalid credentials'})
+def handle_logout(handler, post_data):
+    """Ends the user or publisher session that sent the request."""
+    token = handler._get_auth_token()
+    if token:
+        if is_signed_token(token):
+            revoke_token(token)
+            invalidation.publish('sessions')
+        elif not clear_session_token(token, 'user'):
+            clear_session_token(token, 'publisher')
+    handler._send_response(200, {'message': 'Logged out'})
 
 def handle_user_register(handler, post_data):
     """Handles new user registration."""
@@ -272,12 +887,11 @@ def handle_book_delete(handler, post_data):
         book_id = post_data.get('book_id')
         file_paths = delete_book(book_id)
         if file_paths:
-            if file_paths.get('cover_path'):
-                cover_file = os.path.join(UPLOADS_DIR, file_paths['cover_path'])
-                if os.path.exists(cover_file): os.remove(cover_file)
-            if file_paths.get('pdf_path'):
-                pdf_file = os.path.join(UPLOADS_DIR, file_paths['pdf_path'])
-                if os.path.exists(pdf_file): os.remove(pdf_file)
+            forget_book(book_id)
+            remove_book(book_id)
+            forget_book_pdf(book_id)
+            # The files are removed by the janitor, off the request thread
+            queue_file_deletions([file_paths.get('cover_path'), file_paths.get('pdf_path')])
             handler._send_response(200, {'message': 'Book deleted'})
         else:
             handler._send_response(404, {'error': 'Book not found or failed to delete'})
@@ -290,11 +904,14 @@ def handle_bookmark_and_history(handler, path, post_data):
     if user and user_type == 'user':
         book_id = post_data.get('book_id')
         if path == '/api/user/bookmarks/add':
-            add_bookmark(user['user_id'], book_id)
+            if add_bookmark(user['user_id'], book_id):
+                record_interaction(user['user_id'], book_id)
         elif path == '/api/user/bookmarks/remove':
             remove_bookmark(user['user_id'], book_id)
         elif path == '/api/user/history/add':
-            add_to_reading_history(user['user_id'], book_id)
+            if add_to_reading_history(user['user_id'], book_id):
+                record_interaction(user['user_id'], book_id)
+                record_read(book_id)
         handler._send_response(200, {'message': 'Action successful'})
     else:
         handler._send_response(401, {'error': 'Unauthorized'})
@@ -333,18 +950,61 @@ def handle_book_add(handler, form_data, file_paths):
         cover_path_for_db = file_paths.get('cover')
         pdf_file = file_paths.get('pdf')
 
-        success = add_book(
+        new_book_id = add_book(
             form_data.get('name'), form_data.get('author_name'),
             form_data.get('description'), form_data.get('category_id'),
             cover_path_for_db, pdf_file, pub['publisher_id']
         )
-        if success:
+        if new_book_id:
+            refresh_book(new_book_id)
+            if pdf_file:
+                # Text extraction runs on worker processes; this returns at once
+                queue_book_pdf(new_book_id, pdf_file)
             handler._send_response(201, {'message': 'Book added'})
         else:
             handler._send_response(400, {'error': 'Failed to add book'})
     else:
         handler._send_response(401, {'error': 'Unauthorized'})
 
+def handle_book_import(handler):
+    """
+    Handles a bulk import: the request body is a zip or tar archive with a
+    manifest plus the covers and PDFs. Replies 202 with a job whose progress can
+    be followed at /api/books/import/<job_id>.
+    """
+    pub, pub_type = handler._get_authenticated_entity()
+    if not (pub and pub_type == 'publisher'):
+        handler._send_response(401, {'error': 'Unauthorized'})
+        return
+    try:
+        content_length = int(handler.headers.get('Content-Length', ''))
+    except ValueError:
+        handler._send_response(411, {'error': 'Content-Length is required'})
+        return
+    try:
+        job = start_import(pub['publisher_id'], handler.rfile, content_length,
+                           handler.headers.get('Content-Type', ''))
+    except ArchiveError as e:
+        handler._send_response(400, {'error': str(e)})
+        return
+    except OSError as e:
+        print(f"Book import could not be staged: {e}")
+        handler._send_response(500, {'error': 'Could not store the archive'})
+        return
+    handler._send_response(202, job)
+
+def handle_get_import_job(handler, path):
+    """Handles progress requests for a bulk import started by the publisher."""
+    pub, pub_type = handler._get_authenticated_entity()
+    if not (pub and pub_type == 'publisher'):
+        handler._send_response(401, {'error': 'Unauthorized'})
+        return
+    job = get_import_job(path.split('/')[-1], pub['publisher_id'])
+    if job:
+        handler._send_response(200, job)
+    else:
+        handler._send_response(404, {'error': 'Import job not found'})
+
 def handle_book_update(handler, form_data, file_paths):
     """Handles updating an existing book."""
     pub, pub_type = handler._get_authenticated_entity()
@@ -358,6 +1018,11 @@ def handle_book_update(handler, form_data, file_paths):
             form_data.get('category_id'), cover_path
         )
         if success:
+            refresh_book(form_data.get('book_id'))
+            existing_cover = form_data.get('existing_cover_path')
+            if new_cover_file and existing_cover and existing_cover != new_cover_file:
+                # The old cover is no longer used by the book
+                queue_file_deletions([existing_cover])
             handler._send_response(200, {'message': 'Book updated'})
         else:
             handler._send_response(400, {'error': 'Failed to update book'})
@@ -1,62 +1,67 @@
 # server.py
 # Main server for the application, now refactored to use request handlers.
 
-import http.server
 import socketserver
-import json
 import os
-import cgi
-from urllib.parse import urlparse
-import datetime
+import uuid
 
 # Import the new database and handler modules
+from db.connection import start_replica_health_checks, warm_pools
 from db.user_queries import get_entity_by_token
-from handlers.main_handler import handle_get_request, handle_post_request
+from db.session_tokens import is_signed_token, verify_signed_token
+from handlers.base_handler import BaseRequestHandler
+from handlers.main_handler import (handle_get_request, handle_post_request, request_budget,
+                                   request_priority, RATE_LIMITS, preload_categories, restore_categories)
+from services.recommendations import start_background_rebuild
+from services.trending import start_background_snapshots
+from services.catalog import start_background_reload, wait_until_loaded, reload as reload_catalog
+from services.fulltext import start_background_indexing
+from services.file_cache import invalidate_file
+from services.janitor import start_janitor
+from services.event_stream import start_event_stream, owns_socket
+from services.invalidation import start_bus
+from services.static_gzip import precompress_static
+from services.snapshots import start_snapshot_writer, save as save_snapshots
+from services.warmup import start_warm_up
 
 # Define server constants
-PORT = 8000
+PORT = int(os.environ.get("PORT", "8000"))
+# How long one warm-up attempt waits for the catalog's first load
+CATALOG_WARM_UP_WAIT = 60
 STATIC_DIR = "static"
 UPLOADS_DIR = os.path.join(STATIC_DIR, "uploads")
 
 
-class DateTimeEncoder(json.JSONEncoder):
-    """Custom JSON encoder to handle datetime objects."""
-    def default(self, obj):
-        if isinstance(obj, (datetime.datetime, datetime.date)):
-            return obj.isoformat()
-        return super(DateTimeEncoder, self).default(obj)
-
-class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+class SimpleHTTPRequestHandler(BaseRequestHandler):
     """
     Handles HTTP requests by dispatching them to the appropriate
     functions in the main_handler module.
     """
 
+    rate_limits = RATE_LIMITS
+    cors_methods = 'GET, POST, PUT, DELETE, OPTIONS'
+    request_priority = staticmethod(request_priority)
+    request_budget = staticmethod(request_budget)
+
     # --- HELPER METHODS ---
 
-    def _send_response(self, status_code, data, content_type='application/json'):
-        """Helper to send a standardized HTTP response."""
-        self.send_response(status_code)
-        self.send_header('Content-type', content_type)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        if data is not None:
-            response_data = json.dumps(data, cls=DateTimeEncoder).encode('utf-8')
-            self.wfile.write(response_data)
-
-    def _get_auth_token(self):
-        """Extracts the Bearer token from the Authorization header."""
-        auth_header = self.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            return auth_header.split(' ')[1]
-        return None
-
-    def _get_authenticated_entity(self):
-        """Validates the token and returns the authenticated user or publisher."""
-        token = self._get_auth_token()
+    def _get_authenticated_entity(self, token=None):
+        """
+        Validates the token and returns the authenticated user or publisher. The
+        token comes from the Authorization header unless one is passed in.
+        """
+        token = token or self._get_auth_token()
         if not token:
             return None, None
-        
+
+        if is_signed_token(token):
+            # Signed tokens are checked in memory, without a database lookup
+            for entity_type in ('user', 'publisher'):
+                entity = verify_signed_token(token, entity_type)
+                if entity:
+                    return entity, entity_type
+            return None, None
+
         user = get_entity_by_token(token, 'user')
         if user:
             return user, 'user'
@@ -73,6 +78,8 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             'content-type': self.headers['content-type'],
             'content-length': self.headers['content-length'],
         }
+        # Imported here: cgi is slow to import and only needed for uploads
+        import cgi
         form = cgi.FieldStorage(
             fp=self.rfile,
             headers=headers,
@@ -100,10 +107,18 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
                 else:
                     continue
 
+                # A unique prefix keeps two uploads called e.g. cover.png apart, so
+                # deleting or replacing one book never touches another book's file
+                filename = f"{uuid.uuid4().hex[:12]}_{filename}"
                 filepath = os.path.join(save_dir, filename)
-                
-                with open(filepath, 'wb') as f:
+
+                # Written beside the target and renamed into place, so a file the
+                # cache has mapped is never truncated under it
+                temp_path = f"{filepath}.{os.getpid()}.tmp"
+                with open(temp_path, 'wb') as f:
                     f.write(file_item.file.read())
+                os.replace(temp_path, filepath)
+                invalidate_file(filepath)
                 
                 # Store the relative path for database insertion
                 file_paths[key] = os.path.join(os.path.basename(save_dir), filename).replace("\\", "/")
@@ -112,21 +127,31 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
 
     # --- HTTP METHOD HANDLERS (Now simplified) ---
 
-    def do_OPTIONS(self):
-        """Handle pre-flight CORS requests."""
-        self.send_response(204)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-        self.end_headers()
-
     def do_GET(self):
         """Dispatches GET requests to the main handler."""
-        handle_get_request(self)
+        self._dispatch(handle_get_request)
 
     def do_POST(self):
         """Dispatches POST requests to the main handler."""
-        handle_post_request(self)
+        self._dispatch(handle_post_request)
+
+
+class AppServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    TCPServer that handles each connection on its own thread, so a slow PDF read
+    does not hold up everyone else (services/admission.py caps how many run at
+    once), and leaves the connections handed to the event hub open.
+    """
+
+    daemon_threads = True
+
+    # Browsers reconnect their event streams all at once after a restart
+    request_queue_size = 128
+
+    def shutdown_request(self, request):
+        if owns_socket(request):
+            return
+        super().shutdown_request(request)
 
 
 # --- Main Execution Block ---
@@ -135,11 +160,38 @@ if __name__ == "__main__":
     os.makedirs(os.path.join(UPLOADS_DIR, "covers"), exist_ok=True)
     os.makedirs(os.path.join(UPLOADS_DIR, "pdfs"), exist_ok=True)
 
-    with socketserver.TCPServer(("", PORT), SimpleHTTPRequestHandler) as httpd:
+    # Load the catalog, the "readers also read" model and the book rankings in the
+    # background; the first two start from the read-model snapshot if there is one
+    restore_categories()
+    start_background_reload()
+    start_background_rebuild()
+    start_background_snapshots()
+    start_snapshot_writer()
+    # Index the text of any PDFs uploaded since the last run
+    start_background_indexing()
+    # Delete queued and orphaned uploads off the request thread
+    start_janitor()
+    # Push change events to browsers connected to /api/events
+    start_event_stream()
+    # Hear about changes made by the other server processes
+    start_bus()
+    # Take failing read replicas out of the rotation (if DB_READ_DSNS is set)
+    start_replica_health_checks()
+    # Get warm before /readyz lets users in; requests are answered meanwhile
+    start_warm_up([
+        ('database', warm_pools),
+        ('categories', preload_categories),
+        # The background loader only tries every few minutes, so try again here if it failed
+        ('catalog', lambda: wait_until_loaded(CATALOG_WARM_UP_WAIT) or reload_catalog()),
+        ('static', precompress_static),
+    ])
+
+    with AppServer(("", PORT), SimpleHTTPRequestHandler) as httpd:
         print(f"Serving at port {PORT}")
         print(f"Access the application at http://localhost:{PORT}")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nStopping server...")
+            save_snapshots()
             httpd.shutdown()
\ No newline at end of file
@@ -0,0 +1,3 @@
+# This file makes the 'services' directory a Python package.
+# Services keep in-memory read models (built from the db package) that the
+# request handlers can answer from without a database round trip.
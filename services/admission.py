@@ -0,0 +1,182 @@
+# services/admission.py
+# Rate limiting and admission control, checked before a request reads its body
+# or touches the database.
+#
+# Rate limits are token buckets. A route's rule gives a rate (requests per
+# second, refilled continuously) and a burst (how many may come at once). Every
+# request to a limited route takes a token from the bucket of its client
+# address and, if it is signed in, from the bucket of its user, publisher or
+# admin as well; with either bucket empty it is refused with 429 Too Many
+# Requests. Each server lists its rules in its handler module (RATE_LIMITS).
+# The RATE_LIMITS environment variable changes them without editing the code,
+# e.g. RATE_LIMITS="/api/login=50:100,/api/search=off" for a load test run from
+# one machine, where every client shares one address.
+#
+# Admission control caps how many requests a server works on at once. Requests
+# come in priority classes: when the server gets busy, LOW requests (search) are
+# turned away first, then NORMAL ones, while HIGH requests (PDF reads, admin
+# writes) may use every slot. A request turned away gets 503 with Retry-After.
+# Each server lists the classes of its routes in its handler module (PRIORITIES).
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+HIGH = 'high'
+NORMAL = 'normal'
+LOW = 'low'
+
+MAX_ACTIVE_REQUESTS = int(os.environ.get("MAX_ACTIVE_REQUESTS", "32"))
+# The share of MAX_ACTIVE_REQUESTS each class may fill
+PRIORITY_SHARES = {HIGH: 1.0, NORMAL: 0.75, LOW: 0.5}
+
+# Past this many buckets the least recently used are forgotten
+MAX_BUCKETS = 10000
+
+def _matching_route(path, table):
+    """
+    Returns the key of a per-route table that applies to a path, or None. Keys
+    ending in '/' match every path under them; an exact match wins over a prefix,
+    and a longer prefix over a shorter one.
+    """
+    if path in table:
+        return path
+    best = None
+    for key in table:
+        if key.endswith('/') and path.startswith(key) and (best is None or len(key) > len(best)):
+            best = key
+    return best
+
+def route_setting(path, table, default=None):
+    """Looks up a path in a per-route table (see _matching_route)."""
+    route = _matching_route(path, table)
+    return table[route] if route is not None else default
+
+def override_rate_limits(rules):
+    """
+    Returns a server's RATE_LIMITS with the rules in the RATE_LIMITS environment
+    variable applied: comma-separated "route=rate:burst", or "route=off" to lift
+    a route's limit. Entries that cannot be read are reported and skipped.
+    """
+    rules = dict(rules)
+    for entry in os.environ.get("RATE_LIMITS", "").split(","):
+        if not entry.strip():
+            continue
+        try:
+            route, rule = entry.strip().rsplit("=", 1)
+            if rule == "off":
+                rules.pop(route, None)
+                continue
+            rate, burst = rule.split(":")
+            if float(rate) <= 0 or int(burst) < 1:
+                raise ValueError("the rate and burst must be positive")
+            rules[route] = (float(rate), int(burst))
+        except ValueError as e:
+            print(f"Ignoring rate limit override {entry!r}: {e}")
+    return rules
+
+class TokenBucket:
+    """Holds up to `burst` tokens and gains `rate` tokens a second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """Takes a token. Returns 0 if there was one, else the seconds until there will be."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """Token buckets per (route, client key), at most max_buckets of them."""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.buckets = OrderedDict()    # least recently used first
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+
+    def check(self, route, rule, keys):
+        """
+        Charges one request to the bucket of each key (e.g. 'ip:1.2.3.4',
+        'user:7'). Returns 0 if it is allowed, else the seconds to wait. Nothing
+        is taken from any bucket when the request is refused, and a refused
+        request adds no buckets.
+        """
+        rate, burst = rule
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            for key in keys:
+                bucket = self.buckets.get((route, key))
+                if bucket is None:
+                    # A new bucket is full, so it is only stored once a token is taken
+                    bucket = TokenBucket(rate, burst)
+                buckets.append(((route, key), bucket))
+            wait = 0
+            for name, bucket in buckets:
+                bucket._refill(now)
+                if bucket.tokens < 1:
+                    wait = max(wait, (1 - bucket.tokens) / bucket.rate)
+            if wait:
+                return wait
+            for name, bucket in buckets:
+                bucket.take(now)
+                self.buckets[name] = bucket
+                self.buckets.move_to_end(name)
+            # Forget the least recently used buckets; they are the likeliest to be full again
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+            return 0
+
+class AdmissionGate:
+    """Counts the requests being worked on and turns away those over their class's share."""
+
+    def __init__(self, max_active=MAX_ACTIVE_REQUESTS, shares=PRIORITY_SHARES):
+        self.limits = {priority: max(1, int(max_active * share)) for priority, share in shares.items()}
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def try_enter(self, priority):
+        with self.lock:
+            if self.active >= self.limits.get(priority, self.limits[NORMAL]):
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+# --- Shared limiters used by the server ---
+
+_rate_limiter = RateLimiter()
+_gate = AdmissionGate()
+
+def check_rate(path, rules, keys):
+    """
+    Applies the path's rate limit (from a server's RATE_LIMITS) to the given
+    client keys. Returns 0 if the request may go ahead, else the seconds to wait.
+    """
+    route = _matching_route(path, rules)
+    if route is None:
+        return 0
+    # Keyed by the rule's route, so all the paths under a prefix share a bucket
+    return _rate_limiter.check(route, rules[route], keys)
+
+def try_admit(priority):
+    """Takes a request slot for a request of this class. False means shed it."""
+    return _gate.try_enter(priority)
+
+def release():
+    """Gives back a slot taken with try_admit()."""
+    _gate.leave()
@@ -0,0 +1,332 @@
+# services/book_import.py
+# Bulk import of many books at once from an archive.
+#
+# A publisher uploads one .zip or .tar(.gz) archive holding a manifest
+# (manifest.csv or manifest.json) plus the cover images and PDFs it names. The
+# manifest has one row per book with the columns:
+#
+#   name, author_name, description, category_id, cover, pdf
+#
+# where cover and pdf are file names inside the archive (cover is optional).
+#
+# The archive is extracted while the request body is read, into a staging folder,
+# without holding whole files in memory. The rest runs on a background thread:
+# rows are checked and their files moved into static/uploads on a small thread
+# pool, and the books are inserted IMPORT_BATCH_SIZE at a time with one
+# executemany each. A bad row is reported and skipped without undoing the rest.
+# Progress can be polled with get_import_job().
+
+import csv
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from db.book_queries import add_books_bulk
+from services import catalog
+from services.fulltext import queue_book_pdf
+from services.janitor import queue_file_deletions
+
+UPLOADS_DIR = os.path.join("static", "uploads")
+STAGING_DIR = os.path.join("data", "imports")
+
+IMPORT_BATCH_SIZE = 100
+IMPORT_WORKERS = 4
+COPY_CHUNK_SIZE = 1024 * 1024
+MAX_ARCHIVE_BYTES = 2 * 1024 * 1024 * 1024
+# Extracted files may add up to at most this much, whatever the archive claims
+MAX_EXTRACTED_BYTES = 4 * 1024 * 1024 * 1024
+# Finished jobs are kept this long so their results can still be read
+JOB_RETENTION = 24 * 60 * 60
+MAX_REPORTED_ERRORS = 200
+
+ZIP_TYPES = ('application/zip', 'application/x-zip-compressed')
+TAR_TYPES = ('application/x-tar', 'application/gzip', 'application/x-gzip', 'application/x-gtar')
+COVER_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+class ArchiveError(Exception):
+    """The uploaded archive or its manifest cannot be used."""
+
+class _BodyReader:
+    """A file-like object that reads at most `length` bytes of a request body."""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+def _copy_limited(source, target_path, budget):
+    """Copies a file object to target_path in chunks. Returns the bytes written."""
+    written = 0
+    with open(target_path, 'wb') as target:
+        while True:
+            chunk = source.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > budget:
+                raise ArchiveError("The archive expands to more than the allowed size")
+            target.write(chunk)
+    return written
+
+def _staged_name(member_name):
+    """Returns the file name a member is staged under, or None for folders and hidden files."""
+    name = os.path.basename(member_name.replace('\\', '/'))
+    if not name or name.startswith('.'):
+        return None
+    return name
+
+def extract_archive(body, content_type, staging_dir):
+    """
+    Extracts an archive from the request body into staging_dir, flattening folders.
+    Tar archives are extracted as they stream in; zip archives keep their index at
+    the end, so they are first spooled to a temporary file.
+    """
+    # Imported here, so they are only loaded once someone imports books
+    import tarfile
+    import zipfile
+    os.makedirs(staging_dir, exist_ok=True)
+    budget = MAX_EXTRACTED_BYTES
+    if content_type in TAR_TYPES:
+        try:
+            with tarfile.open(fileobj=body, mode='r|*') as archive:
+                for member in archive:
+                    name = _staged_name(member.name)
+                    if not member.isfile() or name is None:
+                        continue
+                    budget -= _copy_limited(archive.extractfile(member), os.path.join(staging_dir, name), budget)
+        except tarfile.TarError as e:
+            raise ArchiveError(f"Not a valid tar archive: {e}")
+    elif content_type in ZIP_TYPES:
+        spool_path = os.path.join(staging_dir, '.upload.zip')
+        _copy_limited(body, spool_path, MAX_ARCHIVE_BYTES)
+        try:
+            with zipfile.ZipFile(spool_path) as archive:
+                for member in archive.infolist():
+                    name = _staged_name(member.filename)
+                    if member.is_dir() or name is None:
+                        continue
+                    with archive.open(member) as source:
+                        budget -= _copy_limited(source, os.path.join(staging_dir, name), budget)
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f"Not a valid zip archive: {e}")
+        finally:
+            os.remove(spool_path)
+    else:
+        raise ArchiveError("Send the archive as application/zip or application/x-tar (optionally gzipped)")
+
+def read_manifest(staging_dir):
+    """Returns the manifest rows as a list of dictionaries."""
+    json_path = os.path.join(staging_dir, 'manifest.json')
+    csv_path = os.path.join(staging_dir, 'manifest.csv')
+    try:
+        if os.path.exists(json_path):
+            with open(json_path, encoding='utf-8') as f:
+                rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows.get('books', [])
+        elif os.path.exists(csv_path):
+            with open(csv_path, encoding='utf-8-sig', newline='') as f:
+                rows = list(csv.DictReader(f))
+        else:
+            raise ArchiveError("The archive has no manifest.csv or manifest.json")
+    except (OSError, ValueError, csv.Error) as e:
+        raise ArchiveError(f"The manifest could not be read: {e}")
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ArchiveError("The manifest must be a list of books")
+    if not rows:
+        raise ArchiveError("The manifest lists no books")
+    return rows
+
+# --- Import jobs ---
+
+_jobs = {}
+_lock = threading.Lock()
+
+def _update(job, **changes):
+    with _lock:
+        job.update(changes)
+
+def _add_errors(job, errors):
+    with _lock:
+        job['failed'] += len(errors)
+        room = MAX_REPORTED_ERRORS - len(job['errors'])
+        job['errors'].extend(errors[:max(0, room)])
+
+def _text(row, key):
+    value = row.get(key)
+    return str(value).strip() if value is not None else ''
+
+def _place_file(staging_dir, file_name, folder, job_id, number, uses):
+    """
+    Moves (or copies, if another row uses it too) a staged file into the uploads
+    folder under a name that cannot clash with existing uploads or other rows, so
+    deleting one book never removes another book's file. Returns the path to
+    store in the database.
+    """
+    target_name = f"{job_id[:8]}_{number}_{file_name}"
+    source = os.path.join(staging_dir, file_name)
+    target = os.path.join(UPLOADS_DIR, folder, target_name)
+    # Put beside the target first and renamed into place, so no file the file
+    # cache may have mapped is ever written over in place
+    temp_path = f"{target}.{os.getpid()}.tmp"
+    if uses.get(file_name, 0) > 1:
+        shutil.copyfile(source, temp_path)
+    else:
+        shutil.move(source, temp_path)
+    os.replace(temp_path, target)
+    return f"{folder}/{target_name}"
+
+def _prepare_row(job_id, staging_dir, uses, number, row):
+    """
+    Checks one manifest row and moves its files into place.
+    Returns (book, None) with the values to insert, or (None, error message).
+    """
+    name = _text(row, 'name')
+    if not name:
+        return None, "name is required"
+    try:
+        category_id = int(_text(row, 'category_id'))
+    except ValueError:
+        return None, "category_id must be a number"
+
+    pdf_name = _staged_name(_text(row, 'pdf'))
+    if not pdf_name or not pdf_name.lower().endswith('.pdf'):
+        return None, "pdf must name a .pdf file in the archive"
+    try:
+        with open(os.path.join(staging_dir, pdf_name), 'rb') as f:
+            if f.read(5) != b'%PDF-':
+                return None, f"{pdf_name} is not a PDF file"
+    except OSError:
+        return None, f"{pdf_name} is not in the archive"
+
+    cover_name = _staged_name(_text(row, 'cover'))
+    if cover_name:
+        if not cover_name.lower().endswith(COVER_EXTENSIONS):
+            return None, "cover must be a .png, .jpg or .gif image"
+        if not os.path.exists(os.path.join(staging_dir, cover_name)):
+            return None, f"{cover_name} is not in the archive"
+
+    try:
+        pdf_path = _place_file(staging_dir, pdf_name, 'pdfs', job_id, number, uses)
+        cover_path = _place_file(staging_dir, cover_name, 'covers', job_id, number, uses) if cover_name else None
+    except OSError as e:
+        return None, f"Could not store the files: {e}"
+    book = {'name': name, 'author_name': _text(row, 'author_name'), 'description': _text(row, 'description'),
+            'category_id': category_id, 'cover_path': cover_path, 'pdf_path': pdf_path}
+    return book, None
+
+def _insert_batch(job, publisher_id, batch):
+    """Inserts a batch of prepared (row number, book) pairs and records the outcome."""
+    results = add_books_bulk([book for number, book in batch], publisher_id)
+    if results is None:
+        results = [(None, "Database error")] * len(batch)
+    imported, errors, leftover_files = [], [], []
+    for (number, book), (book_id, error) in zip(batch, results):
+        if book_id is None:
+            errors.append({'row': number, 'error': error})
+            leftover_files.extend([book['cover_path'], book['pdf_path']])
+        else:
+            imported.append((book_id, book['pdf_path']))
+    # Files of rows the database refused are not referenced by anything
+    queue_file_deletions(leftover_files)
+    for book_id, pdf_path in imported:
+        queue_book_pdf(book_id, pdf_path)
+    _add_errors(job, errors)
+    with _lock:
+        job['imported'] += len(imported)
+        job['book_ids'].extend(book_id for book_id, pdf_path in imported)
+
+def _run_job(job, publisher_id, staging_dir, rows):
+    """Checks, stores and inserts every manifest row (runs on its own thread)."""
+    job_id = job['job_id']
+    uses = {}
+    for row in rows:
+        for key in ('pdf', 'cover'):
+            file_name = _staged_name(_text(row, key))
+            if file_name:
+                uses[file_name] = uses.get(file_name, 0) + 1
+    try:
+        batch = []
+        with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+            # map() hands results back in manifest order while later rows are still being prepared
+            prepared = pool.map(lambda item: _prepare_row(job_id, staging_dir, uses, *item),
+                                enumerate(rows, 1))
+            for number, (book, error) in enumerate(prepared, 1):
+                if error:
+                    _add_errors(job, [{'row': number, 'error': error}])
+                else:
+                    batch.append((number, book))
+                if len(batch) == IMPORT_BATCH_SIZE:
+                    _insert_batch(job, publisher_id, batch)
+                    batch = []
+                _update(job, processed=number)
+        if batch:
+            _insert_batch(job, publisher_id, batch)
+        # One catalog reload instead of refreshing every new book separately
+        if job['imported']:
+            catalog.reload()
+        _update(job, status='done', finished_at=time.time())
+    except Exception as e:
+        print(f"Book import {job_id} failed: {e}")
+        _update(job, status='failed', error=str(e), finished_at=time.time())
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def _forget_old_jobs():
+    cutoff = time.time() - JOB_RETENTION
+    with _lock:
+        for job_id in [job_id for job_id, job in _jobs.items() if job.get('finished_at', time.time()) < cutoff]:
+            del _jobs[job_id]
+
+def start_import(publisher_id, body, content_length, content_type):
+    """
+    Extracts an uploaded archive and starts importing it in the background.
+    Returns the new job's progress dictionary. Raises ArchiveError if the archive
+    or manifest cannot be used (nothing is imported then).
+    """
+    if content_length > MAX_ARCHIVE_BYTES:
+        raise ArchiveError("The archive is too large")
+    _forget_old_jobs()
+    job_id = uuid.uuid4().hex
+    staging_dir = os.path.join(STAGING_DIR, job_id)
+    try:
+        extract_archive(_BodyReader(body, content_length), content_type.split(';')[0].strip(), staging_dir)
+        rows = read_manifest(staging_dir)
+    except (ArchiveError, OSError):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    job = {'job_id': job_id, 'publisher_id': publisher_id, 'status': 'importing', 'total': len(rows),
+           'processed': 0, 'imported': 0, 'failed': 0, 'errors': [], 'book_ids': [],
+           'started_at': time.time()}
+    with _lock:
+        _jobs[job_id] = job
+    os.makedirs(os.path.join(UPLOADS_DIR, "covers"), exist_ok=True)
+    os.makedirs(os.path.join(UPLOADS_DIR, "pdfs"), exist_ok=True)
+    thread = threading.Thread(target=_run_job, args=(job, publisher_id, staging_dir, rows),
+                              name=f"import-{job_id[:8]}", daemon=True)
+    thread.start()
+    return get_import_job(job_id, publisher_id)
+
+def get_import_job(job_id, publisher_id):
+    """Returns a copy of a job's progress, or None if there is no such job for this publisher."""
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job['publisher_id'] != publisher_id:
+            return None
+        progress = dict(job)
+        progress['errors'] = list(job['errors'])
+        progress['book_ids'] = list(job['book_ids'])
+    del progress['publisher_id']
+    return progress
@@ -0,0 +1,409 @@
+# services/catalog.py
+# In-memory copy of the book catalog with bitmap indexes for faceted browsing.
+#
+# Every book gets a slot number, and each facet value (a category, a publisher,
+# an author) keeps a bitmap with one bit per slot, stored as a Python int. A
+# filter like "category 1 or 2, by publisher 7, that I'm subscribed to" is then
+# a few bitwise ORs and ANDs, and a facet count is the number of set bits.
+#
+# The catalog is loaded from the database at startup and reloaded every
+# RELOAD_INTERVAL seconds. Between reloads the book write paths keep it current
+# through refresh_book() and remove_book(), and changes made by other server
+# processes arrive as change events over the invalidation bus. The fuzzy search
+# index (services/search.py) is kept in step with it.
+#
+# A failed reload keeps the catalog it had, so while the database is down the
+# catalog is the last known good copy and /api/books is answered from it. It is
+# reloaded as soon as the database comes back.
+#
+# The catalog is saved in the read-model snapshots (services/snapshots.py) with
+# its watermark: the database's time when the last full load began, and the
+# highest book_id. After a restart it is loaded from the snapshot and caught up
+# by reading only the books changed since, instead of the whole table. The time
+# comes from the database clock, which is what stamps the rows, so a server
+# whose clock is off cannot skip changes. The search index is rebuilt from it
+# in memory rather than saved as well.
+
+import threading
+import time
+from datetime import datetime, timedelta
+from db.book_queries import get_all_books, get_books_by_ids, get_book_ids_changed_since, get_catalog_book_ids
+from db.category_queries import get_all_categories
+from db.connection import CompactRows, on_recovery, get_database_time
+from db.publisher_queries import get_publisher_ids_changed_since
+from services import search, invalidation, snapshots
+
+RELOAD_INTERVAL = 10 * 60
+# Catching up re-reads the changes from this long before the watermark, so a
+# change stamped before it but committed after cannot be missed
+WATERMARK_SLACK = timedelta(minutes=5)
+# Books read per query while catching up (Oracle allows 1000 values in an IN list)
+CATCH_UP_CHUNK = 500
+# Books changed by other processes are refreshed together after this many seconds
+REMOTE_REFRESH_DELAY = 0.5
+
+# Facets whose value comes straight from a catalog column
+FACET_COLUMNS = {'category': 'category_id', 'publisher': 'publisher_id', 'author': 'author_name'}
+
+# At most this many values are returned per facet, the ones with the most books
+MAX_FACET_VALUES = 20
+
+def _facet_key(facet, value):
+    """Normalises a facet value so lookups match what was indexed."""
+    if value is None or value == '':
+        return None
+    if facet == 'author':
+        return str(value).strip().lower()
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _slots_of(bits):
+    """Returns the slot numbers of the set bits, lowest first."""
+    text = bin(bits)[:1:-1]   # binary digits, least significant first
+    slots = []
+    position = text.find('1')
+    while position != -1:
+        slots.append(position)
+        position = text.find('1', position + 1)
+    return slots
+
+class FacetIndex:
+    """Catalog rows plus one bitmap per facet value."""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.id_index = columns.index('book_id')
+        self.column_index = {facet: columns.index(column) for facet, column in FACET_COLUMNS.items()}
+        self.rows = []              # slot -> row tuple, or None for a free slot
+        self.slot_of = {}           # book_id -> slot
+        self.free_slots = []
+        self.all_bits = 0           # bitmap of every live slot
+        self.bitmaps = {facet: {} for facet in FACET_COLUMNS}   # facet -> value -> bitmap
+
+    def _set_bits(self, row, slot, on):
+        """Sets or clears a slot's bit in each facet bitmap for the row's values."""
+        bit = 1 << slot
+        for facet, index in self.column_index.items():
+            key = _facet_key(facet, row[index])
+            if key is None:
+                continue
+            values = self.bitmaps[facet]
+            if on:
+                values[key] = values.get(key, 0) | bit
+            else:
+                remaining = values.get(key, 0) & ~bit
+                if remaining:
+                    values[key] = remaining
+                else:
+                    values.pop(key, None)
+
+    def put(self, row):
+        """Adds a book row, or replaces the stored row for the same book."""
+        book_id = row[self.id_index]
+        slot = self.slot_of.get(book_id)
+        if slot is not None:
+            self._set_bits(self.rows[slot], slot, False)
+            self.rows[slot] = row
+        else:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.rows[slot] = row
+            else:
+                slot = len(self.rows)
+                self.rows.append(row)
+            self.slot_of[book_id] = slot
+            self.all_bits |= 1 << slot
+        self._set_bits(row, slot, True)
+
+    def remove(self, book_id):
+        """Removes a book. Its slot is reused by the next new book."""
+        slot = self.slot_of.pop(book_id, None)
+        if slot is None:
+            return
+        self._set_bits(self.rows[slot], slot, False)
+        self.rows[slot] = None
+        self.all_bits &= ~(1 << slot)
+        self.free_slots.append(slot)
+
+    def _facet_bits(self, facet, values):
+        """ORs together the bitmaps of the selected values of one facet."""
+        bits = 0
+        bitmaps = self.bitmaps[facet]
+        for value in values:
+            bits |= bitmaps.get(_facet_key(facet, value), 0)
+        return bits
+
+    def search(self, filters, subscribed_categories=None, search_term=""):
+        """
+        Returns (rows, facet_counts) for the given filters.
+        `filters` maps a facet name to a list of selected values: values of one facet
+        are ORed, different facets are ANDed. If subscribed_categories is given, only
+        books in those categories are kept. Each facet's counts apply every filter
+        except that facet's own, so they show what selecting another value would give.
+        """
+        selected = {facet: self._facet_bits(facet, values)
+                    for facet, values in filters.items() if facet in FACET_COLUMNS and values}
+        base = self.all_bits
+        if subscribed_categories is not None:
+            base &= self._facet_bits('category', subscribed_categories)
+
+        result = base
+        for bits in selected.values():
+            result &= bits
+
+        counts = {}
+        for facet in FACET_COLUMNS:
+            scope = base
+            for other, bits in selected.items():
+                if other != facet:
+                    scope &= bits
+            facet_counts = []
+            for value, bits in self.bitmaps[facet].items():
+                count = (bits & scope).bit_count()
+                if count:
+                    facet_counts.append((count, value))
+            facet_counts.sort(key=lambda pair: pair[0], reverse=True)
+            counts[facet] = {value: count for count, value in facet_counts[:MAX_FACET_VALUES]}
+
+        rows = [self.rows[slot] for slot in _slots_of(result)]
+        if search_term:
+            term = search_term.lower()
+            text_columns = [self.columns.index(c) for c in ('name', 'author_name', 'category_name')]
+            rows = [row for row in rows
+                    if any(row[i] and term in str(row[i]).lower() for i in text_columns)]
+        return rows, counts
+
+def build_index(books):
+    """Builds a FacetIndex from a CompactRows catalog listing."""
+    index = FacetIndex(books.columns)
+    for row in books.rows:
+        index.put(row)
+    return index
+
+# --- Shared catalog used by the server ---
+
+_index = None
+_lock = threading.Lock()
+_loaded = threading.Event()    # set once the first load has worked
+# Watermark of the catalog: the database's time when its last full load or
+# catch-up began (a datetime)
+_state = {'as_of': None, 'max_book_id': 0}
+
+def reload():
+    """Reloads the whole catalog from the database. Returns False if it could not be read."""
+    global _index
+    as_of = get_database_time()
+    if as_of is None:
+        return False
+    books = get_all_books()
+    if not isinstance(books, CompactRows):
+        return False
+    index = build_index(books)
+    search.rebuild(books)
+    with _lock:
+        _index = index
+        _state['as_of'] = as_of
+    _loaded.set()
+    return True
+
+def restore_snapshot():
+    """
+    Loads the catalog saved in the last snapshot, so it is there (as the last
+    known good copy) before the database has been read. It is not marked loaded
+    until catch_up() has brought it up to date. Returns True if there was one.
+    """
+    global _index
+    saved = snapshots.load('catalog')
+    if saved is None:
+        return False
+    value, watermark = saved
+    books = CompactRows(value['columns'], value['rows'])
+    index = build_index(books)
+    search.rebuild(books)
+    with _lock:
+        _index = index
+        _state['as_of'] = datetime.fromisoformat(watermark['as_of'])
+        _state['max_book_id'] = watermark['max_book_id']
+    print(f"Catalog restored from snapshot: {len(books)} books")
+    return True
+
+def _books_to_catch_up(since):
+    """
+    Returns (changed book ids, deleted book ids) since a datetime, or None if the
+    database could not be read. Besides the books changed themselves, a book
+    changes when its publisher is renamed or its category name differs.
+    """
+    changed = get_book_ids_changed_since(since, _state['max_book_id'])
+    publisher_ids = get_publisher_ids_changed_since(since)
+    categories = get_all_categories()
+    live_ids = get_catalog_book_ids()
+    if changed is None or publisher_ids is None or live_ids is None or not isinstance(categories, CompactRows):
+        return None
+    category_names = {category['category_id']: category['category_name'] for category in categories}
+    book_ids = set(changed)
+    with _lock:
+        id_index = _index.id_index
+        for publisher_id in publisher_ids:
+            for slot in _slots_of(_index.bitmaps['publisher'].get(publisher_id, 0)):
+                book_ids.add(_index.rows[slot][id_index])
+        category_index = _index.columns.index('category_id')
+        name_index = _index.columns.index('category_name')
+        for row in _index.rows:
+            if row is not None and category_names.get(row[category_index]) != row[name_index]:
+                book_ids.add(row[id_index])
+        deleted = [book_id for book_id in _index.slot_of if book_id not in live_ids]
+    return sorted(book_ids & live_ids), deleted
+
+def catch_up():
+    """
+    Brings a catalog restored from a snapshot up to date by reading only what
+    changed after its watermark. Returns False if the database could not be read.
+    """
+    if _index is None or _state['as_of'] is None:
+        return False
+    began = time.time()
+    as_of = get_database_time()
+    if as_of is None:
+        return False
+    found = _books_to_catch_up(_state['as_of'] - WATERMARK_SLACK)
+    if found is None:
+        return False
+    book_ids, deleted = found
+    for start in range(0, len(book_ids), CATCH_UP_CHUNK):
+        books = get_books_by_ids(book_ids[start:start + CATCH_UP_CHUNK])
+        if not books:
+            return False    # every id was listed just now, so the query failed
+        with _lock:
+            for book in books:
+                _index.put(tuple(book.get(column) for column in _index.columns))
+                search.put_book(book)
+    for book_id in deleted:
+        remove_book(book_id)
+    with _lock:
+        _state['as_of'] = as_of
+    _loaded.set()
+    print(f"Catalog caught up: {len(book_ids)} books changed, {len(deleted)} deleted "
+          f"in {time.time() - began:.1f}s")
+    return True
+
+def _snapshot():
+    """The catalog's section of the read-model snapshots, or None before it is loaded."""
+    with _lock:
+        if _index is None or _state['as_of'] is None:
+            return None
+        rows = [row for row in _index.rows if row is not None]
+        watermark = {'as_of': _state['as_of'].isoformat(), 'max_book_id': max(_index.slot_of, default=0)}
+        return {'columns': tuple(_index.columns), 'rows': rows}, watermark
+
+def wait_until_loaded(timeout):
+    """Waits up to `timeout` seconds for the first catalog load. Returns True if it is loaded."""
+    return _loaded.wait(timeout)
+
+def refresh_book(book_id):
+    """Reloads one book from the database after it was added or updated."""
+    refresh_books([book_id])
+
+def refresh_books(book_ids):
+    """Reloads several books from the database with one query."""
+    if _index is None or not book_ids:
+        return
+    book_ids = [int(book_id) for book_id in book_ids]
+    books = get_books_by_ids(book_ids)
+    found = set()
+    with _lock:
+        for book in books:
+            _index.put(tuple(book.get(column) for column in _index.columns))
+            search.put_book(book)
+            found.add(book['book_id'])
+        for book_id in book_ids:
+            if book_id not in found:
+                _index.remove(book_id)
+                search.remove_book(book_id)
+
+def remove_book(book_id):
+    """Drops a deleted book from the catalog."""
+    if _index is None:
+        return
+    with _lock:
+        _index.remove(int(book_id))
+        search.remove_book(int(book_id))
+
+def get_books(book_ids):
+    """Returns the catalog rows of the given books, in that order, as CompactRows."""
+    with _lock:
+        if _index is None:
+            return None
+        rows = []
+        for book_id in book_ids:
+            slot = _index.slot_of.get(book_id)
+            if slot is not None:
+                rows.append(_index.rows[slot])
+        return CompactRows(_index.columns, rows)
+
+def browse(filters, subscribed_categories=None, search_term=""):
+    """
+    Faceted search over the catalog. Returns (CompactRows, facet_counts),
+    or None if the catalog has not been loaded yet.
+    """
+    with _lock:
+        if _index is None:
+            return None
+        rows, counts = _index.search(filters, subscribed_categories, search_term)
+        return CompactRows(_index.columns, rows), counts
+
+_remote_changes = {'book_ids': set(), 'timer': None}
+
+def _refresh_remote_changes():
+    with _lock:
+        book_ids = _remote_changes['book_ids']
+        _remote_changes['book_ids'] = set()
+        _remote_changes['timer'] = None
+    refresh_books(list(book_ids))
+
+def _reload_in_background():
+    threading.Thread(target=reload, name="catalog-reload", daemon=True).start()
+
+def _apply_remote_change(event):
+    """Applies a change event from another server process (called on the bus thread)."""
+    kind = event['type']
+    if kind in ('book-added', 'book-updated'):
+        # An import adds many books at once, so collect them into one query
+        with _lock:
+            _remote_changes['book_ids'].add(int(event['data']['book_id']))
+            if _remote_changes['timer'] is None:
+                timer = threading.Timer(REMOTE_REFRESH_DELAY, _refresh_remote_changes)
+                timer.daemon = True
+                _remote_changes['timer'] = timer
+                timer.start()
+    elif kind == 'book-deleted':
+        remove_book(event['data']['book_id'])
+    elif kind in ('category-changed', 'publisher-updated'):
+        # Names shown on every book changed
+        _reload_in_background()
+
+def _reload_loop():
+    # A catalog from the snapshot only needs the changes since; the next full
+    # reload then comes at the usual time
+    if restore_snapshot() and catch_up():
+        time.sleep(RELOAD_INTERVAL)
+    while True:
+        reload()
+        time.sleep(RELOAD_INTERVAL)
+
+def start_background_reload():
+    """
+    Loads the catalog now (from the snapshot if there is one) and then every
+    RELOAD_INTERVAL seconds, on a daemon thread, and follows the changes other
+    server processes announce. It is also reloaded whenever the database recovers
+    from an outage.
+    """
+    snapshots.register('catalog', _snapshot)
+    invalidation.subscribe('change-event', _apply_remote_change)
+    invalidation.on_resync(_reload_in_background)
+    # Changes made while the database was unreachable may have been missed
+    on_recovery(_reload_in_background)
+    thread = threading.Thread(target=_reload_loop, name="catalog", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,244 @@
+# services/event_stream.py
+# Server-sent events: pushes change events to connected browsers.
+#
+# A browser opens /api/events with EventSource and keeps the connection open.
+# After the response headers are sent, the request handler hands the socket to
+# the EventHub and returns, so the request thread is free again. One hub
+# thread then watches every subscriber socket with a selector and writes events
+# to them without blocking, which lets thousands of idle subscribers share that
+# one thread. A subscriber whose unsent data grows past MAX_CLIENT_BUFFER is too
+# slow and is disconnected; EventSource reconnects on its own.
+#
+# Events come from the db write functions through db/change_events.py: directly
+# when they happen in this process, over the invalidation bus when they happen in
+# another server process, and from the spool directory when a process without
+# listeners wrote them. The last REPLAY_EVENTS events are kept, so a
+# browser that reconnects with a Last-Event-ID gets what it missed. If it missed
+# more than that (or the server restarted) it gets a "reset" event and should
+# refetch everything.
+
+import collections
+import json
+import selectors
+import socket
+import threading
+import time
+import uuid
+from db import change_events
+from services import invalidation
+
+HEARTBEAT_INTERVAL = 15
+SPOOL_CHECK_INTERVAL = 0.5
+# Spooled events older than this were written while no main server was running
+SPOOL_MAX_AGE = 60
+MAX_SUBSCRIBERS = 10000
+MAX_CLIENT_BUFFER = 256 * 1024
+REPLAY_EVENTS = 500
+# How long EventSource waits before reconnecting, in milliseconds
+RETRY_MS = 3000
+
+class _Subscriber:
+    """One open event stream."""
+
+    def __init__(self, sock, user_id):
+        self.sock = sock
+        self.user_id = user_id
+        self.buffer = bytearray()
+
+class EventHub:
+    """Owns the subscriber sockets and writes events to them from one thread."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.subscribers = {}    # socket -> _Subscriber, only touched by the hub thread
+        self.sockets = set()     # every socket handed to the hub, including ones not yet added
+        self.incoming = []       # ('subscribe', ...) or ('event', ...) from other threads
+        self.lock = threading.Lock()
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.next_number = 1
+        self.recent = collections.deque(maxlen=REPLAY_EVENTS)    # (number, user_id, encoded event)
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, None)
+
+    # --- Called from other threads ---
+
+    def has_room(self):
+        with self.lock:
+            return len(self.sockets) < MAX_SUBSCRIBERS
+
+    def owns(self, sock):
+        with self.lock:
+            return sock in self.sockets
+
+    def subscribe(self, sock, user_id, last_event_id=None):
+        """Takes over a socket whose event-stream response headers were already sent."""
+        with self.lock:
+            self.sockets.add(sock)
+            self.incoming.append(('subscribe', (sock, user_id, last_event_id)))
+        self._wake()
+
+    def publish(self, event):
+        """Queues a change event (see db/change_events.py) for the subscribers."""
+        with self.lock:
+            self.incoming.append(('event', event))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wake_writer.send(b'x')
+        except BlockingIOError:
+            pass    # the hub has plenty of wake-ups waiting already
+
+    # --- Hub thread ---
+
+    def _encode(self, number, event):
+        data = json.dumps(event['data'], default=str)
+        return f"id: {self.boot_id}-{number}\nevent: {event['type']}\ndata: {data}\n\n".encode('utf-8')
+
+    def _add_subscriber(self, sock, user_id, last_event_id):
+        sock.setblocking(False)
+        subscriber = _Subscriber(sock, user_id)
+        self.subscribers[sock] = subscriber
+        self.selector.register(sock, selectors.EVENT_READ, subscriber)
+        self._queue(subscriber, f"retry: {RETRY_MS}\n\n".encode('ascii'))
+        if not last_event_id:
+            return
+        boot_id, _, number = last_event_id.partition('-')
+        try:
+            number = int(number)
+        except ValueError:
+            number = -1
+        oldest = self.recent[0][0] if self.recent else self.next_number
+        if boot_id != self.boot_id or number < oldest - 1:
+            # Too much was missed to replay it
+            self._queue(subscriber, b"event: reset\ndata: {}\n\n")
+            return
+        for event_number, event_user_id, encoded in self.recent:
+            if event_number > number and event_user_id in (None, user_id):
+                self._queue(subscriber, encoded)
+
+    def _broadcast(self, event):
+        number = self.next_number
+        self.next_number += 1
+        user_id = event.get('user_id')
+        encoded = self._encode(number, event)
+        self.recent.append((number, user_id, encoded))
+        for subscriber in list(self.subscribers.values()):
+            if user_id is None or subscriber.user_id == user_id:
+                self._queue(subscriber, encoded)
+
+    def _queue(self, subscriber, data):
+        subscriber.buffer += data
+        if len(subscriber.buffer) > MAX_CLIENT_BUFFER:
+            self._drop(subscriber)
+        else:
+            self._flush(subscriber)
+
+    def _flush(self, subscriber):
+        if subscriber.sock not in self.subscribers:
+            return
+        try:
+            sent = subscriber.sock.send(subscriber.buffer)
+            del subscriber.buffer[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._drop(subscriber)
+            return
+        # Only ask to hear about writability while something is waiting to be sent
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.buffer else 0)
+        self.selector.modify(subscriber.sock, events, subscriber)
+
+    def _drop(self, subscriber):
+        if self.subscribers.pop(subscriber.sock, None) is None:
+            return
+        self.selector.unregister(subscriber.sock)
+        with self.lock:
+            self.sockets.discard(subscriber.sock)
+        try:
+            subscriber.sock.close()
+        except OSError:
+            pass
+
+    def _take_incoming(self):
+        with self.lock:
+            incoming, self.incoming = self.incoming, []
+        for kind, item in incoming:
+            if kind == 'subscribe':
+                self._add_subscriber(*item)
+            else:
+                self._broadcast(item)
+
+    def run(self):
+        next_heartbeat = time.time() + HEARTBEAT_INTERVAL
+        next_spool_check = 0
+        while True:
+            timeout = max(0, min(next_heartbeat, next_spool_check) - time.time())
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj is self.wake_reader:
+                    try:
+                        while self.wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                subscriber = key.data
+                if mask & selectors.EVENT_READ:
+                    # Browsers send nothing after the request, so this means the connection closed
+                    try:
+                        if not subscriber.sock.recv(4096):
+                            self._drop(subscriber)
+                            continue
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    except OSError:
+                        self._drop(subscriber)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(subscriber)
+            self._take_incoming()
+
+            now = time.time()
+            if now >= next_spool_check:
+                for event in change_events.take_spooled_events(SPOOL_MAX_AGE):
+                    # Through the listeners, so the other servers' hubs get it as well
+                    change_events.dispatch(event)
+                next_spool_check = now + SPOOL_CHECK_INTERVAL
+            if now >= next_heartbeat:
+                # A comment line keeps proxies from closing idle streams and finds dead sockets
+                for subscriber in list(self.subscribers.values()):
+                    self._queue(subscriber, b": keep-alive\n\n")
+                next_heartbeat = now + HEARTBEAT_INTERVAL
+
+# --- Shared hub used by the server ---
+
+_hub = None
+
+def start_event_stream():
+    """
+    Starts the event hub on a daemon thread. It gets this process's change events
+    and the ones other processes send over the invalidation bus.
+    """
+    global _hub
+    _hub = EventHub()
+    change_events.add_listener(_hub.publish)
+    invalidation.subscribe('change-event', _hub.publish)
+    # Events may have been missed; tell the browsers to refetch
+    invalidation.on_resync(lambda: _hub.publish({'type': 'reset', 'data': {}, 'user_id': None}))
+    thread = threading.Thread(target=_hub.run, name="event-stream", daemon=True)
+    thread.start()
+    return thread
+
+def can_subscribe():
+    """True if the hub is running and has room for another subscriber."""
+    return _hub is not None and _hub.has_room()
+
+def subscribe(sock, user_id, last_event_id=None):
+    """Hands an event-stream connection to the hub (see EventHub.subscribe)."""
+    _hub.subscribe(sock, user_id, last_event_id)
+
+def owns_socket(sock):
+    """True if the socket belongs to the hub, so the server must not close it."""
+    return _hub is not None and _hub.owns(sock)
@@ -0,0 +1,107 @@
+# services/file_cache.py
+# A bounded cache of memory-mapped files for the PDFs and images served most often.
+#
+# Instead of opening and reading a file on every request, a popular file is
+# mapped into memory once with mmap and responses are written straight from the
+# mapping through memoryview slices, without copying the data into Python
+# bytes. A range request is just a smaller slice.
+#
+# Entries are keyed by path and checked against the file's size and mtime on
+# every lookup, so a file replaced or deleted by either server (or by hand) is
+# never served stale. Uploads and deletes in this process also drop their entry
+# right away with invalidate_file(). When the mapped files add up to more than
+# MAX_CACHE_BYTES, the least recently used ones are unmapped first.
+#
+# A mapped file must never be truncated or rewritten in place: reading a mapped
+# page that no longer exists kills the process with SIGBUS. Uploads and imports
+# are therefore stored under unique names and written to a temporary file that
+# is renamed into place, so a mapping always keeps its old, complete file.
+#
+# Every caller gets its own memoryview of the mapping. Dropping an entry only
+# forgets it: a view a response is still writing from stays valid, and the
+# mapping is closed once the last view of it is let go.
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+MAX_CACHE_FILES = 512
+# Bigger files are streamed from disk instead, so one huge PDF can't take the whole cache
+MAX_FILE_BYTES = 64 * 1024 * 1024
+
+class MappedFileCache:
+    """Least-recently-used cache of read-only file mappings."""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, max_files=MAX_CACHE_FILES, max_file_bytes=MAX_FILE_BYTES):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_file_bytes = max_file_bytes
+        self.entries = OrderedDict()    # path -> (size, mtime_ns, mmap)
+        self.total_bytes = 0
+
+    def _drop(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        size, mtime_ns, mapping = entry
+        self.total_bytes -= size
+        try:
+            mapping.close()
+        except BufferError:
+            # A response still holds a view; the mapping is closed once it is let go
+            pass
+
+    def get(self, path):
+        """
+        Returns a new memoryview of the whole file, or None if the file does not
+        exist or is too big to cache (then it should be read the normal way).
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._drop(path)
+            return None
+        entry = self.entries.get(path)
+        if entry is not None:
+            if entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                self.entries.move_to_end(path)
+                return memoryview(entry[2])
+            self._drop(path)
+
+        if stat.st_size == 0 or stat.st_size > self.max_file_bytes:
+            # An empty file cannot be mapped, and a huge one is not worth it
+            return memoryview(b'') if stat.st_size == 0 else None
+        try:
+            with open(path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        self.entries[path] = (len(mapping), stat.st_mtime_ns, mapping)
+        self.total_bytes += len(mapping)
+        while self.entries and (self.total_bytes > self.max_bytes or len(self.entries) > self.max_files):
+            oldest = next(iter(self.entries))
+            if oldest == path:
+                break
+            self._drop(oldest)
+        return memoryview(mapping)
+
+    def invalidate(self, path):
+        """Forgets a file that was replaced or deleted."""
+        self._drop(path)
+
+# --- Shared cache used by the server ---
+
+_cache = MappedFileCache()
+_lock = threading.Lock()
+
+def get_file_view(path):
+    """Returns a memoryview of a file's contents, or None (see MappedFileCache.get)."""
+    with _lock:
+        return _cache.get(os.path.normpath(path))
+
+def invalidate_file(path):
+    """Drops a file from the cache after it was uploaded again or deleted."""
+    with _lock:
+        _cache.invalidate(os.path.normpath(path))
@@ -0,0 +1,407 @@
+# services/fulltext.py
+# Full-text search inside the uploaded book PDFs.
+#
+# Text is pulled out of each PDF (services/pdf_text.py) on a pool of worker
+# processes, so a big upload never holds up the request that sent it, and the
+# CPU-heavy parsing does not compete with the web server's threads. The words of
+# each page go into an inverted index stored on disk with the dbm module:
+#
+#   "w:<word>"            -> [buckets holding the word]
+#   "w:<word>:<bucket>"   -> {"<book_id>": [page numbers containing the word], ...}
+#   "b:<book_id>"         -> {"source": pdf_path, "mtime": ..., "pages": page count}
+#   "v:<book_id>"         -> [every word of the book], so it can be removed again
+#
+# A word's postings are split into buckets of BUCKET_SIZE consecutive book ids,
+# so adding or removing a book rewrites one small bucket per word instead of
+# every posting of a common word. A book's words are written in batches of
+# WRITE_BATCH, taking the lock once per batch, so searches keep running while a
+# big book is stored.
+#
+# The index survives restarts. At startup, index_existing_books() queues only
+# the PDFs that are new or changed since they were last indexed, and drops books
+# that no longer exist. An index in an older layout is discarded and rebuilt.
+#
+# dbm files cannot take writers from several processes, so one process owns the
+# index: whichever holds the lock file LOCK_PATH, the same way the invalidation
+# bus picks its broker. Only the owner extracts text and writes. The other
+# processes send their uploads and deletions to it over the invalidation bus,
+# and search a read-only copy of the index that is opened again when its files
+# change. If the owner stops, the next process that needs to write takes over
+# and brings the index up to date.
+
+import dbm
+import glob
+import json
+import os
+import threading
+from concurrent.futures import BrokenExecutor
+from db.book_queries import get_book_pdf_paths
+from services import invalidation
+from services.pdf_text import extract_pages
+from services.search import normalize_words
+
+try:
+    import fcntl
+except ImportError:    # not available on Windows
+    fcntl = None
+
+UPLOADS_DIR = os.path.join("static", "uploads")
+INDEX_PATH = os.path.join("data", "fulltext")
+LOCK_PATH = INDEX_PATH + ".lock"
+INDEX_FORMAT = b"2"
+
+BUCKET_SIZE = 64
+WRITE_BATCH = 500
+
+# Worker processes used for text extraction
+WORKERS = 2
+
+def word_pages(pages):
+    """Returns {word: [page numbers]} for the page texts of a book."""
+    found = {}
+    for number, text in enumerate(pages, 1):
+        for word in set(normalize_words(text)):
+            # One- and two-letter words are too common to be worth indexing
+            if len(word) > 2:
+                found.setdefault(word, []).append(number)
+    return found
+
+class FullTextIndex:
+    """
+    A word -> book -> pages index kept in a dbm file. A read-only index is for
+    searching an index that another process writes.
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.db = None
+        self.files = None
+
+    def _open(self):
+        if self.db is None and self.read_only:
+            flag = 'r'
+            if dbm.whichdb(self.path) == 'dbm.gnu':
+                flag += 'u'    # gdbm locks the file for its writer; a reader must not wait on it
+            self.files = self._file_times()
+            self.db = dbm.open(self.path, flag)
+        elif self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = dbm.open(self.path, 'c')
+            if self.db.get("format") != INDEX_FORMAT:
+                # Written in an older layout: start again, every book is re-queued
+                self.db.close()
+                self.db = dbm.open(self.path, 'n')
+                self.db["format"] = INDEX_FORMAT
+        return self.db
+
+    def _get(self, key):
+        value = self._open().get(key)
+        return json.loads(value) if value else None
+
+    def _file_times(self):
+        # Each dbm backend names its files differently, but they all start with the path
+        return sorted((name, os.stat(name).st_mtime_ns) for name in glob.glob(self.path + '*')
+                      if not name.endswith('.lock'))
+
+    def reopen_if_changed(self):
+        """Opens a read-only index again if another process has written to it since."""
+        if self.db is not None and self._file_times() != self.files:
+            self.db.close()
+            self.db = None
+
+    def _sync(self):
+        # Not every dbm backend buffers writes, so not every one has sync()
+        sync = getattr(self.db, 'sync', None)
+        if sync:
+            sync()
+
+    def book_info(self, book_id):
+        """Returns {"source", "mtime", "pages"} for an indexed book, or None."""
+        return self._get(f"b:{book_id}")
+
+    def indexed_books(self):
+        """Returns the ids of every indexed book."""
+        return [int(key[2:]) for key in self._open().keys() if key.startswith(b"b:")]
+
+    def start_book(self, book_id, words):
+        """
+        Removes what was indexed for a book and records the words it is about to
+        get, so remove_book() can undo a book that was only partly written.
+        """
+        self._remove(book_id)
+        self._open()["v:" + str(book_id)] = json.dumps(list(words))
+
+    def add_words(self, book_id, items):
+        """Adds (word, page numbers) postings for a book."""
+        db = self._open()
+        key = str(book_id)
+        bucket = book_id // BUCKET_SIZE
+        for word, numbers in items:
+            bucket_key = f"w:{word}:{bucket}"
+            postings = self._get(bucket_key)
+            if postings is None:
+                buckets = self._get("w:" + word) or []
+                buckets.append(bucket)
+                db["w:" + word] = json.dumps(buckets)
+                postings = {}
+            postings[key] = numbers
+            db[bucket_key] = json.dumps(postings)
+
+    def finish_book(self, book_id, source, mtime, page_count):
+        """Marks a book as fully indexed."""
+        self._open()["b:" + str(book_id)] = json.dumps({'source': source, 'mtime': mtime, 'pages': page_count})
+        self._sync()
+
+    def put_book(self, book_id, pages, source, mtime):
+        """Indexes the page texts of a book, replacing what was indexed for it before."""
+        found = word_pages(pages)
+        self.start_book(book_id, found)
+        self.add_words(book_id, found.items())
+        self.finish_book(book_id, source, mtime, len(pages))
+
+    def remove_book(self, book_id):
+        """Removes a book from the index."""
+        self._remove(book_id)
+        self._sync()
+
+    def _remove(self, book_id):
+        db = self._open()
+        key = str(book_id)
+        bucket = int(book_id) // BUCKET_SIZE
+        for word in self._get("v:" + key) or []:
+            bucket_key = f"w:{word}:{bucket}"
+            postings = self._get(bucket_key)
+            if postings is None or key not in postings:
+                continue
+            del postings[key]
+            if postings:
+                db[bucket_key] = json.dumps(postings)
+                continue
+            del db[bucket_key]
+            buckets = [other for other in self._get("w:" + word) or [] if other != bucket]
+            if buckets:
+                db["w:" + word] = json.dumps(buckets)
+            else:
+                del db["w:" + word]
+        for prefix in ("v:", "b:"):
+            if (prefix + key).encode() in db:
+                del db[prefix + key]
+
+    def _postings(self, word):
+        """Returns {"<book_id>": [pages]} for a word, from all of its buckets."""
+        postings = {}
+        for bucket in self._get("w:" + word) or []:
+            postings.update(self._get(f"w:{word}:{bucket}") or {})
+        return postings
+
+    def search(self, query, book_ids=None):
+        """
+        Returns [(book_id, [page numbers])] for books with at least one page that
+        contains every word of the query, books with the most such pages first.
+        If book_ids is given, only those books are considered.
+        """
+        words = [word for word in dict.fromkeys(normalize_words(query)) if len(word) > 2]
+        if not words:
+            return []
+        postings = []
+        for word in words:
+            found = self._postings(word)
+            if not found:
+                return []
+            postings.append(found)
+        # Start from the rarest word so the fewest books are checked
+        postings.sort(key=len)
+
+        results = []
+        for key, pages in postings[0].items():
+            if book_ids is not None and int(key) not in book_ids:
+                continue
+            if any(key not in other for other in postings[1:]):
+                continue
+            common = set(pages).intersection(*(other[key] for other in postings[1:]))
+            if common:
+                results.append((int(key), sorted(common)))
+        results.sort(key=lambda result: len(result[1]), reverse=True)
+        return results
+
+# --- Shared index used by the server ---
+
+_index = FullTextIndex(INDEX_PATH)
+# What a process that does not own the index searches
+_reader = FullTextIndex(INDEX_PATH, read_only=True)
+_lock = threading.Lock()
+_owner_lock = threading.Lock()
+_owner = {'lock_file': None}
+_executor = None
+# book_id -> the extraction job whose result should be stored for it
+_pending = {}
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Imported here: multiprocessing is slow to import and not needed to start serving
+        from concurrent.futures import ProcessPoolExecutor
+        _executor = ProcessPoolExecutor(max_workers=WORKERS)
+    return _executor
+
+def _owns_index():
+    """
+    Returns True if this process owns the index, taking it over first if no
+    process holds the lock file. A new owner starts indexing at once, to catch up
+    on what was sent to the last owner, or while there was none.
+    """
+    if fcntl is None:
+        return True    # no lock files here, so only one process may run
+    with _owner_lock:
+        if _owner['lock_file'] is not None:
+            return True
+        os.makedirs(os.path.dirname(LOCK_PATH), exist_ok=True)
+        lock_file = open(LOCK_PATH, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        _owner['lock_file'] = lock_file
+    invalidation.subscribe('fulltext', _apply_remote_request)
+    invalidation.on_resync(_index_in_background)
+    _index_in_background()
+    return True
+
+def _apply_remote_request(data):
+    """Carries out an upload or deletion that another process sent to the owner."""
+    if data['action'] == 'queue':
+        queue_book_pdf(data['book_id'], data['pdf_path'])
+    elif data['action'] == 'forget':
+        forget_book_pdf(data['book_id'])
+
+def _store(book_id, pdf_path, mtime, future):
+    """Saves the pages of a finished extraction job (runs on an executor thread)."""
+    with _lock:
+        if _pending.get(book_id) is not future:
+            # The book was deleted or re-uploaded while this job ran
+            return
+    try:
+        pages = future.result()
+    except Exception as e:
+        print(f"Could not extract text from {pdf_path}: {e}")
+        with _lock:
+            if _pending.get(book_id) is future:
+                del _pending[book_id]
+        return
+    found = word_pages(pages)
+    items = list(found.items())
+    with _lock:
+        if _pending.get(book_id) is not future:
+            return
+        _index.start_book(book_id, found)
+    for start in range(0, len(items), WRITE_BATCH):
+        with _lock:
+            if _pending.get(book_id) is not future:
+                # Deleted or re-uploaded meanwhile; whoever did that cleans up
+                return
+            _index.add_words(book_id, items[start:start + WRITE_BATCH])
+    with _lock:
+        if _pending.get(book_id) is not future:
+            return
+        del _pending[book_id]
+        _index.finish_book(book_id, pdf_path, mtime, len(pages))
+
+def queue_book_pdf(book_id, pdf_path):
+    """
+    Queues a book's PDF (a path relative to the uploads folder) for text
+    extraction and returns at once, or asks the process that owns the index to.
+    Returns False if the file is missing.
+    """
+    global _executor
+    book_id = int(book_id)
+    full_path = os.path.join(UPLOADS_DIR, pdf_path)
+    try:
+        mtime = os.path.getmtime(full_path)
+    except OSError:
+        print(f"PDF for book {book_id} not found: {full_path}")
+        return False
+    if not _owns_index():
+        invalidation.publish('fulltext', {'action': 'queue', 'book_id': book_id, 'pdf_path': pdf_path})
+        return True
+    with _lock:
+        try:
+            future = _get_executor().submit(extract_pages, full_path)
+        except BrokenExecutor:
+            # A worker died (e.g. killed for memory); start a fresh pool
+            _executor = None
+            future = _get_executor().submit(extract_pages, full_path)
+        _pending[book_id] = future
+    future.add_done_callback(lambda done: _store(book_id, pdf_path, mtime, done))
+    return True
+
+def forget_book_pdf(book_id):
+    """Removes a deleted book from the index, including any extraction still running."""
+    book_id = int(book_id)
+    if not _owns_index():
+        invalidation.publish('fulltext', {'action': 'forget', 'book_id': book_id})
+        return
+    with _lock:
+        future = _pending.pop(book_id, None)
+        if future is not None:
+            future.cancel()
+        _index.remove_book(book_id)
+
+def search_pdf_text(query, book_ids=None):
+    """Returns [(book_id, [page numbers])] for books whose text matches the query."""
+    with _lock:
+        if _owner['lock_file'] is not None or fcntl is None:
+            return _index.search(query, book_ids)
+        try:
+            _reader.reopen_if_changed()
+            return _reader.search(query, book_ids)
+        except (dbm.error, OSError, ValueError) as e:
+            # No index yet, or the owner was writing the part that was read
+            print(f"Could not search the full-text index: {e}")
+            _reader.db = None
+            return []
+
+def index_existing_books():
+    """
+    Queues every PDF that is not indexed yet or changed since it was indexed, and
+    drops indexed books that are no longer in the database.
+    Returns False if the book list could not be read.
+    """
+    books = get_book_pdf_paths()
+    if books is None:
+        return False
+    queued = 0
+    for book_id, pdf_path in books:
+        with _lock:
+            info = _index.book_info(book_id)
+        full_path = os.path.join(UPLOADS_DIR, pdf_path)
+        if info and info['source'] == pdf_path and os.path.exists(full_path) \
+                and info['mtime'] == os.path.getmtime(full_path):
+            continue
+        if queue_book_pdf(book_id, pdf_path):
+            queued += 1
+
+    current = {book_id for book_id, pdf_path in books}
+    with _lock:
+        stale = [book_id for book_id in _index.indexed_books() if book_id not in current]
+        for book_id in stale:
+            _index.remove_book(book_id)
+    print(f"Full-text index: {queued} PDFs queued, {len(stale)} deleted books removed")
+    return True
+
+def _index_in_background():
+    """Runs index_existing_books() on a daemon thread."""
+    thread = threading.Thread(target=index_existing_books, name="fulltext", daemon=True)
+    thread.start()
+    return thread
+
+def start_background_indexing():
+    """
+    Takes ownership of the index if no other process has it. The owner then runs
+    index_existing_books() on a daemon thread; the other processes only search.
+    """
+    if fcntl is None:
+        _index_in_background()
+    else:
+        _owns_index()
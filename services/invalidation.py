@@ -0,0 +1,322 @@
+# services/invalidation.py
+# A local publish/subscribe bus that tells the other server processes to drop
+# stale state.
+#
+# Each process keeps state in memory (the catalog, the session revocation list,
+# the event hub's subscribers), so a change made in one process, such as an admin
+# deleting a category or a user, has to be announced to the others. A process
+# publishes a keyed message, e.g. publish('sessions') or publish('change-event',
+# event), and every *other* process that subscribed to that key gets it. The
+# publisher updates its own state directly, as it always has.
+#
+# Backends are chosen with the INVALIDATION_BUS environment variable:
+#   unix  - (the default where available) the processes talk over a UNIX socket.
+#           Whichever process holds the lock file runs the broker; the broker
+#           numbers every message and sends it to every connection in that one
+#           order. A process that misses messages (it lost its connection, or the
+#           broker changed) cannot know what changed, so its resync callbacks run
+#           and it reloads everything.
+#   local - a single process; nothing is sent anywhere.
+# Another backend (for example Oracle change notification) only needs to
+# subclass LocalBus and call _deliver() for each message it receives.
+
+import collections
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from db import change_events
+from db.session_tokens import reload_revocations
+
+try:
+    import fcntl
+except ImportError:    # not available on Windows
+    fcntl = None
+
+BUS_SOCKET_PATH = os.environ.get("INVALIDATION_BUS_SOCKET", os.path.join("data", "invalidation.sock"))
+BUS_LOCK_PATH = BUS_SOCKET_PATH + ".lock"
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 10
+# A process that reads its messages slower than this is disconnected by the broker
+SEND_TIMEOUT = 5
+# Messages kept while disconnected, sent once the connection is back
+MAX_OUTBOX = 1000
+# Published by a process that had to throw messages away, so that everyone resyncs
+RESYNC_KEY = '*resync*'
+
+class LocalBus:
+    """A bus for one process. Keeps the subscriptions; has no one to tell."""
+
+    def __init__(self):
+        self.subscribers = collections.defaultdict(list)
+        self.resync_callbacks = []
+
+    def subscribe(self, key, callback):
+        """Calls callback(data) for each message published under key by another process."""
+        self.subscribers[key].append(callback)
+
+    def on_resync(self, callback):
+        """Calls callback() when messages may have been missed, so state must be reloaded."""
+        self.resync_callbacks.append(callback)
+
+    def publish(self, key, data=None):
+        pass
+
+    def start(self):
+        pass
+
+    def _deliver(self, key, data):
+        if key == RESYNC_KEY:
+            self._resync()
+            return
+        for callback in self.subscribers.get(key, []):
+            try:
+                callback(data)
+            except Exception as e:
+                print(f"Invalidation handler for {key} failed: {e}")
+
+    def _resync(self):
+        for callback in self.resync_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Invalidation resync failed: {e}")
+
+class UnixSocketBus(LocalBus):
+    """The bus over a UNIX socket, with one process acting as the broker."""
+
+    def __init__(self, socket_path=BUS_SOCKET_PATH, lock_path=BUS_LOCK_PATH):
+        super().__init__()
+        self.socket_path = socket_path
+        self.lock_path = lock_path
+        self.origin = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.sock = None
+        self.outbox = collections.deque()
+        self.outbox_overflowed = False
+        self.broker_id = None
+        self.last_seq = 0
+        self.needs_resync = False
+        self.lock_file = None
+
+    # --- Client side ---
+
+    def publish(self, key, data=None):
+        line = (json.dumps({'origin': self.origin, 'key': key, 'data': data}, default=str) + '\n').encode('utf-8')
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.sendall(line)
+                    return
+                except OSError:
+                    self._close_socket()
+            if len(self.outbox) >= MAX_OUTBOX:
+                self.outbox.popleft()
+                self.outbox_overflowed = True
+            self.outbox.append(line)
+
+    def _close_socket(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+
+    def _connect(self):
+        """Connects to the broker, becoming the broker first if nobody is."""
+        self._try_become_broker()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        with self.lock:
+            self.sock = sock
+            # Send what was published while disconnected, in order
+            if self.outbox_overflowed:
+                self.outbox.append((json.dumps({'origin': self.origin, 'key': RESYNC_KEY}) + '\n').encode('utf-8'))
+                self.outbox_overflowed = False
+            while self.outbox:
+                sock.sendall(self.outbox.popleft())
+        return sock
+
+    def _read_loop(self):
+        delay = RECONNECT_DELAY
+        connected_before = False
+        while True:
+            try:
+                sock = self._connect()
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            # Anything published while we were away is lost to us. The resync waits
+            # for the broker's hello, since a dying broker can still take connections.
+            self.needs_resync = connected_before
+            connected_before = True
+            try:
+                for line in sock.makefile('rb'):
+                    self._handle_line(line)
+            except OSError:
+                pass
+            with self.lock:
+                if self.sock is sock:
+                    self._close_socket()
+
+    def _handle_line(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        if message.get('hello'):
+            # The first line from the broker: who it is and where its numbering is
+            self.broker_id = message['broker']
+            self.last_seq = message['seq']
+            if self.needs_resync:
+                self.needs_resync = False
+                self._resync()
+            return
+        if message['broker'] != self.broker_id or message['seq'] != self.last_seq + 1:
+            self._resync()
+        self.broker_id = message['broker']
+        self.last_seq = message['seq']
+        if message.get('origin') != self.origin:
+            self._deliver(message['key'], message.get('data'))
+
+    # --- Broker side ---
+
+    def _try_become_broker(self):
+        """Starts the broker in this process if no other process holds the lock."""
+        if self.lock_file is not None or fcntl is None:
+            return
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return
+        # Holding the lock means any socket file left behind belongs to a dead broker
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(64)
+        self.lock_file = lock_file
+        broker = _Broker(listener)
+        threading.Thread(target=broker.accept_loop, name="invalidation-broker", daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self._read_loop, name="invalidation-bus", daemon=True).start()
+
+class _Broker:
+    """Numbers the messages it receives and sends each one to every connection."""
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.broker_id = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def accept_loop(self):
+        while True:
+            conn, _ = self.listener.accept()
+            conn.settimeout(SEND_TIMEOUT)
+            hello = {'hello': True, 'broker': self.broker_id}
+            with self.lock:
+                # Under the lock, so no message falls between the hello and the first broadcast
+                hello['seq'] = self.seq
+                try:
+                    conn.sendall((json.dumps(hello) + '\n').encode('utf-8'))
+                except OSError:
+                    conn.close()
+                    continue
+                self.connections.append(conn)
+            threading.Thread(target=self._read_connection, args=(conn,), name="invalidation-peer", daemon=True).start()
+
+    def _read_connection(self, conn):
+        buffer = b''
+        try:
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except socket.timeout:
+                    continue    # the timeout is for sending; an idle reader is fine
+                if not data:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._broadcast(message)
+        except OSError:
+            pass
+        self._drop(conn)
+
+    def _broadcast(self, message):
+        # The lock gives every message its number and sends it to everyone before
+        # the next one, so all processes see the messages in the same order
+        with self.lock:
+            self.seq += 1
+            message['seq'] = self.seq
+            message['broker'] = self.broker_id
+            line = (json.dumps(message) + '\n').encode('utf-8')
+            for conn in list(self.connections):
+                try:
+                    conn.sendall(line)
+                except OSError:
+                    # Too slow or gone; it will reconnect and resync
+                    self.connections.remove(conn)
+                    conn.close()
+
+    def _drop(self, conn):
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+BUS_BACKENDS = {'local': LocalBus, 'unix': UnixSocketBus}
+
+def _default_backend():
+    if hasattr(socket, 'AF_UNIX') and fcntl is not None:
+        return 'unix'
+    return 'local'
+
+# --- Shared bus used by the servers ---
+
+_bus = BUS_BACKENDS[os.environ.get("INVALIDATION_BUS", _default_backend())]()
+
+def subscribe(key, callback):
+    """Calls callback(data) for each message another process publishes under key."""
+    _bus.subscribe(key, callback)
+
+def on_resync(callback):
+    """Calls callback() whenever this process may have missed messages."""
+    _bus.on_resync(callback)
+
+def publish(key, data=None):
+    """Tells the other processes that the state under key changed."""
+    _bus.publish(key, data)
+
+def start_bus():
+    """
+    Connects this process to the bus. Change events from the db write functions
+    are passed on to the other processes, and revoked sessions are picked up as
+    soon as another process announces them.
+    """
+    change_events.add_listener(lambda event: publish('change-event', event))
+    subscribe('sessions', lambda data: reload_revocations())
+    _bus.start()
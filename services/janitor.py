@@ -0,0 +1,217 @@
+# services/janitor.py
+# Background clean-up of uploaded files.
+#
+# Deleting a book or publisher only queues its files for deletion:
+# queue_file_deletions() writes the paths to a small file in QUEUE_DIR and
+# returns, so the request never waits on the disk, and a queued deletion is not
+# lost if the server stops before it runs. Both servers queue deletions; the
+# janitor thread in the main server carries them out.
+#
+# Before a queued file is deleted the janitor checks that no row refers to it
+# again and that it was not written after the deletion was queued: a book can
+# be deleted and a new one uploaded under the same path before the queue runs.
+#
+# Files can still be left behind (an upload whose database insert failed, a cover
+# replaced by a differently named one, a crash between steps), so every
+# SCAN_INTERVAL seconds the janitor also walks static/uploads and deletes files
+# the database no longer refers to. Totals are kept in STATS_PATH so the admin
+# panel can show how much disk space was reclaimed.
+
+import json
+import os
+import threading
+import time
+import uuid
+from db.book_queries import get_upload_paths_in_use, get_upload_paths_referenced
+from services.file_cache import invalidate_file
+
+UPLOADS_DIR = os.path.join("static", "uploads")
+UPLOAD_FOLDERS = ("covers", "pdfs")
+QUEUE_DIR = os.path.join("data", "delete_queue")
+STATS_PATH = os.path.join("data", "janitor_stats.json")
+
+QUEUE_CHECK_INTERVAL = 5
+SCAN_INTERVAL = 6 * 60 * 60
+# A new upload is saved before its database row exists, so recent files are left alone
+ORPHAN_GRACE_PERIOD = 60 * 60
+
+_wake = threading.Event()
+_stats_lock = threading.Lock()
+
+def queue_file_deletions(relative_paths):
+    """
+    Queues upload files (paths relative to static/uploads, like "pdfs/book.pdf")
+    for deletion by the janitor. The queue entry is on disk before this returns.
+    """
+    paths = [path for path in relative_paths if path]
+    if not paths:
+        return
+    os.makedirs(QUEUE_DIR, exist_ok=True)
+    name = f"{time.time_ns()}-{uuid.uuid4().hex}"
+    temp_path = os.path.join(QUEUE_DIR, name + ".tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(paths, f)
+        f.flush()
+        os.fsync(f.fileno())
+    # The rename makes the entry appear complete or not at all
+    os.replace(temp_path, os.path.join(QUEUE_DIR, name + ".json"))
+    _wake.set()
+
+def _upload_file_path(relative_path):
+    """Returns the full path of an upload, or None if it points outside the upload folders."""
+    full_path = os.path.normpath(os.path.join(UPLOADS_DIR, relative_path))
+    for folder in UPLOAD_FOLDERS:
+        root = os.path.join(UPLOADS_DIR, folder)
+        if os.path.commonpath([full_path, root]) == root and full_path != root:
+            return full_path
+    return None
+
+def _delete_file(full_path):
+    """Deletes a file. Returns the number of bytes freed, or None if nothing was deleted."""
+    try:
+        size = os.stat(full_path).st_size
+        os.remove(full_path)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"Janitor could not delete {full_path}: {e}")
+        return None
+    invalidate_file(full_path)
+    return size
+
+def process_queue():
+    """Carries out every queued deletion, oldest first. Returns (files deleted, bytes freed)."""
+    try:
+        entries = sorted(entry.name for entry in os.scandir(QUEUE_DIR) if entry.name.endswith(".json"))
+    except FileNotFoundError:
+        return 0, 0
+    deleted, freed = 0, 0
+    for name in entries:
+        entry_path = os.path.join(QUEUE_DIR, name)
+        try:
+            with open(entry_path, encoding='utf-8') as f:
+                paths = json.load(f)
+        except FileNotFoundError:
+            continue    # another janitor got to it first
+        except (OSError, ValueError) as e:
+            print(f"Janitor skipping unreadable queue entry {name}: {e}")
+            paths = []
+        files = []
+        for relative_path in paths:
+            full_path = _upload_file_path(relative_path)
+            if full_path is None:
+                print(f"Janitor refusing to delete {relative_path!r}: not an upload")
+                continue
+            files.append((relative_path, full_path))
+        in_use = get_upload_paths_referenced([relative_path for relative_path, full_path in files])
+        if in_use is None:
+            break    # the database is unreachable; the entries are tried again later
+        if in_use is False:
+            # Only this entry is kept for the next run; the others still go ahead
+            print(f"Janitor could not check queue entry {name}; trying it again later")
+            continue
+        # The entry name starts with the time it was queued
+        queued_at = int(name.split('-', 1)[0]) / 1e9
+        for relative_path, full_path in files:
+            if relative_path in in_use:
+                continue
+            try:
+                if os.stat(full_path).st_mtime > queued_at:
+                    continue    # written again since; the orphan scan decides about it
+            except FileNotFoundError:
+                continue
+            size = _delete_file(full_path)
+            if size is not None:
+                deleted += 1
+                freed += size
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
+    return deleted, freed
+
+def _iter_upload_files():
+    """Yields (relative path, DirEntry) for every file under the upload folders, one at a time."""
+    for folder in UPLOAD_FOLDERS:
+        pending = [os.path.join(UPLOADS_DIR, folder)]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            relative_path = os.path.relpath(entry.path, UPLOADS_DIR).replace("\\", "/")
+                            yield relative_path, entry
+            except FileNotFoundError:
+                continue
+
+def reclaim_orphans():
+    """
+    Deletes upload files that no row in the database refers to and that are older
+    than ORPHAN_GRACE_PERIOD. Returns (files deleted, bytes freed), or None if the
+    list of paths in use could not be read (then nothing is deleted).
+    """
+    in_use = get_upload_paths_in_use()
+    if in_use is None:
+        return None
+    in_use = {path.replace("\\", "/") for path in in_use}
+    cutoff = time.time() - ORPHAN_GRACE_PERIOD
+    deleted, freed = 0, 0
+    for relative_path, entry in _iter_upload_files():
+        if relative_path in in_use:
+            continue
+        try:
+            if entry.stat().st_mtime > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        size = _delete_file(entry.path)
+        if size is not None:
+            deleted += 1
+            freed += size
+    return deleted, freed
+
+def _record(kind, deleted, freed):
+    """Adds to the running totals in STATS_PATH."""
+    with _stats_lock:
+        stats = read_stats()
+        stats[kind + '_files'] = stats.get(kind + '_files', 0) + deleted
+        stats['bytes_reclaimed'] = stats.get('bytes_reclaimed', 0) + freed
+        stats['last_' + kind] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        os.makedirs(os.path.dirname(STATS_PATH), exist_ok=True)
+        temp_path = STATS_PATH + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(stats, f)
+        os.replace(temp_path, STATS_PATH)
+
+def read_stats():
+    """Returns the janitor's running totals (files deleted, bytes reclaimed, last runs)."""
+    try:
+        with open(STATS_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _janitor_loop():
+    next_scan = time.time()
+    while True:
+        _wake.wait(QUEUE_CHECK_INTERVAL)
+        _wake.clear()
+        deleted, freed = process_queue()
+        if deleted:
+            _record('queued', deleted, freed)
+        if time.time() >= next_scan:
+            result = reclaim_orphans()
+            if result is not None:
+                deleted, freed = result
+                _record('orphan', deleted, freed)
+                print(f"Janitor: reclaimed {deleted} orphaned uploads, {freed / (1024 * 1024):.1f} MB")
+            next_scan = time.time() + SCAN_INTERVAL
+
+def start_janitor():
+    """Starts the janitor on a daemon thread."""
+    thread = threading.Thread(target=_janitor_loop, name="janitor", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,87 @@
+# services/pdf_links.py
+# Short-lived signed links for reading a book's PDF.
+#
+# Reading a book used to check the session, the subscription and the PDF path in
+# the database on every request. PDF.js fetches a document in many small range
+# requests, so that meant several database round trips per page turn. Instead,
+# the entitlement is checked once when a link is issued, and the link carries
+# everything needed to serve the file: the user, the book, the file path and an
+# expiry time, signed with HMAC so none of it can be changed. Serving a link only
+# checks the signature and the expiry.
+#
+# The signing secret comes from the PDF_LINK_SECRET environment variable. Without
+# it, the secret is kept in SECRET_PATH: the first server process to start makes
+# a random one there and every other process reads it, so a link issued by one
+# worker is accepted by all of them (PDF.js's range requests can land on any)
+# and links keep working across restarts. SECRET_PATH is in the home directory
+# of the user running the server (or PDF_LINK_SECRET_FILE), not in the working
+# tree, so nothing the server serves from its own directory can reach it.
+
+import base64
+import hashlib
+import hmac
+import os
+import time
+import uuid
+
+LINK_LIFETIME = 10 * 60
+FILE_PATH_PREFIX = '/files/pdf/'
+SECRET_PATH = os.environ.get("PDF_LINK_SECRET_FILE",
+                             os.path.join(os.path.expanduser("~"), ".ebook_reader", "pdf_link_secret"))
+
+def _shared_secret():
+    """Returns the secret in SECRET_PATH, making it first if no process has yet."""
+    try:
+        with open(SECRET_PATH, 'rb') as f:
+            secret = f.read()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(SECRET_PATH), mode=0o700, exist_ok=True)
+    temp_path = f"{SECRET_PATH}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(base64.b64encode(os.urandom(32)))
+    try:
+        # link() fails if another process got there first; then its secret is used
+        os.link(temp_path, SECRET_PATH)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+    with open(SECRET_PATH, 'rb') as f:
+        return f.read()
+
+_secret = os.environ.get("PDF_LINK_SECRET", "").encode('utf-8') or _shared_secret()
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(message):
+    return _b64encode(hmac.new(_secret, message.encode('ascii'), hashlib.sha256).digest())
+
+def issue_pdf_link(user_id, book_id, pdf_path, lifetime=LINK_LIFETIME):
+    """Returns (url, expires_at) for a link that serves the book's PDF until expires_at."""
+    expires_at = int(time.time()) + lifetime
+    payload = _b64encode(f"{int(user_id)}:{int(book_id)}:{expires_at}:{pdf_path}".encode('utf-8'))
+    return f"{FILE_PATH_PREFIX}{int(book_id)}?t={payload}.{_sign(payload)}", expires_at
+
+def verify_pdf_link(book_id, token):
+    """
+    Checks a link token for the given book. Returns {'user_id', 'pdf_path',
+    'expires_at'} if it is genuine and unexpired, otherwise None.
+    """
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        user_id, linked_book_id, expires_at, pdf_path = _b64decode(payload).decode('utf-8').split(':', 3)
+        if int(linked_book_id) != int(book_id) or int(expires_at) <= time.time():
+            return None
+        return {'user_id': int(user_id), 'pdf_path': pdf_path, 'expires_at': int(expires_at)}
+    except (ValueError, UnicodeDecodeError):
+        return None
@@ -0,0 +1,364 @@
+# services/pdf_text.py
+# Pulls the text out of a PDF file, page by page, using only the standard library.
+#
+# A PDF is a list of numbered objects. Pages are found by walking the page tree
+# from the document catalog, and each page's content stream (usually compressed
+# with zlib, "FlateDecode") is scanned for the text-showing operators Tj, TJ, '
+# and ". Strings are turned into text through the font selected with Tf: a font
+# with a /ToUnicode CMap (which CID fonts such as Identity-H ones need, and Word
+# and most PDF printers write) is decoded through it, other fonts are read as a
+# plain single-byte encoding. A CID font without a ToUnicode CMap has glyph codes
+# that say nothing about the characters, so its text is skipped rather than
+# indexed as noise.
+#
+# extract_pages() runs in a worker process (see services/fulltext.py), so it only
+# takes and returns plain, picklable values.
+
+import re
+import zlib
+
+_OBJECT_RE = re.compile(rb"(\d+)\s+(\d+)\s+obj\b(.*?)\bendobj", re.DOTALL)
+_STREAM_RE = re.compile(rb"stream\r?\n(.*?)\r?\n?endstream", re.DOTALL)
+_REF_RE = re.compile(rb"(\d+)\s+\d+\s+R")
+# Names, numbers and operators in a content stream
+_TOKEN_RE = re.compile(rb"/[^\s()<>\[\]{}/%]*|[^\s()<>\[\]{}/%]+|\S")
+
+# Escapes allowed inside a (literal string)
+_ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b',
+            ord('f'): b'\f', ord('('): b'(', ord(')'): b')', ord('\\'): b'\\'}
+
+# Kerning in a TJ array larger than this (in thousandths of an em) is a word gap
+_WORD_GAP = 200
+
+def _dict_value(dictionary, key):
+    """Returns the raw text after /key in a PDF dictionary, up to the next key."""
+    # A value is a /Name, an [array], or anything else up to the next key
+    match = re.search(rb"/" + key + rb"(?![A-Za-z])\s*(/[^\s/\[\]<>()]+|\[.*?\]|.*?)(?=\s*(?:/[A-Za-z]|>>|$))",
+                      dictionary, re.DOTALL)
+    return match.group(1).strip() if match else None
+
+def _refs(value):
+    """Returns the object numbers referenced ("12 0 R") in a dictionary value."""
+    return [int(number) for number in _REF_RE.findall(value or b'')]
+
+def _decode_stream(dictionary, data):
+    """Decompresses a stream if it uses FlateDecode. Returns None for other filters."""
+    filters = _dict_value(dictionary, b"Filter")
+    if not filters:
+        return data
+    if filters.replace(b'[', b'').replace(b']', b'').strip() != b"/FlateDecode":
+        return None
+    try:
+        return zlib.decompress(data)
+    except zlib.error:
+        # Some writers leave trailing bytes after the compressed data
+        try:
+            return zlib.decompressobj().decompress(data)
+        except zlib.error:
+            return None
+
+def _read_objects(raw):
+    """Returns {object number: (dictionary bytes, decoded stream bytes or None)}."""
+    objects = {}
+    for match in _OBJECT_RE.finditer(raw):
+        number, body = int(match.group(1)), match.group(3)
+        stream = _STREAM_RE.search(body)
+        if stream:
+            dictionary = body[:stream.start()]
+            objects[number] = (dictionary, _decode_stream(dictionary, stream.group(1)))
+        else:
+            objects[number] = (body, None)
+
+    # Newer PDFs pack small objects into compressed object streams
+    for dictionary, data in list(objects.values()):
+        if data is None or b"/ObjStm" not in dictionary:
+            continue
+        try:
+            count = int(_dict_value(dictionary, b"N"))
+            first = int(_dict_value(dictionary, b"First"))
+        except (TypeError, ValueError):
+            continue
+        header = data[:first].split()
+        offsets = [(int(header[i]), int(header[i + 1])) for i in range(0, min(len(header), 2 * count) - 1, 2)]
+        for i, (number, offset) in enumerate(offsets):
+            end = first + offsets[i + 1][1] if i + 1 < len(offsets) else len(data)
+            objects.setdefault(number, (data[first + offset:end], None))
+    return objects
+
+def _page_order(objects):
+    """Returns the object numbers of the pages, in reading order."""
+    pages = []
+    roots = [number for number, (dictionary, data) in objects.items()
+             if re.search(rb"/Type\s*/Pages\b", dictionary) and not _dict_value(dictionary, b"Parent")]
+    visited = set()
+
+    def walk(number):
+        if number in visited or number not in objects:
+            return
+        visited.add(number)
+        dictionary = objects[number][0]
+        if re.search(rb"/Type\s*/Pages\b", dictionary):
+            for kid in _refs(_dict_value(dictionary, b"Kids")):
+                walk(kid)
+        elif re.search(rb"/Type\s*/Page\b", dictionary):
+            pages.append(number)
+
+    for root in roots:
+        walk(root)
+    if not pages:
+        # No usable page tree: fall back to the order the pages appear in the file
+        pages = [number for number, (dictionary, data) in objects.items()
+                 if re.search(rb"/Type\s*/Page\b", dictionary)]
+    return pages
+
+def _read_literal(content, position):
+    """Reads a (literal string) starting at content[position] == '('. Returns (bytes, end)."""
+    out = bytearray()
+    depth = 1
+    i = position + 1
+    while i < len(content) and depth:
+        char = content[i]
+        if char == 0x5C:    # backslash
+            i += 1
+            if i >= len(content):
+                break
+            escaped = content[i]
+            if escaped in _ESCAPES:
+                out += _ESCAPES[escaped]
+            elif 0x30 <= escaped <= 0x37:   # octal \ddd
+                digits = content[i:i + 3]
+                length = 1
+                while length < len(digits) and 0x30 <= digits[length] <= 0x37:
+                    length += 1
+                out.append(int(digits[:length], 8) & 0xFF)
+                i += length - 1
+            # A backslash before a line break continues the string
+        elif char == 0x28:
+            depth += 1
+            out.append(char)
+        elif char == 0x29:
+            depth -= 1
+            if depth:
+                out.append(char)
+        else:
+            out.append(char)
+        i += 1
+    return bytes(out), i
+
+def _read_hex(content, position):
+    """Reads a <hex string> starting at content[position] == '<'. Returns (bytes, end)."""
+    end = content.find(b'>', position)
+    if end == -1:
+        return b'', len(content)
+    digits = re.sub(rb"\s", b"", content[position + 1:end])
+    if len(digits) % 2:
+        digits += b'0'
+    try:
+        return bytes.fromhex(digits.decode('ascii')), end + 1
+    except ValueError:
+        return b'', end + 1
+
+def _decode_text(data):
+    """Turns the bytes of a text string into str."""
+    if data.startswith(b'\xfe\xff'):
+        return data[2:].decode('utf-16-be', 'ignore')
+    return data.decode('latin-1')
+
+def _skip_text(data):
+    """Decoder for fonts whose codes cannot be turned into text."""
+    return ''
+
+def _utf16(hex_digits):
+    return bytes.fromhex(hex_digits.decode('ascii')).decode('utf-16-be', 'ignore')
+
+class ToUnicodeMap:
+    """The code -> text mapping of a /ToUnicode CMap (bfchar and bfrange entries)."""
+
+    def __init__(self, cmap):
+        self.mapping = {}
+        space = re.search(rb"begincodespacerange\s*<([0-9A-Fa-f]+)>", cmap)
+        # Bytes per character code: 2 for Identity-H fonts, 1 for simple fonts
+        self.width = max(1, len(space.group(1)) // 2) if space else 2
+        for block in re.findall(rb"beginbfchar(.*?)endbfchar", cmap, re.DOTALL):
+            for code, text in re.findall(rb"<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]*)>", block):
+                self.mapping[int(code, 16)] = _utf16(text)
+        for block in re.findall(rb"beginbfrange(.*?)endbfrange", cmap, re.DOTALL):
+            for low, high, text, texts in re.findall(
+                    rb"<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]+)>\s*(?:<([0-9A-Fa-f]*)>|\[(.*?)\])", block, re.DOTALL):
+                low, high = int(low, 16), int(high, 16)
+                if texts:
+                    for offset, item in enumerate(re.findall(rb"<([0-9A-Fa-f]*)>", texts)):
+                        self.mapping[low + offset] = _utf16(item)
+                elif text and high - low <= 0xFFFF:
+                    # Consecutive codes map to consecutive characters
+                    first = bytes.fromhex(text.decode('ascii'))
+                    prefix, last = first[:-2], int.from_bytes(first[-2:], 'big')
+                    for offset in range(high - low + 1):
+                        unit = ((last + offset) & 0xFFFF).to_bytes(2, 'big')
+                        self.mapping[low + offset] = (prefix + unit).decode('utf-16-be', 'ignore')
+
+    def decode(self, data):
+        width = self.width
+        mapping = self.mapping
+        return ''.join(mapping.get(int.from_bytes(data[i:i + width], 'big'), '')
+                       for i in range(0, len(data) - width + 1, width))
+
+def _dict_entry(dictionary, key, objects):
+    """Returns the dictionary under /key, written inline (<< >>) or as a reference, as bytes."""
+    match = re.search(rb"/" + key + rb"(?![A-Za-z])\s*", dictionary)
+    if not match:
+        return None
+    rest = dictionary[match.end():]
+    if rest.startswith(b'<<'):
+        depth = 0
+        i = 0
+        while i < len(rest):
+            if rest.startswith(b'<<', i):
+                depth += 1
+                i += 2
+            elif rest.startswith(b'>>', i):
+                depth -= 1
+                i += 2
+                if depth == 0:
+                    return rest[2:i - 2]
+            else:
+                i += 1
+        return None
+    ref = re.match(rb"(\d+)\s+\d+\s+R", rest)
+    if ref:
+        return objects.get(int(ref.group(1)), (None, None))[0]
+    return None
+
+def page_fonts(page_number, objects):
+    """
+    Returns {font resource name: decoder} for a page, from its own resources or
+    the nearest parent's. Fonts not listed are read as single-byte text.
+    """
+    resources = None
+    number = page_number
+    for _ in range(32):     # resources may be inherited from the page tree
+        dictionary = objects.get(number, (b'', None))[0]
+        resources = _dict_entry(dictionary, b"Resources", objects)
+        parents = _refs(_dict_value(dictionary, b"Parent"))
+        if resources is not None or not parents:
+            break
+        number = parents[0]
+    fonts = _dict_entry(resources or b'', b"Font", objects)
+    decoders = {}
+    for name, font_number in re.findall(rb"/([^\s/<>\[\]()]+)\s+(\d+)\s+\d+\s+R", fonts or b''):
+        font = objects.get(int(font_number), (b'', None))[0]
+        cmap_refs = _refs(_dict_value(font, b"ToUnicode"))
+        cmap = objects.get(cmap_refs[0], (None, None))[1] if cmap_refs else None
+        if cmap:
+            decoders[name] = ToUnicodeMap(cmap).decode
+        elif re.search(rb"/Subtype\s*/Type0\b", font):
+            decoders[name] = _skip_text
+    return decoders
+
+def content_text(content, fonts=None):
+    """
+    Returns the text shown by a page content stream. `fonts` maps font resource
+    names to decoders (see page_fonts()).
+    """
+    fonts = fonts or {}
+    decode = _decode_text
+    name = None     # the last /Name seen, the font for a following Tf
+    size = 0        # the font size set by Tf
+    y = 0.0         # the baseline the next text goes on
+    shown_y = None  # the baseline of the text shown last
+    parts = []
+    operands = []   # strings and numbers since the last operator
+    i = 0
+    length = len(content)
+    while i < length:
+        char = content[i]
+        if char == 0x28:        # (
+            value, i = _read_literal(content, i)
+            operands.append(value)
+            continue
+        if char == 0x3C and content[i + 1:i + 2] != b'<':     # <hex>, not <<
+            value, i = _read_hex(content, i)
+            operands.append(value)
+            continue
+        if char == 0x25:        # % comment
+            end = content.find(b'\n', i)
+            i = length if end == -1 else end
+            continue
+        if char in b'[]':
+            operands.append(chr(char))
+            i += 1
+            continue
+        match = _TOKEN_RE.match(content, i)
+        if not match:
+            i += 1
+            continue
+        token = match.group(0)
+        i = match.end()
+        if token[:1] == b'/':
+            name = token[1:]
+            continue
+        if token in (b'<<', b'>>', b'{', b'}'):
+            continue
+        try:
+            operands.append(float(token))
+            continue
+        except ValueError:
+            pass
+
+        # token is an operator
+        numbers = [value for value in operands if isinstance(value, float)]
+        if token in (b'Tj', b"'", b'"', b'TJ'):
+            if token in (b"'", b'"'):
+                y -= 1      # these move to the next line first
+            # Many writers place every glyph with its own Td, so lines are only
+            # broken where the baseline moves
+            if shown_y is not None and abs(y - shown_y) > 0.001:
+                parts.append('\n')
+            shown_y = y
+            if token == b'TJ':
+                for value in operands:
+                    if isinstance(value, bytes):
+                        parts.append(decode(value))
+                    elif isinstance(value, float) and value < -_WORD_GAP:
+                        parts.append(' ')
+            else:
+                strings = [value for value in operands if isinstance(value, bytes)]
+                if strings:
+                    parts.append(decode(strings[-1]))
+        elif token == b'Tf':
+            decode = fonts.get(name, _decode_text)
+            size = abs(numbers[-1]) if numbers else 0
+        elif token in (b'Td', b'TD') and len(numbers) >= 2:
+            y += numbers[-1]
+            # A jump wider than a glyph is a word gap (an extra space does no harm)
+            if numbers[-1] == 0 and abs(numbers[-2]) > max(size, 1):
+                parts.append(' ')
+        elif token == b'Tm' and len(numbers) >= 6:
+            y = numbers[5]
+            parts.append(' ')
+        elif token == b'T*':
+            y -= 1
+        elif token == b'BT':
+            y = 0.0
+        operands = []
+    return ''.join(parts)
+
+def extract_pages(path):
+    """
+    Returns the text of each page of the PDF at `path`, as a list of strings
+    (page 1 first). Raises OSError if the file cannot be read.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    objects = _read_objects(raw)
+    pages = []
+    for number in _page_order(objects):
+        dictionary = objects[number][0]
+        fonts = page_fonts(number, objects)
+        texts = []
+        for stream_number in _refs(_dict_value(dictionary, b"Contents")):
+            data = objects.get(stream_number, (None, None))[1]
+            if data:
+                texts.append(content_text(data, fonts))
+        pages.append('\n'.join(texts))
+    return pages
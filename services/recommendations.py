@@ -0,0 +1,230 @@
+# services/recommendations.py
+# "Readers also read" recommendations from an item-item co-occurrence model.
+#
+# Two books co-occur when the same user has read or bookmarked both. The model is
+# a sparse matrix stored as a dictionary of rows: co_counts[book_a][book_b] is the
+# number of users who interacted with both books. Scores are normalised by how
+# popular each book is (cosine similarity), so best-sellers don't crowd out
+# everything else.
+#
+# The model is rebuilt from the database in the background every
+# REBUILD_INTERVAL seconds and updated in place by record_interaction() between
+# rebuilds, so new reads and bookmarks show up immediately.
+#
+# The per-user book sets are saved in the read-model snapshots
+# (services/snapshots.py), so after a restart the model is rebuilt from them in
+# memory and only the interactions since the last rebuild are read. When the
+# last rebuild began is taken from the database clock, which is what stamps the
+# interactions, not from this server's clock.
+
+import heapq
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from db.bookmark_queries import stream_user_book_interactions, get_user_book_interactions_since
+from db.connection import StreamInterrupted, get_database_time
+from services import snapshots
+
+REBUILD_INTERVAL = 60 * 60
+# Catching up re-reads the interactions from this long before the watermark;
+# ones the model already has are not counted twice
+WATERMARK_SLACK = timedelta(minutes=5)
+
+# Only this many books per user take part in pair counting. A heavy reader adds
+# k*(k-1)/2 pairs, so the cap keeps rebuild time bounded as history grows.
+MAX_ITEMS_PER_USER = 200
+
+class CoOccurrenceModel:
+    """Sparse item-item co-occurrence counts plus the per-user item sets they came from."""
+
+    def __init__(self):
+        self.user_items = {}    # user_id -> set of book_ids counted for that user
+        self.item_counts = {}   # book_id -> number of users who interacted with it
+        self.co_counts = {}     # book_id -> {other_book_id: users who have both}
+        self._top_cache = {}    # book_id -> (limit, cached recommendation list)
+
+    def add(self, user_id, book_id):
+        """Adds one (user, book) interaction. Returns False if it was already counted."""
+        items = self.user_items.get(user_id)
+        if items is None:
+            items = self.user_items[user_id] = set()
+        if book_id in items or len(items) >= MAX_ITEMS_PER_USER:
+            return False
+
+        row = self.co_counts.get(book_id)
+        if row is None:
+            row = self.co_counts[book_id] = {}
+        for other in items:
+            row[other] = row.get(other, 0) + 1
+            other_row = self.co_counts[other]
+            other_row[book_id] = other_row.get(book_id, 0) + 1
+        items.add(book_id)
+        self.item_counts[book_id] = self.item_counts.get(book_id, 0) + 1
+        # The book's popularity changed, so every list it appears in is stale
+        self._top_cache.pop(book_id, None)
+        for other in row:
+            self._top_cache.pop(other, None)
+        return True
+
+    def similar(self, book_id, limit=10):
+        """Returns up to `limit` (book_id, score) pairs for books read alongside book_id."""
+        cached = self._top_cache.get(book_id)
+        if cached is not None and cached[0] >= limit:
+            return cached[1][:limit]
+        row = self.co_counts.get(book_id)
+        if not row:
+            return []
+        base = self.item_counts[book_id]
+        counts = self.item_counts
+        scored = ((count / math.sqrt(base * counts[other]), other) for other, count in row.items())
+        top = [(other, round(score, 4)) for score, other in heapq.nlargest(limit, scored)]
+        self._top_cache[book_id] = (limit, top)
+        return top
+
+def build_model(batches):
+    """
+    Builds a model from batches of (user_id, book_id) rows ordered by user.
+    Each user's books are collected, then all of their pairs are counted at once.
+    """
+    model = CoOccurrenceModel()
+    co_counts = model.co_counts
+    current_user, current_items = None, []
+
+    def flush(user_id, items):
+        items = items[:MAX_ITEMS_PER_USER]
+        model.user_items[user_id] = set(items)
+        for book_id in items:
+            model.item_counts[book_id] = model.item_counts.get(book_id, 0) + 1
+            row = co_counts.get(book_id)
+            if row is None:
+                row = co_counts[book_id] = {}
+            for other in items:
+                if other != book_id:
+                    row[other] = row.get(other, 0) + 1
+
+    for batch in batches:
+        for user_id, book_id in batch:
+            if user_id != current_user:
+                if current_items:
+                    flush(current_user, current_items)
+                current_user, current_items = user_id, []
+            current_items.append(book_id)
+    if current_items:
+        flush(current_user, current_items)
+    return model
+
+# --- Shared model used by the server ---
+
+_model = CoOccurrenceModel()
+_lock = threading.Lock()
+# Interactions recorded while a rebuild is running, replayed onto the new model
+_pending = None
+# Watermark of the model: the database's time when its last rebuild or
+# catch-up began (a datetime)
+_state = {'as_of': None}
+
+def rebuild():
+    """Rebuilds the shared model from the database. Returns False if the query failed."""
+    global _model, _pending
+    as_of = get_database_time()
+    if as_of is None:
+        return False
+    # Start collecting new interactions before the query so none can slip through
+    with _lock:
+        _pending = []
+    began = time.perf_counter()
+    stream = stream_user_book_interactions()
+    model = None
+    if stream is not None:
+        try:
+            model = build_model(stream)
+        except StreamInterrupted:
+            model = None    # a partial model would be missing readers
+        finally:
+            stream.close()
+    with _lock:
+        pending, _pending = _pending, None
+        if model is None:
+            return False
+        for user_id, book_id in pending:
+            model.add(user_id, book_id)
+        _model = model
+        _state['as_of'] = as_of
+    print(f"Recommendation model rebuilt: {len(model.item_counts)} books, "
+          f"{len(model.user_items)} readers in {time.perf_counter() - began:.1f}s")
+    return True
+
+def restore_snapshot():
+    """
+    Rebuilds the model from the book sets saved in the last snapshot, then reads
+    the interactions since its watermark. Returns False if there was no snapshot
+    or the database could not be read; the model is rebuilt in full then.
+    """
+    global _model
+    saved = snapshots.load('recommendations')
+    if saved is None:
+        return False
+    user_items, watermark = saved
+    began = time.time()
+    as_of = get_database_time()
+    if as_of is None:
+        return False
+    # One batch per user, as build_model expects them grouped
+    model = build_model([(user_id, book_id) for book_id in items] for user_id, items in user_items.items())
+    rows = get_user_book_interactions_since(datetime.fromisoformat(watermark['as_of']) - WATERMARK_SLACK)
+    if rows is None:
+        return False
+    with _lock:
+        for user_id, book_id in rows:
+            model.add(user_id, book_id)
+        # Interactions recorded meanwhile went to the old model
+        for user_id, items in _model.user_items.items():
+            for book_id in items:
+                model.add(user_id, book_id)
+        _model = model
+        _state['as_of'] = as_of
+    print(f"Recommendation model restored from snapshot: {len(model.item_counts)} books, "
+          f"{len(model.user_items)} readers, {len(rows)} new interactions in {time.time() - began:.1f}s")
+    return True
+
+def _snapshot():
+    """The model's section of the read-model snapshots, or None before it is built."""
+    with _lock:
+        if _state['as_of'] is None:
+            return None
+        user_items = {user_id: tuple(items) for user_id, items in _model.user_items.items()}
+        return user_items, {'as_of': _state['as_of'].isoformat()}
+
+def record_interaction(user_id, book_id):
+    """Counts a new read or bookmark immediately, without waiting for the next rebuild."""
+    try:
+        user_id, book_id = int(user_id), int(book_id)
+    except (TypeError, ValueError):
+        return
+    with _lock:
+        _model.add(user_id, book_id)
+        if _pending is not None:
+            _pending.append((user_id, book_id))
+
+def get_similar_books(book_id, limit=10):
+    """Returns up to `limit` (book_id, score) pairs for "readers also read"."""
+    with _lock:
+        return _model.similar(book_id, limit)
+
+def _refresh_loop():
+    if restore_snapshot():
+        time.sleep(REBUILD_INTERVAL)
+    while True:
+        rebuild()
+        time.sleep(REBUILD_INTERVAL)
+
+def start_background_rebuild():
+    """
+    Builds the model now (from the snapshot if there is one) and then every
+    REBUILD_INTERVAL seconds, on a daemon thread.
+    """
+    snapshots.register('recommendations', _snapshot)
+    thread = threading.Thread(target=_refresh_loop, name="recommendations", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,281 @@
+# services/search.py
+# Typo-tolerant search over book titles, author names and publisher names.
+#
+# Texts are split into words. Every distinct word is indexed by its character
+# trigrams ("bank" -> "$ba", "ban", "ank", "nk$"). A query word first collects
+# candidate words that share enough trigrams with it, then each candidate is
+# checked with an edit distance that gives up as soon as it exceeds the allowed
+# number of typos. This finds "Bangladesh" for "Bangladsh" and "Bangla" for
+# "Bngla" without comparing the query against every title.
+#
+# The index is filled from the in-memory catalog (services/catalog.py), which
+# calls put_book() and remove_book() as books change.
+
+import heapq
+import re
+import threading
+from collections import Counter
+from itertools import chain, repeat
+from operator import itemgetter
+
+# The three kinds of indexed entries
+TITLE, AUTHOR, PUBLISHER = 'title', 'author', 'publisher'
+
+# Results scoring below this (0..1) are dropped
+MIN_SCORE = 0.5
+
+_WORD_RE = re.compile(r"[^\W_]+")
+
+def normalize_words(text):
+    """Lowercases a text and splits it into words, dropping punctuation."""
+    return _WORD_RE.findall(text.lower()) if text else []
+
+def max_typos(word):
+    """How many edits a query word may be away from a match: none for short words."""
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 5:
+        return 1
+    return 2
+
+def trigrams(word, prefix=False):
+    """Returns the set of padded trigrams of a word. Prefixes get no end marker."""
+    padded = '$' + word if prefix else '$' + word + '$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} or {padded}
+
+def bounded_edit_distance(a, b, limit):
+    """
+    Levenshtein distance between a and b, or limit + 1 as soon as it is clear the
+    distance is larger than limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        row_min = i
+        for j, char_b in enumerate(b, 1):
+            cost = 0 if char_a == char_b else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            current.append(value)
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class FuzzyIndex:
+    """
+    Word-level trigram index over three kinds of entries: book titles (keyed by
+    book_id), author names (keyed by the lowercased name) and publishers (keyed by
+    publisher_id). Authors and publishers are indexed once however many books they
+    have, and are reference counted so they disappear with their last book.
+    """
+
+    def __init__(self):
+        self.books = {}         # book_id -> (title, author_name, publisher_id, publisher_name)
+        # field -> key -> [display text, number of books using the entry]
+        self.entries = {TITLE: {}, AUTHOR: {}, PUBLISHER: {}}
+        self.postings = {}      # word -> {field: set of entry keys containing the word}
+        self.grams = {}         # trigram -> set of words
+
+    def _index_entry(self, field, key, text):
+        for word in set(normalize_words(text)):
+            fields = self.postings.get(word)
+            if fields is None:
+                fields = self.postings[word] = {}
+                for gram in trigrams(word):
+                    self.grams.setdefault(gram, set()).add(word)
+            fields.setdefault(field, set()).add(key)
+
+    def _unindex_entry(self, field, key, text):
+        for word in set(normalize_words(text)):
+            fields = self.postings.get(word)
+            if fields is None:
+                continue
+            keys = fields.get(field)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del fields[field]
+            if not fields:
+                del self.postings[word]
+                for gram in trigrams(word):
+                    words = self.grams.get(gram)
+                    if words is not None:
+                        words.discard(word)
+                        if not words:
+                            del self.grams[gram]
+
+    def _acquire(self, field, key, text):
+        entry = self.entries[field].get(key)
+        if entry is None:
+            self.entries[field][key] = [text, 1]
+            self._index_entry(field, key, text)
+        else:
+            entry[1] += 1
+
+    def _release(self, field, key):
+        entry = self.entries[field].get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.entries[field][key]
+            self._unindex_entry(field, key, entry[0])
+
+    def put(self, book_id, title, author_name, publisher_id, publisher_name):
+        """Indexes a book, replacing whatever was indexed for it before."""
+        self.remove(book_id)
+        self.books[book_id] = (title, author_name, publisher_id, publisher_name)
+        self._acquire(TITLE, book_id, title)
+        if author_name:
+            self._acquire(AUTHOR, author_name.strip().lower(), author_name)
+        if publisher_name:
+            self._acquire(PUBLISHER, publisher_id, publisher_name)
+
+    def remove(self, book_id):
+        """Removes a book from the index."""
+        entry = self.books.pop(book_id, None)
+        if entry is None:
+            return
+        title, author_name, publisher_id, publisher_name = entry
+        self._release(TITLE, book_id)
+        if author_name:
+            self._release(AUTHOR, author_name.strip().lower())
+        if publisher_name:
+            self._release(PUBLISHER, publisher_id)
+
+    def _candidates(self, token, prefix):
+        """Returns {word: similarity} for indexed words within the typo limit of token."""
+        limit = max_typos(token)
+        token_grams = trigrams(token, prefix)
+        # Each edit changes at most 3 trigrams, so a match shares at least this many
+        needed = max(1, len(token_grams) - 3 * limit)
+        shared = {}
+        for gram in token_grams:
+            for word in self.grams.get(gram, ()):
+                shared[word] = shared.get(word, 0) + 1
+
+        # A prefix allows one typo fewer, or "bank" would match every "bang..." word
+        prefix_limit = max(0, limit - 1)
+        matches = {}
+        for word, count in shared.items():
+            if count < needed:
+                continue
+            distance = bounded_edit_distance(token, word, limit)
+            if prefix and distance > 0 and len(word) > len(token):
+                prefix_distance = bounded_edit_distance(token, word[:len(token)], prefix_limit)
+                if prefix_distance <= prefix_limit:
+                    distance = min(distance, prefix_distance)
+            if distance <= limit:
+                matches[word] = 1.0 - distance / (len(token) + 1)
+        return matches
+
+    def _rank(self, field, token_matches, limit):
+        """
+        Ranks the entries of one field. An entry's score is the mean, over query
+        words, of the best similarity of any of its words. Only entries matching
+        every query word are scored, unless there are too few of them.
+        """
+        if len(token_matches) == 1:
+            # One query word: take entries from the best matching words first
+            top, seen = [], set()
+            for word, similarity in sorted(token_matches[0].items(), key=itemgetter(1), reverse=True):
+                if similarity < MIN_SCORE:
+                    break
+                for key in self.postings[word].get(field, ()):
+                    if key not in seen:
+                        seen.add(key)
+                        top.append((similarity, key))
+                        if len(top) == limit:
+                            return top
+            return top
+
+        # Per query word: {entry key: best similarity}. Candidates are applied from
+        # worst to best so dict.update keeps the best one.
+        per_token = []
+        for matches in token_matches:
+            scores = {}
+            for word, similarity in sorted(matches.items(), key=lambda item: item[1]):
+                keys = self.postings[word].get(field)
+                if keys:
+                    scores.update(dict.fromkeys(keys, similarity))
+            per_token.append(scores)
+
+        tokens = len(per_token)
+        # Words that match nothing (like "to") still count against the score,
+        # but must not empty the intersection below
+        live = [scores for scores in per_token if scores]
+        if not live:
+            return []
+
+        # Entries matching every query word come first; a set intersection finds them
+        candidates = set(live[0]).intersection(*live[1:])
+        if len(candidates) < limit:
+            # Not enough: also take entries matching enough words to reach MIN_SCORE
+            needed = max(1, int(tokens * MIN_SCORE + 0.999))
+            hits = Counter(chain.from_iterable(live))
+            candidates = [key for key, count in hits.items() if count >= needed]
+
+        # Sum each candidate's similarities column by column; map/zip keep the
+        # per-candidate work out of the Python loop
+        candidates = list(candidates)
+        columns = [map(scores.get, candidates, repeat(0.0)) for scores in live]
+        totals = map(sum, zip(*columns))
+        top = heapq.nlargest(limit, zip(totals, candidates), key=itemgetter(0))
+        return [(total / tokens, key) for total, key in top if total / tokens >= MIN_SCORE]
+
+    def search(self, query, limit=10):
+        """
+        Returns ranked near-matches for the query as a dictionary with 'books',
+        'authors' and 'publishers' lists. The last query word also matches as a
+        prefix, so results show up while the user is still typing.
+        """
+        tokens = normalize_words(query)
+        if not tokens:
+            return {'books': [], 'authors': [], 'publishers': []}
+        token_matches = [self._candidates(token, number == len(tokens) - 1 and len(token) >= 3)
+                         for number, token in enumerate(tokens)]
+
+        titles, authors, publishers = self.entries[TITLE], self.entries[AUTHOR], self.entries[PUBLISHER]
+        return {
+            'books': [{'book_id': key, 'name': titles[key][0], 'score': round(score, 3)}
+                      for score, key in self._rank(TITLE, token_matches, limit)],
+            'authors': [{'name': authors[key][0], 'book_count': authors[key][1], 'score': round(score, 3)}
+                        for score, key in self._rank(AUTHOR, token_matches, limit)],
+            'publishers': [{'publisher_id': key, 'name': publishers[key][0], 'score': round(score, 3)}
+                           for score, key in self._rank(PUBLISHER, token_matches, limit)],
+        }
+
+# --- Shared index used by the server ---
+
+_index = FuzzyIndex()
+_lock = threading.Lock()
+
+def rebuild(book_rows):
+    """Replaces the shared index with one built from catalog rows (as dictionaries)."""
+    global _index
+    index = FuzzyIndex()
+    for book in book_rows:
+        index.put(book['book_id'], book['name'], book['author_name'],
+                  book['publisher_id'], book['publisher_name'])
+    with _lock:
+        _index = index
+
+def put_book(book):
+    """Indexes one added or updated book (a catalog row as a dictionary)."""
+    with _lock:
+        _index.put(book['book_id'], book['name'], book['author_name'],
+                   book['publisher_id'], book['publisher_name'])
+
+def remove_book(book_id):
+    """Removes a deleted book from the index."""
+    with _lock:
+        _index.remove(book_id)
+
+def fuzzy_search(query, limit=10):
+    """Returns ranked near-matches for books, authors and publishers."""
+    with _lock:
+        return _index.search(query, limit)
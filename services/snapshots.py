@@ -0,0 +1,175 @@
+# services/snapshots.py
+# Snapshots of the in-memory read models, so a restart does not rebuild them
+# from full table scans.
+#
+# The catalog, the categories and the recommendation model each register a
+# section: a function returning (value, watermark), where value is made of
+# plain types (tuples, lists, dicts, strings, numbers) and watermark says how
+# current it is, e.g. {'as_of': '2024-05-01T12:00:00', 'max_book_id': 1234}. Every
+# SNAPSHOT_INTERVAL seconds, and when the server stops, the sections are written
+# to SNAPSHOT_PATH. At startup each service loads its section and then only asks
+# the database for what changed after the watermark.
+#
+# The file is binary and versioned:
+#
+#   MAGIC (8 bytes) | header length (4 bytes, big-endian) | header (JSON) | sections
+#
+# The header holds FORMAT_VERSION, the Python version (sections are encoded with
+# marshal, whose format may change between versions), and each section's offset,
+# length, CRC-32 and watermark. The file is opened with mmap and a section is
+# only decoded when it is asked for, straight from the mapping. A file that is
+# missing, from another version, or damaged is ignored, and the services load
+# from the database as before. Like the other files in data/, a snapshot is
+# written to a temporary file and renamed, so it is never read half-written.
+
+import json
+import marshal
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+SNAPSHOT_PATH = os.path.join("data", "snapshots", "read_models.snap")
+SNAPSHOT_INTERVAL = 5 * 60
+MAGIC = b'EBOOKSNP'
+FORMAT_VERSION = 2
+
+_lock = threading.Lock()
+_sections = {}                  # name -> dump function
+_file = {'loaded': False, 'mapping': None, 'header': None}
+
+def _python_version():
+    return f"{sys.version_info[0]}.{sys.version_info[1]}"
+
+def _open_snapshot():
+    """Maps the snapshot file and checks its header, once. Returns the header or None."""
+    if _file['loaded']:
+        return _file['header']
+    _file['loaded'] = True
+    try:
+        with open(SNAPSHOT_PATH, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None    # no snapshot yet (or an empty file)
+    try:
+        if mapping[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a snapshot file")
+        start = len(MAGIC) + 4
+        (header_length,) = struct.unpack('>I', mapping[len(MAGIC):start])
+        header = json.loads(mapping[start:start + header_length])
+        if header.get('format') != FORMAT_VERSION or header.get('python') != _python_version():
+            raise ValueError("written by another version")
+        header['data_start'] = start + header_length
+    except (ValueError, struct.error) as e:
+        print(f"Ignoring snapshot {SNAPSHOT_PATH}: {e}")
+        mapping.close()
+        return None
+    _file['mapping'] = mapping
+    _file['header'] = header
+    return header
+
+def _section_bytes(name):
+    """Returns a memoryview of a section's encoded data in the mapping, or None."""
+    header = _open_snapshot()
+    if header is None or name not in header['sections']:
+        return None
+    entry = header['sections'][name]
+    start = header['data_start'] + entry['offset']
+    data = memoryview(_file['mapping'])[start:start + entry['length']]
+    if len(data) != entry['length'] or zlib.crc32(data) != entry['crc']:
+        print(f"Ignoring damaged snapshot section {name}")
+        return None
+    return data
+
+def load(name):
+    """
+    Returns (value, watermark) for a section of the snapshot taken before the
+    restart, or None if there is none.
+    """
+    with _lock:
+        data = _section_bytes(name)
+        if data is None:
+            return None
+        try:
+            value = marshal.loads(data)
+        except (ValueError, EOFError, TypeError) as e:
+            print(f"Ignoring unreadable snapshot section {name}: {e}")
+            return None
+        finally:
+            data.release()
+        return value, _file['header']['sections'][name]['watermark']
+
+def register(name, dump):
+    """
+    Adds a section to the snapshots. dump() returns (value, watermark), or None
+    when there is nothing to save yet; then the section from the previous
+    snapshot is kept.
+    """
+    with _lock:
+        _sections[name] = dump
+
+def save():
+    """Writes a snapshot of every registered section. Returns False if it could not be written."""
+    began = time.perf_counter()
+    encoded = {}
+    for name, dump in list(_sections.items()):
+        try:
+            result = dump()
+            if result is not None:
+                encoded[name] = (marshal.dumps(result[0]), result[1])
+        except (ValueError, TypeError) as e:
+            print(f"Could not snapshot {name}: {e}")
+
+    with _lock:
+        # Keep the previous snapshot's copy of sections that had nothing new
+        header = _open_snapshot()
+        for name in (header or {}).get('sections', {}):
+            if name not in encoded and name in _sections:
+                data = _section_bytes(name)
+                if data is not None:
+                    encoded[name] = (bytes(data), header['sections'][name]['watermark'])
+                    data.release()
+
+        sections, offset = {}, 0
+        for name, (data, watermark) in encoded.items():
+            sections[name] = {'offset': offset, 'length': len(data), 'crc': zlib.crc32(data), 'watermark': watermark}
+            offset += len(data)
+        header_bytes = json.dumps({'format': FORMAT_VERSION, 'python': _python_version(),
+                                   'written_at': time.time(), 'sections': sections}).encode('utf-8')
+        temp_path = f"{SNAPSHOT_PATH}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack('>I', len(header_bytes)))
+                f.write(header_bytes)
+                for data, watermark in encoded.values():
+                    f.write(data)
+            os.replace(temp_path, SNAPSHOT_PATH)
+        except OSError as e:
+            print(f"Could not write snapshot: {e}")
+            return False
+        # The next read maps the new file
+        if _file['mapping'] is not None:
+            try:
+                _file['mapping'].close()
+            except BufferError:
+                pass    # a section is still being decoded; it is closed when let go
+        _file.update(loaded=False, mapping=None, header=None)
+    size = offset + len(header_bytes)
+    print(f"Snapshot written: {', '.join(sections)} ({size / 1024:.0f} KB) in {time.perf_counter() - began:.2f}s")
+    return True
+
+def _snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        save()
+
+def start_snapshot_writer():
+    """Saves a snapshot every SNAPSHOT_INTERVAL seconds, on a daemon thread."""
+    thread = threading.Thread(target=_snapshot_loop, name="snapshots", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,58 @@
+# services/static_gzip.py
+# Gzipped copies of the static CSS and JavaScript, made once at startup.
+#
+# Compressing a script on every request would cost more than sending it, so
+# precompress_static() writes a .gz copy of every compressible file under
+# STATIC_FOLDERS into GZIP_DIR, and the static file handler sends that copy to
+# browsers that accept gzip. A copy is only used while it is newer than its
+# source, so an asset edited after startup is sent uncompressed rather than
+# stale until the next restart compresses it again.
+
+import gzip
+import os
+
+GZIP_DIR = os.path.join("data", "static_gz")
+STATIC_FOLDERS = (os.path.join("static", "css"), os.path.join("static", "js"))
+COMPRESSIBLE_TYPES = ('.css', '.js', '.mjs', '.html', '.svg', '.json', '.txt')
+
+def is_compressible(path):
+    return path.endswith(COMPRESSIBLE_TYPES)
+
+def _gzip_path(path):
+    return os.path.join(GZIP_DIR, os.path.normpath(path) + '.gz')
+
+def precompress_static():
+    """Writes a gzipped copy of each static asset that has none or an old one. Returns True."""
+    written = 0
+    for folder in STATIC_FOLDERS:
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                if not is_compressible(path) or gzipped_version(path):
+                    continue
+                target = _gzip_path(path)
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    temp_path = target + ".tmp"
+                    with open(temp_path, 'wb') as f:
+                        # mtime=0 keeps the output the same for the same input
+                        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+                    os.replace(temp_path, target)
+                    written += 1
+                except OSError as e:
+                    print(f"Could not precompress {path}: {e}")
+    if written:
+        print(f"Precompressed {written} static files")
+    return True
+
+def gzipped_version(path):
+    """Returns the path of an up-to-date gzipped copy of a static file, or None."""
+    target = _gzip_path(path)
+    try:
+        if os.path.getmtime(target) >= os.path.getmtime(path):
+            return target
+    except OSError:
+        pass
+    return None
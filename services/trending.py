@@ -0,0 +1,166 @@
+# services/trending.py
+# Trending and popular book rankings from time-decayed read counters.
+#
+# Every read adds 1 to a book's counters, and older reads count for less and less:
+# a read loses half its weight every TRENDING_HALF_LIFE for "trending" and every
+# POPULAR_HALF_LIFE for "popular". The counters use forward decay: instead of
+# shrinking every score as time passes, new reads are added with a weight that
+# grows over time. All scores then share one decay factor, so their order only
+# changes when a read happens, and a small top-K table can be kept up to date on
+# each read instead of sorting the whole catalog per request.
+#
+# Scores are saved to the book_popularity table every SNAPSHOT_INTERVAL seconds
+# and loaded back at startup.
+
+import datetime
+import math
+import threading
+import time
+from db.popularity_queries import get_book_popularity, save_book_popularity
+
+TRENDING_HALF_LIFE = 24 * 60 * 60
+POPULAR_HALF_LIFE = 30 * 24 * 60 * 60
+TOP_K = 100
+SNAPSHOT_INTERVAL = 5 * 60
+
+SORT_MODES = ('trending', 'popular')
+
+class DecayedTopK:
+    """Exponentially decayed per-book counters plus a table of the K highest scores."""
+
+    def __init__(self, half_life, k=TOP_K):
+        self.rate = math.log(2) / half_life
+        self.k = k
+        self.landmark = time.time()
+        self.scores = {}        # book_id -> score relative to the landmark
+        self.top = {}           # the k best entries of self.scores
+        self._ranking = None    # cached list of top book_ids, best first
+
+    def _rescale(self, now):
+        """Moves the landmark to now so the growing weights never overflow."""
+        factor = math.exp(-self.rate * (now - self.landmark))
+        self.scores = {book_id: score * factor for book_id, score in self.scores.items()}
+        self.top = {book_id: self.scores[book_id] for book_id in self.top}
+        self.landmark = now
+
+    def add(self, book_id, weight=1.0, now=None):
+        """Adds `weight` reads of a book at time `now`."""
+        now = now or time.time()
+        exponent = self.rate * (now - self.landmark)
+        if exponent > 50:
+            self._rescale(now)
+            exponent = 0.0
+        score = self.scores.get(book_id, 0.0) + weight * math.exp(exponent)
+        self.scores[book_id] = score
+
+        if book_id in self.top or len(self.top) < self.k:
+            self.top[book_id] = score
+            self._ranking = None
+        else:
+            lowest = min(self.top, key=self.top.get)
+            if score > self.top[lowest]:
+                del self.top[lowest]
+                self.top[book_id] = score
+                self._ranking = None
+
+    def remove(self, book_id):
+        """Forgets a book (e.g. after it is deleted)."""
+        self.scores.pop(book_id, None)
+        if self.top.pop(book_id, None) is not None:
+            # Refill the freed slot with the best book outside the table
+            outside = [b for b in self.scores if b not in self.top]
+            if outside:
+                best = max(outside, key=self.scores.get)
+                self.top[best] = self.scores[best]
+            self._ranking = None
+
+    def value(self, book_id, now=None):
+        """Returns a book's current decayed read count."""
+        now = now or time.time()
+        return self.scores.get(book_id, 0.0) * math.exp(-self.rate * (now - self.landmark))
+
+    def ranking(self):
+        """Returns the top book_ids, best first."""
+        if self._ranking is None:
+            self._ranking = sorted(self.top, key=self.top.get, reverse=True)
+        return self._ranking
+
+# --- Shared counters used by the server ---
+
+_counters = {
+    'trending': DecayedTopK(TRENDING_HALF_LIFE),
+    'popular': DecayedTopK(POPULAR_HALF_LIFE),
+}
+_lock = threading.Lock()
+
+def record_read(book_id):
+    """Counts one read of a book in both rankings."""
+    try:
+        book_id = int(book_id)
+    except (TypeError, ValueError):
+        return
+    now = time.time()
+    with _lock:
+        for counter in _counters.values():
+            counter.add(book_id, now=now)
+
+def forget_book(book_id):
+    """Removes a deleted book from both rankings."""
+    with _lock:
+        for counter in _counters.values():
+            counter.remove(int(book_id))
+
+def get_ranking(sort):
+    """Returns the top book_ids for 'trending' or 'popular', best first."""
+    with _lock:
+        return list(_counters[sort].ranking())
+
+def rank_rows(rows, sort, id_index=0):
+    """
+    Orders catalog rows for the given sort mode: ranked books first, best first,
+    followed by every other row in its original order. Only the (at most TOP_K)
+    ranked rows are sorted.
+    """
+    positions = {book_id: i for i, book_id in enumerate(get_ranking(sort))}
+    ranked, rest = [], []
+    for row in rows:
+        position = positions.get(row[id_index])
+        if position is None:
+            rest.append(row)
+        else:
+            ranked.append((position, row))
+    ranked.sort(key=lambda pair: pair[0])
+    return [row for position, row in ranked] + rest
+
+def save_snapshot():
+    """Writes every book's current decayed scores to the database."""
+    now = time.time()
+    with _lock:
+        trending, popular = _counters['trending'], _counters['popular']
+        rows = [(book_id, trending.value(book_id, now), popular.value(book_id, now),
+                 datetime.datetime.fromtimestamp(now))
+                for book_id in popular.scores]
+    return save_book_popularity(rows)
+
+def load_snapshot():
+    """Loads the saved scores, decayed from when they were saved until now."""
+    now = time.time()
+    rows = get_book_popularity()
+    with _lock:
+        for book_id, trending_score, popular_score, updated_at in rows:
+            age = max(0.0, now - updated_at.timestamp())
+            for counter, score in ((_counters['trending'], trending_score), (_counters['popular'], popular_score)):
+                counter.add(int(book_id), weight=float(score) * math.exp(-counter.rate * age), now=now)
+    print(f"Loaded popularity scores for {len(rows)} books")
+
+def _snapshot_loop():
+    load_snapshot()
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        save_snapshot()
+
+def start_background_snapshots():
+    """Loads the saved scores, then saves them every SNAPSHOT_INTERVAL seconds, on a daemon thread."""
+    thread = threading.Thread(target=_snapshot_loop, name="trending", daemon=True)
+    thread.start()
+    return thread
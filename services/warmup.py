@@ -0,0 +1,79 @@
+# services/warmup.py
+# Startup warm-up and the readiness state behind /healthz and /readyz.
+#
+# A freshly started server has no database sessions, no catalog and cold caches,
+# so the first users after a deploy would pay for all of it. The server starts
+# answering at once, but runs its warm-up steps (open the session pools, read
+# the categories, wait for the catalog, gzip the static files) on a background
+# thread first. A step that fails is tried again every RETRY_INTERVAL seconds.
+#
+# /healthz only says the process is alive. /readyz answers 503 until every step
+# has worked, so a load balancer sends users only to warm servers. After that it
+# stays 200 even while the database is down: the servers keep answering from
+# the last known good data then, and taking them all out of rotation at once
+# would turn a database incident into a full outage. The body shows the
+# database state either way.
+
+import threading
+import time
+from db.connection import database_available
+
+RETRY_INTERVAL = 5
+
+STARTED_AT = time.time()
+_lock = threading.Lock()
+# Step name -> seconds it took, or None while it has not worked yet
+_steps = {}
+_state = {'ready_at': None}
+
+def _run_steps(steps):
+    pending = list(steps)
+    while pending:
+        failed = []
+        for name, step in pending:
+            began = time.perf_counter()
+            try:
+                ok = step()
+            except Exception as e:
+                print(f"Warm-up step {name} failed: {e}")
+                ok = False
+            if ok:
+                with _lock:
+                    _steps[name] = round(time.perf_counter() - began, 3)
+            else:
+                failed.append((name, step))
+        pending = failed
+        if pending:
+            time.sleep(RETRY_INTERVAL)
+    with _lock:
+        _state['ready_at'] = time.time()
+    print(f"Warm-up finished {_state['ready_at'] - STARTED_AT:.1f}s after start")
+
+def start_warm_up(steps):
+    """
+    Runs the warm-up steps, a list of (name, function returning True when it
+    worked), in order on a daemon thread.
+    """
+    with _lock:
+        for name, step in steps:
+            _steps[name] = None
+    thread = threading.Thread(target=_run_steps, args=(steps,), name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def health():
+    """What /healthz reports: the process is up, and for how long."""
+    return {'status': 'ok', 'uptime': round(time.time() - STARTED_AT, 1)}
+
+def readiness():
+    """Returns (ready, details) for /readyz."""
+    with _lock:
+        ready_at = _state['ready_at']
+        details = {
+            'status': 'ready' if ready_at is not None else 'warming-up',
+            'steps': dict(_steps),
+            'database': 'up' if database_available() else 'down',
+        }
+    if ready_at is not None:
+        details['warm_up_seconds'] = round(ready_at - STARTED_AT, 1)
+    return ready_at is not None, details
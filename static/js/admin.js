@@ -45,6 +45,14 @@ function loadState() {
     if (saved) Object.assign(state, JSON.parse(saved));
 }
 function logout() {
+    if (state.token) {
+        // Tell the server to end the session; the local state is cleared either way
+        fetch(`${API_BASE_URL}/logout`, {
+            method: 'POST',
+            headers: { 'Authorization': `Bearer ${state.token}`, 'Content-Type': 'application/json' },
+            body: '{}'
+        }).catch(() => {});
+    }
     Object.assign(state, { isLoggedIn: false, token: null, admin: null });
     saveState();
     router();
@@ -50,6 +50,27 @@ async function apiRequest(endpoint, method = 'GET', body = null, isFormData = fa
     }
 }
 
+// Fetches several GET endpoints in one round trip through /api/batch.
+// `requests` maps a name to an endpoint, e.g. { categories: '/categories' };
+// the result maps the same names to the response bodies.
+async function apiBatch(requests) {
+    const names = Object.keys(requests);
+    const data = await apiRequest('/batch', 'POST', {
+        requests: names.map(name => ({ id: name, path: `/api${requests[name]}` }))
+    });
+    const results = {};
+    for (const name of names) {
+        const part = data.responses[name];
+        if (part.status >= 400) {
+            const message = (part.body && part.body.error) || `HTTP error! status: ${part.status}`;
+            displayError(message);
+            throw new Error(message);
+        }
+        results[name] = part.body;
+    }
+    return results;
+}
+
 
 
 
@@ -85,13 +106,64 @@ function loadState() {
     }
 }
 function logout() {
+    if (state.token) {
+        // Tell the server to end the session; the local state is cleared either way
+        fetch(`${API_BASE_URL}/logout`, {
+            method: 'POST',
+            headers: { 'Authorization': `Bearer ${state.token}`, 'Content-Type': 'application/json' },
+            body: '{}'
+        }).catch(() => {});
+    }
     state.isLoggedIn = false;
     state.token = null;
     state.user = null;
     saveState();
+    connectChangeEvents();
     navigateTo('#/login');
 }
 function navigateTo(hash) { window.location.hash = hash; }
+
+// --- LIVE CHANGE EVENTS ---
+// The server pushes book, category and subscription changes over /api/events.
+// EventSource reconnects by itself and resumes from the last event it saw.
+let changeEvents = null;
+
+function connectChangeEvents() {
+    if (changeEvents) changeEvents.close();
+    const query = state.token ? `?token=${encodeURIComponent(state.token)}` : '';
+    changeEvents = new EventSource(`${API_BASE_URL}/events${query}`);
+
+    changeEvents.addEventListener('book-deleted', e => {
+        const { book_id } = JSON.parse(e.data);
+        document.querySelectorAll(`.book-card[data-book-id="${book_id}"]`).forEach(card => card.remove());
+    });
+    changeEvents.addEventListener('book-updated', e => {
+        const book = JSON.parse(e.data);
+        document.querySelectorAll(`.book-card[data-book-id="${book.book_id}"]`).forEach(card => {
+            card.querySelector('h3').textContent = book.name;
+            card.querySelector('.author').textContent = `by ${book.author_name}`;
+        });
+    });
+    changeEvents.addEventListener('subscriptions-changed', e => {
+        const change = JSON.parse(e.data);
+        if (!state.user) return;
+        state.user.subscriptions = state.user.subscriptions || {};
+        if (change.action === 'added') {
+            state.user.subscriptions[change.category_id] = change.expiry_date;
+        } else {
+            delete state.user.subscriptions[change.category_id];
+        }
+        saveState();
+        if (window.location.hash === '#/subscribe') router();
+    });
+    changeEvents.addEventListener('category-changed', () => {
+        if (window.location.hash === '#/subscribe') router();
+    });
+    // Too much was missed to replay it; the next render fetches everything again
+    changeEvents.addEventListener('reset', () => {
+        if (window.location.hash === '#/subscribe') router();
+    });
+}
 function displayError(message) {
     const errorDiv = document.createElement('div');
     errorDiv.className = 'error-message';
@@ -231,7 +303,9 @@ async function renderBooksPage() {
         loadBooks(categoryId, e.target.value);
     });
 
-    const categories = await apiRequest('/categories');
+    // Categories and the first page of books arrive in a single request
+    const { categories, books } = await apiBatch({ categories: '/categories', books: '/books' });
+    bookListContainer.innerHTML = renderBookGrid(books);
     let filterButtonsHTML = `<button class="btn btn-category active" data-category-id="">All</button>`;
     filterButtonsHTML += categories.map(cat => `<button class="btn btn-category" data-category-id="${cat.category_id}">${cat.category_name}</button>`).join('');
     categoryFiltersContainer.innerHTML = filterButtonsHTML;
@@ -244,7 +318,6 @@ async function renderBooksPage() {
             loadBooks(categoryId, searchInput.value);
         }
     });
-    loadBooks();
 }
 
 async function renderSubscribePage() {
@@ -295,6 +368,7 @@ function renderLoginPage() {
                 subscriptions: data.subscriptions || {}
             };
             saveState();
+            connectChangeEvents();
             navigateTo(data.type === 'user' ? '#/books' : '#/publisher/dashboard');
         } catch (error) { /* Handled */ }
     });
@@ -410,10 +484,9 @@ async function renderAddOrEditBookPage(bookId = null) {
         return;
     }
 
-    const [categories, allBooks] = await Promise.all([
-        apiRequest('/categories'),
-        bookId ? apiRequest('/books/publisher') : Promise.resolve([])
-    ]);
+    const { categories, allBooks = [] } = await apiBatch(
+        bookId ? { categories: '/categories', allBooks: '/books/publisher' } : { categories: '/categories' }
+    );
 
     let book = {};
     const isEditing = bookId !== null;
@@ -516,8 +589,9 @@ async function readBook(bookId) {
     // --- END ADDED CODE ---
 
     try {
-        const pdfBlob = await apiRequest(`/books/read/${bookId}`, 'GET', null, false, 'blob');
-        const pdfData = new Uint8Array(await pdfBlob.arrayBuffer());
+        // One entitlement check gives a short-lived signed link; PDF.js then
+        // fetches the document from it in range requests, as pages are needed
+        const link = await apiRequest(`/books/read-link/${bookId}`);
 
         if (document.getElementById('pdf-loading-message')) {
             document.getElementById('pdf-loading-message').remove();
@@ -551,7 +625,7 @@ async function readBook(bookId) {
         document.getElementById('prev-page').addEventListener('click', () => { if (pageNum <= 1) return; pageNum--; queueRenderPage(pageNum); });
         document.getElementById('next-page').addEventListener('click', () => { if (pageNum >= pdfDoc.numPages) return; pageNum++; queueRenderPage(pageNum); });
 
-        pdfjsLib.getDocument({ data: pdfData }).promise.then(doc => {
+        pdfjsLib.getDocument({ url: link.url, disableAutoFetch: true, disableStream: true }).promise.then(doc => {
             pdfDoc = doc;
             document.getElementById('page-count').textContent = doc.numPages;
             renderPage(pageNum);
@@ -607,6 +681,7 @@ function router() {
 // --- INITIALIZATION ---
 function init() {
     loadState();
+    connectChangeEvents();
     window.addEventListener('hashchange', router);
     window.addEventListener('load', router);
     document.body.addEventListener('click', e => {